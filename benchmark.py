@@ -0,0 +1,643 @@
+import os
+import time
+import resource
+import torch
+import tempfile
+import importlib.util
+import numpy as np
+from utils import *
+from config import *
+from transformers import GPT2Config
+from triage import has_invalid_stuffing
+from samplings import top_k_sampling, top_p_sampling, temperature_sampling, sample_logits
+
+### Micro-benchmarks for the hot paths of training and inference
+# python benchmark.py sampling --batch_size 8 --steps 1000
+# python benchmark.py generate --decoding greedy --chunk_size 256
+# python benchmark.py dataset --folders dataset --shards shards
+# python benchmark.py load --checkpoint weights-train5.pth
+# python benchmark.py embedding --batch_size 2
+# python benchmark.py memory --patch_length 1024 2048
+# python benchmark.py precision --pairs ./bgpt-dataset --num_pairs 32
+# python benchmark.py steps --batch_size 8 --context 256
+# python benchmark.py speculative --pairs ./bgpt-dataset --decoding sample
+# python benchmark.py candidates --num_candidates 128
+# python benchmark.py beam --pairs ./bgpt-dataset --widths 1 2 4 8
+
+def timeit(fn, steps, warmup=10):
+    """Run fn a few times to warm up, then return the mean seconds per call."""
+    for _ in range(warmup):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+def peak_memory(fn, device):
+    """
+    Peak memory of one call of fn in bytes: the peak allocated by torch on CUDA, and on CPU the
+    growth of the peak RSS of a forked process running it (the peak of this process cannot be reset).
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated(device) - baseline
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, str((peak - baseline) * 1024).encode())
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return int(result)
+
+
+def saved_activations(forward):
+    """
+    Bytes of the tensors a forward pass saves for its backward pass, the activation memory that gradient
+    checkpointing trades for recomputation (tensors saved twice, such as weights, count once).
+    """
+    saved = {}
+
+    def pack(tensor):
+        saved[(tensor.data_ptr(), tensor.shape, tensor.stride())] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        forward()
+    return sum(saved.values())
+
+
+def read_file(path):
+    """The bytes of a file."""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def load_script(filename):
+    """Import one of the hyphenated scripts (e.g. train-gen.py) as a module."""
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace("-", "_"), filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_model(device, patch_length=PATCH_LENGTH):
+    """Build a randomly initialised bGPTLMHeadModel with the sizes in config.py."""
+    patch_config = GPT2Config(num_hidden_layers=PATCH_NUM_LAYERS, 
+                        max_length=patch_length, 
+                        max_position_embeddings=patch_length,
+                        hidden_size=HIDDEN_SIZE,
+                        n_head=HIDDEN_SIZE//64,
+                        vocab_size=1)
+    byte_config = GPT2Config(num_hidden_layers=BYTE_NUM_LAYERS, 
+                        max_length=PATCH_SIZE+1, 
+                        max_position_embeddings=PATCH_SIZE+1,
+                        hidden_size=HIDDEN_SIZE,
+                        n_head=HIDDEN_SIZE//64,
+                        vocab_size=256+1)
+    model = bGPTLMHeadModel(patch_config, byte_config)
+    return model.to(device).eval()
+
+
+def random_chunks(num_chunks, chunk_size, seed=0):
+    """Random chunks laid out like inference.py convert mode: bos, input, bos."""
+    rng = np.random.default_rng(seed)
+    bos_patch = [256] * PATCH_SIZE
+    chunks = []
+    for _ in range(num_chunks):
+        chunk = rng.integers(0, 256, size=chunk_size).tolist()
+        chunks.append(bos_patch + chunk + bos_patch)
+    return chunks
+
+
+def benchmark_generate(args):
+    """Time the repair of random chunks with generate_batch for one decoding mode."""
+    device = torch.device(args.device)
+    model = build_model(device)
+    byte_lists = random_chunks(args.num_chunks, args.chunk_size)
+    input_patches, input_masks = pad_byte_lists(byte_lists)
+    references = torch.tensor([byte_list[PATCH_SIZE:-PATCH_SIZE] for byte_list in byte_lists])
+    generator = torch.Generator(device=device).manual_seed(0)
+
+    def generate():
+        with torch.no_grad():
+            return model.generate_batch(input_patches,
+                                        input_masks,
+                                        top_k=args.top_k,
+                                        top_p=args.top_p,
+                                        temperature=args.temperature,
+                                        generator=generator,
+                                        decoding=args.decoding,
+                                        references=references,
+                                        max_patches=args.chunk_size//PATCH_SIZE+1)
+
+    elapsed = timeit(generate, args.steps, warmup=1)
+    print(f"{args.decoding}: {elapsed/args.num_chunks:.3f} s/chunk ({args.num_chunks/elapsed:.2f} chunks/sec)")
+
+
+def benchmark_dataset(args):
+    """Compare samples/sec of ByteDataset on the raw files against ShardDataset on the packed shards."""
+    train_gen = load_script("train-gen.py")
+    datasets = {}
+    if args.folders:
+        datasets["ByteDataset"] = train_gen.ByteDataset(train_gen.list_files_in_directory(args.folders))
+    if args.shards:
+        datasets["ShardDataset"] = train_gen.ShardDataset(train_gen.list_samples_in_shards(args.shards))
+
+    for name, dataset in datasets.items():
+        num_samples = min(args.num_samples, len(dataset))
+        start = time.perf_counter()
+        for start_idx in range(0, num_samples, BATCH_SIZE):
+            batch = [dataset[idx] for idx in range(start_idx, min(start_idx+BATCH_SIZE, num_samples))]
+            train_gen.collate_batch(batch)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {num_samples/elapsed:.1f} samples/sec")
+
+
+def benchmark_load(args):
+    """Compare the model startup from a training checkpoint against skip_init with exported weights."""
+    device = torch.device(args.device)
+
+    start = time.perf_counter()
+    model = build_model(device)
+    checkpoint = torch.load(args.checkpoint, map_location=device)
+    model.load_state_dict(checkpoint['model'])
+    baseline_time = time.perf_counter() - start
+    print(f"init + training checkpoint: {baseline_time:.2f}s")
+    del model, checkpoint
+
+    with tempfile.TemporaryDirectory() as directory:
+        for ext in [".safetensors", ".pt"]:
+            path = os.path.join(directory, "weights"+ext)
+            try:
+                export_inference_weights(torch.load(args.checkpoint, map_location='cpu')['model'], path)
+            except ImportError as error:
+                print(f"skip_init + {ext}: skipped ({error})")
+                continue
+
+            start = time.perf_counter()
+            with skip_init():
+                model = build_model(device)
+            load_inference_weights(model, path, device)
+            elapsed = time.perf_counter() - start
+            print(f"skip_init + {ext}: {elapsed:.2f}s ({baseline_time/elapsed:.1f}x)")
+            del model
+
+
+def benchmark_embedding(args):
+    """Compare the one-hot patch embedding against the embedding_bag gather-sum, forward and backward."""
+    device = torch.device(args.device)
+    model = build_model(device).train()
+    decoder = model.patch_level_decoder
+    patches = torch.randint(0, 256+1, (args.batch_size, args.patch_length*PATCH_SIZE), device=device)
+
+    for name, embedding_bag in [("one-hot      ", False), ("embedding_bag", True)]:
+        def forward():
+            with torch.no_grad():
+                return decoder.embed(patches, embedding_bag)
+
+        def backward():
+            decoder.embed(patches, embedding_bag).sum().backward()
+
+        forward_time = timeit(forward, args.steps)
+        backward_time = timeit(backward, args.steps)
+        memory = peak_memory(backward, device)
+        print(f"{name}: forward {forward_time*1e3:.2f} ms, forward+backward {backward_time*1e3:.2f} ms, peak {memory/2**20:.1f} MB")
+
+
+def benchmark_memory(args):
+    """Peak memory and throughput of a training step for every gradient checkpointing and attention setting."""
+    device = torch.device(args.device)
+    settings = [("eager                 ", False, False),
+                ("checkpointing         ", True, False),
+                ("sdpa                  ", False, True),
+                ("checkpointing + sdpa  ", True, True)]
+
+    for patch_length in args.patch_length:
+        print(f"PATCH_LENGTH {patch_length}, batch size {args.batch_size}:")
+        patches = torch.randint(0, 256, (args.batch_size, patch_length*PATCH_SIZE), device=device)
+        masks = torch.ones(args.batch_size, patch_length, dtype=torch.long, device=device)
+        for name, gradient_checkpointing, sdpa in settings:
+            torch.manual_seed(0)
+            model = configure_memory(build_model(device, patch_length).train(), gradient_checkpointing, sdpa)
+
+            def forward():
+                return model(patches, masks).loss
+
+            def step():
+                forward().backward()
+                model.zero_grad(set_to_none=True)
+
+            try:
+                activations = saved_activations(forward)
+                memory = peak_memory(step, device)
+                step_time = timeit(step, args.steps, warmup=1)
+            except RuntimeError as error:
+                # out of memory on CUDA, the other settings may still fit
+                print(f"  {name}: failed ({str(error).splitlines()[0]})")
+                continue
+            finally:
+                del model
+                if device.type == "cuda":
+                    torch.cuda.empty_cache()
+            print(f"  {name}: {step_time:.2f} s/step ({args.batch_size*patch_length/step_time:.0f} patches/sec), "
+                  f"saved activations {activations/2**20:.0f} MB, peak {memory/2**20:.0f} MB")
+
+
+def benchmark_precision(args):
+    """
+    Repair accuracy and latency of CPU inference in fp32, bf16 and int8 on held-out .input/.output pairs,
+    converted like inference.py convert mode with the decoding settings of config.py.
+    """
+    device = torch.device("cpu")
+    bases = sorted(path[:-len(".input")] for path in os.listdir(args.pairs) if path.endswith(".input"))
+    bases = [base for base in bases if os.path.exists(os.path.join(args.pairs, base+".output"))][:args.num_pairs]
+    inputs = [read_file(os.path.join(args.pairs, base+".input")) for base in bases]
+    targets = [read_file(os.path.join(args.pairs, base+".output")) for base in bases]
+    print(f"{len(bases)} pairs, {sum(len(target) for target in targets)} target bytes, decoding {DECODING_MODE}")
+
+    reference_outputs = None
+    for precision in args.precisions:
+        model = load_inference_model(device, args.checkpoint, precision)
+        generator = torch.Generator(device=device).manual_seed(0)
+        outputs = []
+        start = time.perf_counter()
+        for start_idx in range(0, len(inputs), args.batch_size):
+            outputs += convert_chunks(model, inputs[start_idx:start_idx+args.batch_size], generator, precision)
+        elapsed = time.perf_counter() - start
+
+        # bytes past the end of the shorter of output and target count as wrong
+        correct = sum(sum(a == b for a, b in zip(output, target)) for output, target in zip(outputs, targets))
+        total = sum(max(len(output), len(target)) for output, target in zip(outputs, targets))
+        exact = sum(output == target for output, target in zip(outputs, targets))
+        line = (f"{precision}: {elapsed/max(len(inputs), 1):.2f} s/chunk, byte accuracy {correct/max(total, 1):.2%}, "
+                f"exact chunks {exact}/{len(inputs)}")
+        if reference_outputs is None:
+            reference_outputs, reference_time = outputs, elapsed
+        else:
+            same = sum(output == reference for output, reference in zip(outputs, reference_outputs))
+            line += f", {reference_time/elapsed:.2f}x the speed and {same}/{len(inputs)} chunks equal to {args.precisions[0]}"
+        print(line)
+        del model
+
+
+def benchmark_steps(args):
+    """
+    Latency of one step of each decoder, and of greedy generation, in eager mode (with the growing byte-level
+    cache, and with the static byte-level step) against compile_steps.
+    The byte-level step is timed over a whole patch (PATCH_SIZE calls) and reported per call.
+    """
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    eager = build_model(device)
+    torch.manual_seed(0)
+    static = build_model(device)
+    static.byte_level_decoder.static_steps = True
+    torch.manual_seed(0)
+    compiled = compile_steps(build_model(device), True)
+    encoded_patches = torch.randn(args.batch_size, HIDDEN_SIZE, device=device)
+    context = torch.randint(0, 256, (args.batch_size, args.context*PATCH_SIZE), device=device)
+    new_patches = torch.randint(0, 256, (args.batch_size, 1, PATCH_SIZE), device=device)
+    byte_lists = random_chunks(args.batch_size, args.chunk_size)
+    input_patches, input_masks = pad_byte_lists(byte_lists)
+
+    results = {}
+    for name, model in [("eager", eager), ("static", static), ("compiled", compiled)]:
+        def byte_steps():
+            tokens = torch.full((args.batch_size, 1), 256, device=device)
+            past_key_values = None
+            for _ in range(PATCH_SIZE):
+                logits, past_key_values = model.byte_level_decoder.generate(encoded_patches,
+                                                                            tokens,
+                                                                            past_key_values=past_key_values,
+                                                                            use_cache=True,
+                                                                            return_logits=True)
+                tokens = logits.argmax(-1, keepdim=True)
+
+        with torch.no_grad():
+            past_key_values = model.patch_level_decoder(context, use_cache=True)["past_key_values"]
+            masks = torch.ones(args.batch_size, args.context+1, dtype=torch.long, device=device)
+            positions = torch.full((args.batch_size, 1), args.context, device=device)
+
+        def patch_step():
+            return model.patch_level_decoder(new_patches,
+                                             masks,
+                                             past_key_values=past_key_values,
+                                             use_cache=True,
+                                             position_ids=positions)
+
+        def generate():
+            return model.generate_batch(input_patches,
+                                        input_masks,
+                                        decoding="greedy",
+                                        max_patches=args.chunk_size//PATCH_SIZE+1)
+
+        with torch.no_grad():
+            byte_time = timeit(byte_steps, args.steps, warmup=3) / PATCH_SIZE
+            patch_time = timeit(patch_step, args.steps, warmup=3)
+            generate_time = timeit(generate, 1, warmup=1)
+            results[name] = generate()
+        print(f"{name:8}: byte-level step {byte_time*1e3:.2f} ms, patch-level step {patch_time*1e3:.2f} ms, "
+              f"greedy generation {generate_time/args.batch_size:.2f} s/chunk")
+    print(f"Same greedy output: {results['eager'] == results['static'] == results['compiled']}")
+
+
+def benchmark_speculative(args):
+    """
+    Sequential byte-level decoder calls and seconds per chunk of generate_batch, byte by byte against
+    speculative decoding with the input bytes as drafts, on held-out .input chunks or random chunks.
+    """
+    device = torch.device(args.device)
+    if args.pairs:
+        model = load_inference_model(device, args.checkpoint)
+        names = sorted(name for name in os.listdir(args.pairs) if name.endswith(".input"))[:args.num_chunks]
+        chunks = [read_file(os.path.join(args.pairs, name)) for name in names]
+        byte_lists = [encode_chunk(chunk) for chunk in chunks]
+    else:
+        model = build_model(device)
+        byte_lists = random_chunks(args.num_chunks, args.chunk_size)
+    input_patches, input_masks = pad_byte_lists(byte_lists)
+    references = torch.nn.utils.rnn.pad_sequence([torch.tensor(byte_list[PATCH_SIZE:-PATCH_SIZE]) for byte_list in byte_lists],
+                                                 batch_first=True,
+                                                 padding_value=256)
+
+    # every call of the byte-level decoder is one sequential step, a byte or a verification pass
+    decoder = model.byte_level_decoder
+    num_calls = 0
+    for method in ["forward", "generate"]:
+        def counted(*method_args, method=getattr(decoder, method), **method_kwargs):
+            nonlocal num_calls
+            num_calls += 1
+            return method(*method_args, **method_kwargs)
+        setattr(decoder, method, counted)
+
+    outputs = {}
+    for speculative in [False, True]:
+        generator = torch.Generator(device=device).manual_seed(0)
+        num_calls = 0
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs[speculative] = model.generate_batch(input_patches,
+                                                        input_masks,
+                                                        top_k=args.top_k,
+                                                        top_p=args.top_p,
+                                                        temperature=args.temperature,
+                                                        generator=generator,
+                                                        decoding=args.decoding,
+                                                        references=references,
+                                                        copy_threshold=COPY_THRESHOLD,
+                                                        max_patches=references.shape[1]//PATCH_SIZE+1,
+                                                        speculative=speculative)
+        elapsed = time.perf_counter() - start
+        # the chunks of the batch share the calls, so they are counted per patch of the longest output
+        num_patches = max(len(output) for output in outputs[speculative]) / PATCH_SIZE
+        print(f"{'speculative' if speculative else 'byte by byte'}: {num_calls/max(num_patches, 1):.2f} byte-level calls per patch, "
+              f"{elapsed/len(byte_lists):.2f} s/chunk")
+    if args.decoding != "sample":
+        print(f"Same output: {outputs[False] == outputs[True]}")
+
+
+def benchmark_candidates(args):
+    """
+    Scoring of K candidate patches (single bit flips of a patch) after a context: K*PATCH_SIZE sequential
+    calls of ByteLevelDecoder.generate against one call of score_candidates.
+    """
+    device = torch.device(args.device)
+    model = build_model(device)
+    byte_lists = [byte_list[:-PATCH_SIZE] for byte_list in random_chunks(args.batch_size, args.context*PATCH_SIZE)]
+    patches = torch.tensor(byte_lists, device=device)
+    masks = torch.ones(args.batch_size, len(byte_lists[0])//PATCH_SIZE, dtype=torch.long, device=device)
+    patch = torch.randint(0, 256, (PATCH_SIZE,), device=device)
+    flips = torch.arange(args.num_candidates, device=device)
+    candidates = patch.repeat(args.num_candidates, 1)
+    candidates[flips, flips // 8 % PATCH_SIZE] ^= 1 << (flips % 8)
+
+    def sequential():
+        encoded_patches = model.patch_level_decoder(patches, masks)["last_hidden_state"][:, -1]
+        scores = []
+        for candidate in candidates:
+            tokens = torch.full((args.batch_size, 1), 256, device=device)
+            past_key_values = None
+            log_probs = []
+            for byte in candidate:
+                logits, past_key_values = model.byte_level_decoder.generate(encoded_patches,
+                                                                            tokens,
+                                                                            past_key_values=past_key_values,
+                                                                            use_cache=True,
+                                                                            return_logits=True)
+                log_probs.append(torch.log_softmax(logits, dim=-1)[:, byte])
+                tokens = byte.repeat(args.batch_size, 1)
+            scores.append(torch.stack(log_probs, dim=1))
+        return torch.stack(scores, dim=1)
+
+    def batched():
+        return model.score_candidates(patches, masks, candidates)
+
+    with torch.no_grad():
+        sequential_time = timeit(sequential, args.steps, warmup=1)
+        batched_time = timeit(batched, args.steps, warmup=1)
+        difference = (sequential() - batched()).abs().max().item()
+    print(f"{args.num_candidates} candidates after {args.batch_size} contexts of {args.context} patches")
+    print(f"byte by byte ({args.num_candidates*PATCH_SIZE} calls): {sequential_time*1e3:.1f} ms")
+    print(f"score_candidates (1 call): {batched_time*1e3:.1f} ms ({sequential_time/batched_time:.1f}x), "
+          f"largest log-probability difference {difference:.2e}")
+
+
+def benchmark_beam(args):
+    """
+    Repair of held-out .input/.output pairs with the decoding of config.py against beam search with JPEG
+    byte-stuffing pruning, for every beam width: exact repairs, byte accuracy, outputs breaking the byte
+    stuffing and seconds per chunk.
+    """
+    device = torch.device(args.device)
+    model = load_inference_model(device, args.checkpoint)
+    names = sorted(name[:-len(".input")] for name in os.listdir(args.pairs) if name.endswith(".input"))[:args.num_pairs]
+    inputs = [read_file(os.path.join(args.pairs, name+".input")) for name in names]
+    targets = [read_file(os.path.join(args.pairs, name+".output")) for name in names]
+    print(f"{len(names)} pairs, {sum(input != target for input, target in zip(inputs, targets))} of them corrupted")
+
+    def report(name, decode):
+        start = time.perf_counter()
+        outputs = []
+        for start_idx in range(0, len(inputs), args.batch_size):
+            byte_lists = [encode_chunk(chunk) for chunk in inputs[start_idx:start_idx+args.batch_size]]
+            input_patches, input_masks = pad_byte_lists(byte_lists)
+            references = torch.nn.utils.rnn.pad_sequence([torch.tensor(byte_list[PATCH_SIZE:-PATCH_SIZE]) for byte_list in byte_lists],
+                                                         batch_first=True,
+                                                         padding_value=256)
+            with torch.no_grad():
+                outputs += [bytes(output) for output in decode(input_patches, input_masks, references)]
+        elapsed = time.perf_counter() - start
+
+        exact = sum(output == target for output, target in zip(outputs, targets))
+        correct = sum(sum(a == b for a, b in zip(output, target)) for output, target in zip(outputs, targets))
+        total = sum(max(len(output), len(target)) for output, target in zip(outputs, targets))
+        invalid = sum(has_invalid_stuffing(output) for output in outputs)
+        print(f"{name}: {exact}/{len(outputs)} repaired exactly, byte accuracy {correct/max(total, 1):.2%}, "
+              f"{invalid} breaking the byte stuffing, {elapsed/max(len(outputs), 1):.2f} s/chunk")
+
+    generator = torch.Generator(device=device).manual_seed(0)
+    report(f"{DECODING_MODE:>14}", lambda patches, masks, references: model.generate_batch(patches,
+                                                                                          masks,
+                                                                                          top_k=TOP_K,
+                                                                                          top_p=TOP_P,
+                                                                                          temperature=TEMPERATURE,
+                                                                                          generator=generator,
+                                                                                          decoding=DECODING_MODE,
+                                                                                          references=references,
+                                                                                          copy_threshold=COPY_THRESHOLD,
+                                                                                          max_patches=references.shape[1]//PATCH_SIZE+1,
+                                                                                          sliding_window=SLIDING_WINDOW))
+    for width in args.widths:
+        report(f"beam width {width:>3}", lambda patches, masks, references: model.generate_beam(patches,
+                                                                                              masks,
+                                                                                              beam_width=width,
+                                                                                              jpeg_stuffing=not args.no_pruning,
+                                                                                              max_patches=references.shape[1]//PATCH_SIZE+1,
+                                                                                              sliding_window=SLIDING_WINDOW,
+                                                                                              length_penalty=BEAM_LENGTH_PENALTY))
+
+
+def benchmark_sampling(args):
+    """Compare the NumPy samplings.py round-trip against the batched on-device sample_logits."""
+    device = torch.device(args.device)
+    logits = torch.randn(args.batch_size, 256+1, device=device) * 4
+    generator = torch.Generator(device=device).manual_seed(0)
+
+    def numpy_sampling():
+        probs = torch.nn.functional.softmax(logits, dim=-1).cpu().detach().numpy()
+        tokens = []
+        for prob in probs:
+            prob = top_k_sampling(prob, top_k=args.top_k, return_probs=True)
+            prob = top_p_sampling(prob, top_p=args.top_p, return_probs=True)
+            tokens.append(temperature_sampling(prob, temperature=args.temperature))
+        return torch.tensor(tokens, device=device)
+
+    def torch_sampling():
+        return sample_logits(logits,
+                             top_k=args.top_k,
+                             top_p=args.top_p,
+                             temperature=args.temperature,
+                             generator=generator).tolist()
+
+    numpy_time = timeit(numpy_sampling, args.steps)
+    torch_time = timeit(torch_sampling, args.steps)
+    print(f"samplings.py (NumPy): {numpy_time*1e6:.1f} us/step")
+    print(f"sample_logits       : {torch_time*1e6:.1f} us/step ({numpy_time/torch_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for bGPT.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sampling_parser = subparsers.add_parser("sampling", help="Sampling of the next byte.")
+    sampling_parser.add_argument("--batch_size", type=int, default=1, help="Number of sequences sampled at once.")
+    sampling_parser.add_argument("--steps", type=int, default=1000, help="Number of timed steps.")
+    sampling_parser.add_argument("--top_k", type=int, default=8, help="Top k for sampling.")
+    sampling_parser.add_argument("--top_p", type=float, default=0.9, help="Top p for sampling.")
+    sampling_parser.add_argument("--temperature", type=float, default=1.0, help="Temperature for sampling.")
+    sampling_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    sampling_parser.set_defaults(func=benchmark_sampling)
+
+    generate_parser = subparsers.add_parser("generate", help="Repair of random chunks with a random model.")
+    generate_parser.add_argument("--decoding", default="sample", choices=["sample", "greedy", "copy"], help="Decoding mode.")
+    generate_parser.add_argument("--num_chunks", type=int, default=4, help="Number of chunks repaired at once.")
+    generate_parser.add_argument("--chunk_size", type=int, default=256, help="Bytes per chunk.")
+    generate_parser.add_argument("--steps", type=int, default=3, help="Number of timed steps.")
+    generate_parser.add_argument("--top_k", type=int, default=TOP_K, help="Top k for sampling.")
+    generate_parser.add_argument("--top_p", type=float, default=TOP_P, help="Top p for sampling.")
+    generate_parser.add_argument("--temperature", type=float, default=TEMPERATURE, help="Temperature for sampling.")
+    generate_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    generate_parser.set_defaults(func=benchmark_generate)
+
+    dataset_parser = subparsers.add_parser("dataset", help="Loading of training samples.")
+    dataset_parser.add_argument("--folders", nargs="*", default=[], help="Folders with raw training files.")
+    dataset_parser.add_argument("--shards", nargs="*", default=[], help="Folders packed by pack-dataset.py.")
+    dataset_parser.add_argument("--num_samples", type=int, default=1000, help="Number of samples to load.")
+    dataset_parser.set_defaults(func=benchmark_dataset)
+
+    load_parser = subparsers.add_parser("load", help="Model startup before the first chunk.")
+    load_parser.add_argument("--checkpoint", default=INFERENCE_WEIGHTS_PATH, help="Training checkpoint saved by train-gen.py.")
+    load_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    load_parser.set_defaults(func=benchmark_load)
+
+    embedding_parser = subparsers.add_parser("embedding", help="Patch embedding of the patch-level decoder.")
+    embedding_parser.add_argument("--batch_size", type=int, default=BATCH_SIZE, help="Number of sequences embedded at once.")
+    embedding_parser.add_argument("--patch_length", type=int, default=PATCH_LENGTH, help="Patches per sequence.")
+    embedding_parser.add_argument("--steps", type=int, default=20, help="Number of timed steps.")
+    embedding_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    embedding_parser.set_defaults(func=benchmark_embedding)
+
+    memory_parser = subparsers.add_parser("memory", help="Training step with gradient checkpointing and SDPA attention.")
+    memory_parser.add_argument("--batch_size", type=int, default=BATCH_SIZE, help="Number of sequences per step.")
+    memory_parser.add_argument("--patch_length", type=int, nargs="+", default=[PATCH_LENGTH], help="Patches per sequence, one run each.")
+    memory_parser.add_argument("--steps", type=int, default=3, help="Number of timed steps.")
+    memory_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    memory_parser.set_defaults(func=benchmark_memory)
+
+    precision_parser = subparsers.add_parser("precision", help="Repair accuracy and latency of CPU inference per precision.")
+    precision_parser.add_argument("--pairs", required=True, help="Folder with held-out .input/.output pairs of flip-bits-final.py.")
+    precision_parser.add_argument("--num_pairs", type=int, default=32, help="Number of pairs converted.")
+    precision_parser.add_argument("--batch_size", type=int, default=INFERENCE_BATCH_SIZE, help="Number of chunks converted at once.")
+    precision_parser.add_argument("--precisions", nargs="+", default=["fp32", "bf16", "int8"], choices=["fp32", "bf16", "int8"], help="Precisions compared, the first one is the reference.")
+    precision_parser.add_argument("--checkpoint", default=INFERENCE_WEIGHTS_PATH, help="Training checkpoint or exported weights.")
+    precision_parser.set_defaults(func=benchmark_precision)
+
+    steps_parser = subparsers.add_parser("steps", help="Decoder steps of generation in eager mode and with torch.compile.")
+    steps_parser.add_argument("--batch_size", type=int, default=INFERENCE_BATCH_SIZE, help="Number of sequences generated at once.")
+    steps_parser.add_argument("--context", type=int, default=256, help="Patches in the patch-level cache.")
+    steps_parser.add_argument("--chunk_size", type=int, default=256, help="Bytes per chunk for greedy generation.")
+    steps_parser.add_argument("--steps", type=int, default=20, help="Number of timed steps.")
+    steps_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    steps_parser.set_defaults(func=benchmark_steps)
+
+    speculative_parser = subparsers.add_parser("speculative", help="Speculative decoding with the input bytes as drafts.")
+    speculative_parser.add_argument("--pairs", default=None, help="Folder with held-out .input chunks, random chunks and weights otherwise.")
+    speculative_parser.add_argument("--checkpoint", default=INFERENCE_WEIGHTS_PATH, help="Training checkpoint or exported weights, with --pairs.")
+    speculative_parser.add_argument("--decoding", default="sample", choices=["sample", "greedy", "copy"], help="Decoding mode.")
+    speculative_parser.add_argument("--num_chunks", type=int, default=INFERENCE_BATCH_SIZE, help="Number of chunks converted at once.")
+    speculative_parser.add_argument("--chunk_size", type=int, default=256, help="Bytes per random chunk.")
+    speculative_parser.add_argument("--top_k", type=int, default=TOP_K, help="Top k for sampling.")
+    speculative_parser.add_argument("--top_p", type=float, default=TOP_P, help="Top p for sampling.")
+    speculative_parser.add_argument("--temperature", type=float, default=TEMPERATURE, help="Temperature for sampling.")
+    speculative_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    speculative_parser.set_defaults(func=benchmark_speculative)
+
+    candidates_parser = subparsers.add_parser("candidates", help="Scoring of candidate patches in one byte-level pass.")
+    candidates_parser.add_argument("--num_candidates", type=int, default=128, help="Number of candidate patches (bit flips).")
+    candidates_parser.add_argument("--batch_size", type=int, default=1, help="Number of contexts.")
+    candidates_parser.add_argument("--context", type=int, default=64, help="Patches per context.")
+    candidates_parser.add_argument("--steps", type=int, default=3, help="Number of timed steps.")
+    candidates_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    candidates_parser.set_defaults(func=benchmark_candidates)
+
+    beam_parser = subparsers.add_parser("beam", help="Repair with beam search and JPEG byte-stuffing pruning.")
+    beam_parser.add_argument("--pairs", required=True, help="Folder with held-out .input/.output pairs of flip-bits-final.py.")
+    beam_parser.add_argument("--checkpoint", default=INFERENCE_WEIGHTS_PATH, help="Training checkpoint or exported weights.")
+    beam_parser.add_argument("--widths", type=int, nargs="+", default=[1, 2, 4, 8], help="Beam widths compared.")
+    beam_parser.add_argument("--no_pruning", action="store_true", help="Keep the beams breaking the byte stuffing.")
+    beam_parser.add_argument("--num_pairs", type=int, default=16, help="Number of pairs repaired.")
+    beam_parser.add_argument("--batch_size", type=int, default=INFERENCE_BATCH_SIZE, help="Number of chunks repaired at once.")
+    beam_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    beam_parser.set_defaults(func=benchmark_beam)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -9,6 +9,10 @@ EVAL_FOLDERS = [
                 # "test"
                 # "cpu_states/test",
                 ]                                               # Folder containing evaluation data
+TRAIN_SHARDS = []                                               # Folders of shards packed by pack-dataset.py, used instead of TRAIN_FOLDERS when not empty
+EVAL_SHARDS = []                                                # Folders of packed shards for evaluation
+TRAIN_CONTAINERS = []                                           # Containers (.bgc files or folders of them) written by flip-bits-final.py, used instead of TRAIN_FOLDERS when not empty
+EVAL_CONTAINERS = []                                            # Containers for evaluation
 EVAL_SPLIT = 0.05                                                # Split of evaluation data
 
 # Configuration for the paths
@@ -19,9 +23,12 @@ LOGS_PATH = "logs-bgpt5.txt"                              # Path to save logs
 # Configuration for the model
 PATCH_SIZE = 16                                                 # Patch Size
 PATCH_LENGTH = 512                                             # Patch Length
+CHUNK_SIZE = 4096                                               # Size of the JPEG body chunks of create-dataset.py (an input/output pair takes 2*CHUNK_SIZE/PATCH_SIZE+3 patches)
+SLIDING_WINDOW = 16                                             # Oldest input patches dropped at once when an input/output pair overflows PATCH_LENGTH, 0 to truncate the output instead
 BYTE_NUM_LAYERS = 3                                             # Number of layers in the decoder
 PATCH_NUM_LAYERS = 12                                           # Number of layers in the encoder
 HIDDEN_SIZE = 384                                             # Hidden Size
+EMBEDDING_BAG = True                                            # Whether to embed patches with a gather-sum of the patch embedding weights instead of a one-hot matmul (same result, same checkpoints)
 
 # Configuration for the training
 NUM_EPOCHS = 2                                                 # Number of epochs to train for (if early stopping doesn't intervene)
@@ -29,10 +36,17 @@ LEARNING_RATE = 1e-5                                            # Learning rate
 BATCH_SIZE = 2                                                  # Batch size for training
 ACCUMULATION_STEPS = 1                                          # Accumulation steps to simulate large batch size
 PATCH_SAMPLING_BATCH_SIZE = 0                                   # Batch size for patch during training, 0 for full batch
+PATCH_SAMPLING_TARGETS = True                                   # Whether patch sampling only picks output patches of conversion pairs (only for patch sampling)
+BUCKET_BATCHING = False                                         # Whether to batch samples of similar patch counts together, to cut the padding (see BucketBatchSampler in train-gen.py)
+MAX_BATCH_PATCHES = 0                                           # Patches per batch once padded, instead of BATCH_SIZE samples, 0 for BATCH_SIZE (only for bucket batching)
+PACK_SEQUENCES = False                                          # Whether to pack several short samples into one PATCH_LENGTH sequence, with attention kept within every sample
+GRADIENT_CHECKPOINTING = False                                  # Whether to recompute the activations of the GPT2 blocks in the backward pass instead of keeping them (less memory, about a third slower)
+SDPA_ATTENTION = False                                          # Whether to run attention with PyTorch scaled_dot_product_attention instead of materialising the attention weights (needs PyTorch 2.0)
 LOAD_FROM_CHECKPOINT = True                                    # Whether to load weights from a checkpoint
 LOAD_FROM_PRETRAINED = False                                     # Whether to load pre-trained weights from a checkpoint
 ## input target
 CONVERSION_MODE = 'input->output'                                          # Mode of conversion None for autoregressive training, 'input->output' for unidirectional conversion, 'input&output' for bidirectional conversion)
+CORRECTION_HEAD = False                                         # Whether to train the single-pass correction head instead of the byte-level decoder (needs an aligned 'input->output' CONVERSION_MODE)
 WANDB_LOG = True                                                # Whether to log to wandb
 SHOW_WARNS = False                                              # Whether to show warnings
 DETERMINISTIC = True                                           # Whether to set random seed for reproducibility
@@ -43,8 +57,22 @@ INPUT_EXT = "bin"                                               # Extension of i
 TARGET_EXT = "bin"                                              # Extension of target files
 INPUT_FOLDER = "body-image-0001"                                          # Folder containing input files
 OUTPUT_FOLDER = "repaired"                                        # Folder to save output files
-INFERENCE_MODE = "generate"                                      # Mode of inference (convert or generate)
+INFERENCE_MODE = "generate"                                      # Mode of inference (convert, correct or generate)
 NUM_SAMPLES = 5                                               # Number of samples to generate (only for generate mode)
+INFERENCE_BATCH_SIZE = 8                                        # Number of files converted at once (only for convert and correct modes)
 TOP_K = 0                                                       # Top k for sampling
 TOP_P = 1.                                                      # Top p for sampling
 TEMPERATURE = 1                                                 # Temperature for sampling
+INFERENCE_SEED = 0                                              # Seed of the sampling generator, None for a random seed
+DECODING_MODE = "sample"                                        # Decoding mode ("sample", "greedy" for argmax, "copy" to copy the input unless confident, convert mode only)
+COPY_THRESHOLD = 0.9                                            # Probability the model needs to override the input byte (only for copy decoding)
+SPECULATIVE_DECODING = False                                    # Whether to verify the input bytes of each patch as a draft in one byte-level decoder pass, same distribution as decoding byte by byte (convert mode only)
+BEAM_WIDTH = 0                                                  # Beams per chunk of the beam search decoder in convert mode, 0 to decode with DECODING_MODE instead
+BEAM_JPEG_PRUNING = True                                        # Whether beam search prunes the beams breaking the JPEG byte stuffing (0xFF followed by anything but 0x00 or a restart marker)
+BEAM_LENGTH_PENALTY = 1.0                                       # Exponent of the length normalization of the beam scores, so that beams ending early do not win by being short
+CPU_PRECISION = "fp32"                                          # Precision on CPU: "fp32", "bf16" for bfloat16 autocast (inference and training) or "int8" for dynamic int8 quantization of the GPT2 linear layers (inference only)
+COMPILE_STEPS = False                                           # Whether to compile the byte-level and patch-level decoder steps of generation with torch.compile (falls back to eager mode)
+TRIAGE_MODE = None                                              # Triage of chunks before repair (None to repair every chunk, "stuffing", "perplexity" or "both", see triage.py)
+TRIAGE_THRESHOLD = 7.0                                          # Bits per byte of the worst patch above which a chunk is repaired (only for perplexity triage)
+LOCALIZED_REPAIR = False                                        # Regenerate only the output patches below the likelihood threshold and copy the rest (convert mode only, repairs the chunks of a batch one at a time instead of together)
+REPAIR_THRESHOLD = 2.0                                          # Bits per byte above which an output patch is regenerated (only for localized repair)
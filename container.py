@@ -0,0 +1,189 @@
+import json
+import mmap
+from pathlib import Path
+
+### Single-file container for chunked images, instead of one file per chunk
+# One .bgc file holds any number of images. Each image has its header, trailer, meta.json
+# and one or more streams of fixed-size chunks:
+# - "bin"             the body chunks written by create-dataset.py
+# - "input", "output" the corrupted and clean chunks written by flip-bits-final.py
+#
+# Layout:
+# magic (8 bytes) | index offset (8 bytes, little endian) | header, trailer and chunk data ... | index (JSON)
+# index: {"version": 1, "images": {name: {"meta": {...}, "header": [offset, length],
+#         "trailer": [offset, length], "streams": {stream: offset}}}}
+# chunk i of a stream starts at offset + i * meta["size"], so any chunk is one slice of the mmap.
+
+### Use
+# with ContainerWriter(Path("dataset.bgc")) as writer:
+#     writer.add_image("image_0001", header, trailer, {"bin": chunks}, meta)
+# with Container(Path("dataset.bgc")) as container:
+#     chunk = container.chunk("image_0001", 0)
+
+MAGIC = b"BGPTCHNK"
+CONTAINER_EXT = ".bgc"
+VERSION = 1
+
+
+class ContainerWriter:
+    """Append images to a new container, the index is written on close."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + bytes(8))
+        self.images = {}
+
+    def write(self, data: bytes):
+        offset = self.file.tell()
+        self.file.write(data)
+        return offset
+
+    def add_image(self, name: str, header: bytes, trailer: bytes, streams: dict, meta: dict):
+        """
+        Add one image.
+
+        Args:
+            name (str): Image name, e.g. image_0001.
+            header (bytes): Bytes before the SOS marker.
+            trailer (bytes): EOI marker and anything after it.
+            streams (dict): Stream name -> list of chunks, each of meta["size"] bytes.
+            meta (dict): Content of meta.json (bod_len, size, nr_chunks, chunk_len, ...).
+        """
+        if name in self.images:
+            raise ValueError(f"Image {name} is already in {self.path}")
+
+        record = {"meta": meta, "header": [0, len(header)], "trailer": [0, len(trailer)], "streams": {}}
+        record["header"][0] = self.write(header)
+        record["trailer"][0] = self.write(trailer)
+
+        for stream, chunks in streams.items():
+            if len(chunks) != meta["nr_chunks"] or any(len(chunk) != meta["size"] for chunk in chunks):
+                raise ValueError(f"Stream {stream} of {name} must have {meta['nr_chunks']} chunks of {meta['size']} bytes")
+            # all chunks of a stream are written at once
+            record["streams"][stream] = self.write(b"".join(chunks))
+
+        self.images[name] = record
+
+    def close(self):
+        index_offset = self.write(json.dumps({"version": VERSION, "images": self.images}).encode("utf-8"))
+        self.file.seek(len(MAGIC))
+        self.file.write(index_offset.to_bytes(8, "little"))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Container:
+    """Random access to the images of a container through a read-only mmap."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not a chunk container")
+        index_offset = int.from_bytes(self.data[len(MAGIC):len(MAGIC)+8], "little")
+        index = json.loads(self.data[index_offset:].decode("utf-8"))
+        if index["version"] != VERSION:
+            raise ValueError(f"{self.path} has container version {index['version']}, expected {VERSION}")
+        self.images = index["images"]
+
+    def names(self):
+        return list(self.images)
+
+    def meta(self, name: str):
+        return self.images[name]["meta"]
+
+    def streams(self, name: str):
+        return list(self.images[name]["streams"])
+
+    def header(self, name: str):
+        offset, length = self.images[name]["header"]
+        return self.data[offset:offset+length]
+
+    def trailer(self, name: str):
+        offset, length = self.images[name]["trailer"]
+        return self.data[offset:offset+length]
+
+    def chunk(self, name: str, idx: int, stream: str = "bin"):
+        """Return chunk idx of a stream, padding included."""
+        record = self.images[name]
+        size = record["meta"]["size"]
+        if not 0 <= idx < record["meta"]["nr_chunks"]:
+            raise IndexError(f"{name} has no chunk {idx}")
+        offset = record["streams"][stream] + idx * size
+        return self.data[offset:offset+size]
+
+    def chunks(self, name: str, stream: str = "bin"):
+        return [self.chunk(name, idx, stream) for idx in range(self.meta(name)["nr_chunks"])]
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def list_containers(paths):
+    """Return the container files among paths, searching directories recursively."""
+    containers = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            containers += sorted(path.rglob("*" + CONTAINER_EXT))
+        elif path.suffix == CONTAINER_EXT:
+            containers.append(path)
+    return containers
+
+
+# containers opened by read_image, kept open so that reading many images parses each index once per process
+open_containers = {}
+
+
+def open_container(path: Path):
+    """Return an open Container for path, shared within the process."""
+    path = Path(path)
+    if path not in open_containers:
+        open_containers[path] = Container(path)
+    return open_containers[path]
+
+
+def list_images(input_root: Path):
+    """
+    List the images under input_root, either image_XXXX folders or images inside containers.
+    Returns (image name, source) pairs, where source is the folder or the container path.
+    """
+    input_root = Path(input_root)
+    if input_root.suffix == CONTAINER_EXT:
+        containers = [input_root]
+    else:
+        containers = list_containers([input_root])
+    if len(containers) > 0:
+        images = []
+        for path in containers:
+            with Container(path) as container:
+                images += [(name, path) for name in container.names()]
+        return images
+    return [(p.name, p) for p in sorted(input_root.iterdir()) if p.is_dir() and (p / "body").exists()]
+
+
+def read_image(name: str, source: Path, stream: str = "bin"):
+    """Read header, trailer, chunks and meta of an image listed by list_images."""
+    if source.suffix == CONTAINER_EXT:
+        container = open_container(source)
+        return container.header(name), container.trailer(name), container.chunks(name, stream), container.meta(name)
+
+    with open(source / "body" / "meta.json", "r") as f:
+        meta = json.load(f)
+    chunks = [(source / "body" / f"chunk_{i:04d}.bin").read_bytes() for i in range(meta["nr_chunks"])]
+    return (source / "header.bin").read_bytes(), (source / "trailer.bin").read_bytes(), chunks, meta
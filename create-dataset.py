@@ -3,6 +3,8 @@ import os
 import random
 import re
 import sys
+import time
+from multiprocessing import Pool
 
 ### Create the dict structure under /dataset
 # /image0001
@@ -18,11 +20,13 @@ import sys
 
 ### Use 
 # python create-dataset.py --input ./test-chunk --output ./chunked
+# python create-dataset.py --input ./test-chunk --output ./chunked --workers 8
+# python create-dataset.py --input ./test-chunk --output ./chunked --container dataset   (single chunked/dataset.bgc, see container.py)
 
 import json
 from pathlib import Path
-
-CHUNK_SIZE = 4096
+from config import CHUNK_SIZE
+from container import ContainerWriter, CONTAINER_EXT
 
 # Find the indx for SOS and EOI. 
 def find_markers(data: bytes):
@@ -59,14 +63,9 @@ def chunk_and_pad(body: bytes, chunk_size=CHUNK_SIZE):
     num_chunks = math.ceil(body_len / chunk_size)
     last_chunk_len = body_len % chunk_size or chunk_size
 
-    chunks = []
-    for i in range(num_chunks):
-        start = i * chunk_size
-        end = start + chunk_size
-        chunk = body[start:end]
-        if len(chunk) < chunk_size:
-            chunk += b'\x00' * (chunk_size - len(chunk))
-        chunks.append(chunk)
+    # pad the body once, then slice it, instead of padding the last chunk with bytes +=
+    padded = body.ljust(num_chunks * chunk_size, b'\x00')
+    chunks = [padded[i * chunk_size:(i + 1) * chunk_size] for i in range(num_chunks)]
 
     meta = {
         "bod_len": body_len,
@@ -97,17 +96,74 @@ def save_chunks(base_dir: Path, header: bytes, trailer: bytes, chunks, meta):
         json.dump(meta, f, indent=2)
 
 
-def process_dataset(input_dir: Path, output_dir: Path):
-    """Process all JPEGs in a folder into structured chunks."""
+def process_image(task):
+    """
+    Chunk one JPEG into image_XXXX, return its name, size and number of chunks.
+    The image is written as a folder, as image_XXXX.bgc with container="image",
+    or returned with the summary for the dataset container with container="dataset".
+    """
+    idx, file_path, output_dir, container = task
+    header, body, trailer = extract_parts(file_path)
+    chunks, meta = chunk_and_pad(body)
+    image_name = f"image_{idx:04d}"
+    summary = (file_path.name, file_path.stat().st_size, meta["nr_chunks"])
+
+    if container == "dataset":
+        return summary, (image_name, header, trailer, {"bin": chunks}, meta)
+    if container == "image":
+        with ContainerWriter(output_dir / (image_name + CONTAINER_EXT)) as writer:
+            writer.add_image(image_name, header, trailer, {"bin": chunks}, meta)
+    else:
+        save_chunks(output_dir / image_name, header, trailer, chunks, meta)
+    return summary, None
+
+
+def process_dataset(input_dir: Path, output_dir: Path, workers=1, batch_size=16, container=None):
+    """
+    Process all JPEGs in a folder into structured chunks.
+    The image_XXXX numbers follow the sorted file names, so they do not depend on the number of workers.
+    With workers > 1 the images are chunked and written by a process pool, which receives them
+    in batches of batch_size. The pool works through windows of workers * batch_size images and
+    the next window is only sent once the results of the previous one are consumed, so memory
+    stays bounded even when the chunks come back to be written here (container="dataset").
+    container="image" writes one image_XXXX.bgc per image and container="dataset" a single
+    dataset.bgc, instead of a folder with one file per chunk.
+    """
     output_dir.mkdir(parents=True, exist_ok=True)
     jpeg_files = sorted(list(input_dir.glob("*.jpg")) + list(input_dir.glob("*.jpeg")))
-
-    for idx, file_path in enumerate(jpeg_files, 1):
-        print(f"[{idx}/{len(jpeg_files)}] Processing {file_path.name}")
-        header, body, trailer = extract_parts(file_path)
-        chunks, meta = chunk_and_pad(body)
-        image_dir = output_dir / f"image_{idx:04d}"
-        save_chunks(image_dir, header, trailer, chunks, meta)
+    tasks = [(idx, file_path, output_dir, container) for idx, file_path in enumerate(jpeg_files, 1)]
+    writer = ContainerWriter(output_dir / ("dataset" + CONTAINER_EXT)) if container == "dataset" else None
+
+    start_time = time.time()
+    total_bytes = 0
+    num_done = 0
+
+    def consume(results):
+        nonlocal total_bytes, num_done
+        for (name, file_size, nr_chunks), image in results:
+            total_bytes += file_size
+            num_done += 1
+            if writer is not None:
+                writer.add_image(*image)
+            print(f"[{num_done}/{len(jpeg_files)}] Processed {name} ({nr_chunks} chunks)")
+
+    try:
+        if workers > 1:
+            window = workers * batch_size
+            with Pool(workers) as pool:
+                for start in range(0, len(tasks), window):
+                    consume(pool.imap(process_image, tasks[start:start+window], chunksize=batch_size))
+                pool.close()
+                pool.join()
+        else:
+            consume(map(process_image, tasks))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    elapsed = time.time() - start_time
+    print(f"Processed {len(jpeg_files)} images in {elapsed:.2f}s "
+          f"({len(jpeg_files) / max(elapsed, 1e-9):.1f} images/sec, {total_bytes / 2**20 / max(elapsed, 1e-9):.1f} MB/sec)")
 
 
 if __name__ == "__main__":
@@ -116,6 +172,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Prepare JPEG dataset into header/body chunks.")
     parser.add_argument("--input", type=Path, required=True, help="Folder with original JPEGs")
     parser.add_argument("--output", type=Path, required=True, help="Output dataset folder")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--batch_size", type=int, default=16, help="Images sent to a worker at once")
+    parser.add_argument("--container", choices=["image", "dataset"], help="Write containers (one per image or one per dataset) instead of chunk files")
 
     args = parser.parse_args()
-    process_dataset(args.input, args.output)
+    process_dataset(args.input, args.output, args.workers, args.batch_size, args.container)
@@ -0,0 +1,33 @@
+import os
+import time
+import torch
+from utils import export_inference_weights
+
+### Export the model weights of a training checkpoint for inference
+# The training checkpoint also carries the optimizer and scheduler states, the export keeps the
+# model weights only (without the lm_head tied to the byte embeddings), so inference.py loads it faster.
+# .safetensors needs the safetensors package, any other extension is saved with torch.save (mmap-loadable).
+
+### Use
+# python export-weights.py --checkpoint weights-train5.pth --output weights-train5.safetensors
+# then set INFERENCE_WEIGHTS_PATH = "weights-train5.safetensors" in config.py
+
+
+def export_weights(checkpoint_path, output_path):
+    start_time = time.time()
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    export_inference_weights(checkpoint['model'], output_path)
+
+    print(f"Exported {checkpoint_path} ({os.path.getsize(checkpoint_path)/2**20:.1f} MB) "
+          f"to {output_path} ({os.path.getsize(output_path)/2**20:.1f} MB) in {time.time()-start_time:.2f}s")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the model weights of a training checkpoint for inference.")
+    parser.add_argument("--checkpoint", required=True, help="Training checkpoint saved by train-gen.py")
+    parser.add_argument("--output", required=True, help="Output weights (.safetensors or .pt)")
+
+    args = parser.parse_args()
+    export_weights(args.checkpoint, args.output)
@@ -4,11 +4,16 @@
 ## Use on train-test + training-images
 
 import os
+import zlib
 import shutil
 import subprocess
 import random
 import json
+import importlib.util
+import numpy as np
 from pathlib import Path
+from multiprocessing import Pool
+from container import ContainerWriter, list_images, read_image
 
 BITFLIP_CMD = "bitflip"
 
@@ -17,13 +22,14 @@ CORRUPTION_LEVELS = [0.05, 0.1, 0.2, 0.3, 0.5]
 LEVEL_WEIGHTS = [10, 20, 30, 25, 15]  # probability distribution
 CLEAN_RATIO = 0.1  # 10% of chunks remain clean → clean->clean examples
 
-def choose_corruption_level():
+def choose_corruption_level(rng=random):
     """Randomly pick a corruption severity."""
-    return random.choices(CORRUPTION_LEVELS, weights=LEVEL_WEIGHTS, k=1)[0]
+    return rng.choices(CORRUPTION_LEVELS, weights=LEVEL_WEIGHTS, k=1)[0]
 
 def corrupt_file(src: Path, dst: Path, percent: float):
     """Run bitflip spray on a file and save output to dst."""
-    shutil.copy(src, dst)
+    if src != dst:
+        shutil.copy(src, dst)
     cmd = [BITFLIP_CMD, "spray", f"percent:{percent}", str(dst)]
     result = subprocess.run(cmd, capture_output=True, text=True)
     if result.returncode != 0:
@@ -31,48 +37,125 @@ def corrupt_file(src: Path, dst: Path, percent: float):
         print("stderr:", result.stderr.strip())
         raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
 
-def build_bgpt_dataset(input_root: Path, output_root: Path, log_path: Path):
+def flip_bits(data: bytes, percent: float, rng: np.random.Generator):
+    """Flip percent % of the bits of data at distinct random positions, like bitflip spray."""
+    array = np.frombuffer(data, dtype=np.uint8).copy()
+    num_flips = round(len(array) * 8 * percent / 100)
+    positions = rng.choice(len(array) * 8, size=num_flips, replace=False)
+    np.bitwise_xor.at(array, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
+    return array.tobytes()
+
+def chunk_rng(base: str, seed: int):
+    """Random generators seeded by the chunk name, so results do not depend on the worker."""
+    chunk_seed = [seed, zlib.crc32(base.encode())]
+    return random.Random(str(chunk_seed)), np.random.default_rng(chunk_seed)
+
+def process_image(name: str, source: Path, output_root: Path, seed: int, use_bitflip: bool, keep_bytes: bool):
+    """
+    Corrupt all chunks of one image, read from its folder or container.
+    Writes the .input/.output pairs when output_root is given, and returns
+    (base, level, clean, corrupted) per chunk, with the bytes only if keep_bytes,
+    plus the header, trailer and meta of the image if keep_bytes.
+    """
+    header, trailer, chunks, meta = read_image(name, source)
+    results = []
+    for idx, clean in enumerate(chunks):
+        base = f"{name}_chunk_{idx:04d}"
+        rng, np_rng = chunk_rng(base, seed)
+
+        # Decide if this chunk should be corrupted or kept clean
+        if rng.random() < CLEAN_RATIO:
+            # clean->clean pair
+            level = 0.0
+            corrupted = clean
+        else:
+            level = choose_corruption_level(rng)
+            if use_bitflip:
+                out_input = output_root / f"{base}.input"
+                out_input.write_bytes(clean)
+                corrupt_file(out_input, out_input, percent=level)
+                corrupted = out_input.read_bytes()
+            else:
+                corrupted = flip_bits(clean, level, np_rng)
+
+        if output_root is not None:
+            (output_root / f"{base}.output").write_bytes(clean)
+            (output_root / f"{base}.input").write_bytes(corrupted)
+
+        if keep_bytes:
+            results.append((base, level, clean, corrupted))
+        else:
+            results.append((base, level, None, None))
+
+    if keep_bytes:
+        return results, (header, trailer, meta)
+    return results, None
+
+def process_image_star(args):
+    return process_image(*args)
+
+def load_shard_writer(shard_dir: Path):
+    """Load ShardWriter from pack-dataset.py, writing 'input->output' pairs."""
+    spec = importlib.util.spec_from_file_location("pack_dataset", Path(__file__).parent / "pack-dataset.py")
+    pack_dataset = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pack_dataset)
+    return pack_dataset, pack_dataset.ShardWriter(shard_dir, conversion_mode="input->output")
+
+def build_bgpt_dataset(input_root: Path, output_root: Path, log_path: Path,
+                       shard_dir: Path = None, workers: int = None, seed: int = 0, use_bitflip: bool = False,
+                       container_path: Path = None):
     """
     Build a dataset compatible with bGPT:
     - .input = corrupted bytes
     - .output = clean bytes
+    input_root holds image_XXXX folders or containers written by create-dataset.py.
+    Chunks are corrupted in-process (or by the bitflip tool with use_bitflip) across a process pool.
+    With shard_dir, the pairs are streamed into training shards for train-gen.py, and with
+    container_path into a container with "input" and "output" streams (see container.py).
+    output_root may then be None to skip the .input/.output files.
     """
-    output_root.mkdir(parents=True, exist_ok=True)
-    all_chunks = []
+    if output_root is not None:
+        output_root.mkdir(parents=True, exist_ok=True)
+    if use_bitflip and output_root is None:
+        raise ValueError("The bitflip tool works on files, please also give an output folder.")
     log = {}
 
-    image_dirs = sorted([p for p in input_root.iterdir() if p.is_dir()])
-    print(f"Found {len(image_dirs)} image folders to process...\n")
+    images = list_images(input_root)
+    print(f"Found {len(images)} images to process...\n")
 
-    for idx, image_dir in enumerate(image_dirs, 1):
-        body_dir = image_dir / "body"
-        if not body_dir.exists():
-            print(f"Skipping {image_dir.name}, no 'body' directory found.")
-            continue
+    if shard_dir is not None:
+        pack_dataset, writer = load_shard_writer(shard_dir)
+    if container_path is not None:
+        container_writer = ContainerWriter(container_path)
 
-        for chunk_file in sorted(body_dir.glob("chunk_*.bin")):
-            base = f"{image_dir.name}_{chunk_file.stem}"
-            out_input = output_root / f"{base}.input"
-            out_output = output_root / f"{base}.output"
-
-            # Always copy clean version for output
-            shutil.copy(chunk_file, out_output)
-
-            # Decide if this chunk should be corrupted or kept clean
-            if random.random() < CLEAN_RATIO:
-                # clean->clean pair
-                shutil.copy(chunk_file, out_input)
-                log[base] = 0.0
-            else:
-                level = choose_corruption_level()
-                corrupt_file(chunk_file, out_input, percent=level)
+    keep_bytes = shard_dir is not None or container_path is not None
+    tasks = [(name, source, output_root, seed, use_bitflip, keep_bytes) for name, source in images]
+    with Pool(workers) as pool:
+        for idx, ((name, _), (results, image)) in enumerate(zip(images, pool.imap(process_image_star, tasks)), 1):
+            for base, level, clean, corrupted in results:
                 log[base] = level
-
-        print(f"[{idx}/{len(image_dirs)}] Processed {image_dir.name}")
+                if shard_dir is not None:
+                    writer.add([pack_dataset.encode_bytes(corrupted, "input"),
+                                pack_dataset.encode_bytes(clean, "output")])
+            if container_path is not None:
+                header, trailer, meta = image
+                meta = dict(meta, levels=[level for _, level, _, _ in results])
+                container_writer.add_image(name, header, trailer,
+                                           {"input": [corrupted for _, _, _, corrupted in results],
+                                            "output": [clean for _, _, clean, _ in results]},
+                                           meta)
+            print(f"[{idx}/{len(images)}] Processed {name}")
+
+    if shard_dir is not None:
+        writer.close()
+        print(f"   Shards saved to {shard_dir}")
+    if container_path is not None:
+        container_writer.close()
+        print(f"   Container saved to {container_path}")
 
     with open(log_path, "w") as f:
         json.dump(log, f, indent=2)
-    print(f"\n✅ Dataset ready at {output_root}")
+    print(f"\n✅ Dataset ready at {output_root if output_root is not None else shard_dir or container_path}")
     print(f"   Log saved to {log_path}")
 
 if __name__ == "__main__":
@@ -80,8 +163,15 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Create bGPT-compatible corruption dataset (.input/.output).")
     parser.add_argument("--input", type=Path, required=True, help="Path to clean dataset.")
-    parser.add_argument("--output", type=Path, required=True, help="Path to save bGPT dataset.")
+    parser.add_argument("--output", type=Path, help="Path to save bGPT dataset.")
     parser.add_argument("--log", type=Path, default="corruption_log.json", help="Path to save corruption mapping.")
+    parser.add_argument("--shards", type=Path, help="Also stream the pairs into training shards at this path.")
+    parser.add_argument("--container", type=Path, help="Also write the pairs into a single container file (.bgc).")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed, combined with each chunk name.")
+    parser.add_argument("--bitflip", action="store_true", help="Corrupt with the external bitflip tool instead.")
     args = parser.parse_args()
 
-    build_bgpt_dataset(args.input, args.output, args.log)
\ No newline at end of file
+    if args.output is None and args.shards is None and args.container is None:
+        parser.error("please give --output, --shards or --container")
+    build_bgpt_dataset(args.input, args.output, args.log, args.shards, args.workers, args.seed, args.bitflip, args.container)
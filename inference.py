@@ -1,9 +1,12 @@
 import os
+import math
 import time
 import torch
 from utils import *
 from config import *
-from transformers import  GPT2Config
+from triage import triage_chunks
+
+startup_time = time.time()
 
 if torch.cuda.is_available():    
     device = torch.device("cuda")
@@ -12,86 +15,142 @@ else:
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-patch_config = GPT2Config(num_hidden_layers=PATCH_NUM_LAYERS, 
-                    max_length=PATCH_LENGTH, 
-                    max_position_embeddings=PATCH_LENGTH,
-                    hidden_size=HIDDEN_SIZE,
-                    n_head=HIDDEN_SIZE//64,
-                    vocab_size=1)
-byte_config = GPT2Config(num_hidden_layers=BYTE_NUM_LAYERS, 
-                    max_length=PATCH_SIZE+1, 
-                    max_position_embeddings=PATCH_SIZE+1,
-                    hidden_size=HIDDEN_SIZE,
-                    n_head=HIDDEN_SIZE//64,
-                    vocab_size=256+1)
-model = bGPTLMHeadModel(patch_config, byte_config)
+# the CLI, repair-jpeg.py and repair-server.py load the model the same way
+model = load_inference_model(device, correction=INFERENCE_MODE == "correct")
 print("Parameter Number: "+str(sum(p.numel() for p in model.parameters() if p.requires_grad)))
+print("Model ready %.2fs after start" % (time.time() - startup_time))
 
-checkpoint = torch.load(INFERENCE_WEIGHTS_PATH, map_location=torch.device(device))
-model.load_state_dict(checkpoint['model'])
-model = model.to(device)
-model.eval()
-
-def read_bytes(filename):
-    
-    ext = filename.split('.')[-1]
-    ext = bytearray(ext, 'utf-8')
-    ext = [byte for byte in ext][:PATCH_SIZE]
-
-    with open(filename, 'rb') as f:
-        file_bytes = f.read()
+generator = torch.Generator(device=device)
+if INFERENCE_SEED is not None:
+    generator.manual_seed(INFERENCE_SEED)
+else:
+    generator.seed()
 
-    bytes = []
-    for byte in file_bytes:
-        bytes.append(byte)
+bos_patch = [byte for byte in bytearray(TARGET_EXT, 'utf-8')]
+bos_patch = bos_patch + [256] * (PATCH_SIZE - len(bos_patch))
 
-    if len(bytes)%PATCH_SIZE!=0:
-        bytes = bytes + [256] * (PATCH_SIZE - len(bytes) % PATCH_SIZE)
+if INFERENCE_MODE == "correct":
+    files = os.listdir(INPUT_FOLDER)
+    files = [i for i in files if i.split('.')[-1] == INPUT_EXT]
+    start_time = time.time()
 
-    bos_patch = ext + [256] * (PATCH_SIZE - len(ext))
-    bytes = bos_patch + bytes + [256] * PATCH_SIZE
-    bytes = bytes[:PATCH_LENGTH*PATCH_SIZE]
+    # every batch of files is repaired in a single forward pass of the correction head
+    for batch_idx in range(0, len(files), INFERENCE_BATCH_SIZE):
+        batch_files = files[batch_idx:batch_idx+INFERENCE_BATCH_SIZE]
+        byte_lists = []
+        for i in batch_files:
+            # laid out like convert mode, with an eos patch instead of the TARGET_EXT bos patch
+            with open(INPUT_FOLDER+"/"+i, 'rb') as f:
+                byte_lists.append(encode_chunk(f.read())[:-PATCH_SIZE] + [256] * PATCH_SIZE)
+        input_patches = torch.nn.utils.rnn.pad_sequence([torch.tensor(byte_list, dtype=torch.long) for byte_list in byte_lists],
+                                                        batch_first=True,
+                                                        padding_value=256)
+        input_masks = torch.nn.utils.rnn.pad_sequence([torch.ones(len(byte_list)//PATCH_SIZE, dtype=torch.long) for byte_list in byte_lists],
+                                                      batch_first=True,
+                                                      padding_value=0)
+        with torch.no_grad(), precision_context(device):
+            corrected = model.correct(input_patches, input_masks).cpu()
 
-    return bytes
+        for i, byte_list in zip(batch_files, corrected):
+            filename = OUTPUT_FOLDER+"/"+i+'.'+TARGET_EXT
+            file_size = os.path.getsize(INPUT_FOLDER+"/"+i)
+            with open(filename, 'wb') as file:
+                file.write(bytes(byte_list[PATCH_SIZE:PATCH_SIZE+file_size].tolist()))
+            print("Corrected to "+filename)
+        if batch_idx == 0:
+            print("First batch corrected %.2fs after start" % (time.time() - startup_time))
 
-bos_patch = [byte for byte in bytearray(TARGET_EXT, 'utf-8')]
-bos_patch = bos_patch + [256] * (PATCH_SIZE - len(bos_patch))
+    elapsed = time.time() - start_time
+    print("Corrected %d files in %.2fs (%.2f chunks/sec)" % (len(files), elapsed, len(files) / max(elapsed, 1e-9)))
 
-if INFERENCE_MODE == "convert":
+elif INFERENCE_MODE == "convert":
     files = os.listdir(INPUT_FOLDER)
     files = [i for i in files if i.split('.')[-1] == INPUT_EXT]
+    start_time = time.time()
+    num_files = len(files)
+    check_chunk_geometry()
+
+    # pre-pass: the chunks the triage finds clean are copied instead of converted
+    if TRIAGE_MODE is not None:
+        suspect_files = []
+        for triage_idx in range(0, len(files), INFERENCE_BATCH_SIZE):
+            triage_files = files[triage_idx:triage_idx+INFERENCE_BATCH_SIZE]
+            chunks = []
+            for i in triage_files:
+                with open(INPUT_FOLDER+"/"+i, 'rb') as f:
+                    chunks.append(f.read())
+            for i, chunk, suspect in zip(triage_files, chunks, triage_chunks(chunks, TRIAGE_MODE, model, TRIAGE_THRESHOLD)):
+                if suspect:
+                    suspect_files.append(i)
+                else:
+                    with open(OUTPUT_FOLDER+"/"+i+'.'+TARGET_EXT, 'wb') as file:
+                        file.write(chunk)
+        triage_time = time.time() - start_time
+        print("Triage (%s) found %d of %d files clean (%.1f%%) in %.2fs, copied them unchanged" % (TRIAGE_MODE, num_files - len(suspect_files), num_files, 100 * (num_files - len(suspect_files)) / max(num_files, 1), triage_time))
+        files = suspect_files
+
+    # convert INFERENCE_BATCH_SIZE files at once with convert_chunks, each one stops on its own
+    num_patches = 0
+    regenerated = []
+    for batch_idx in range(0, len(files), INFERENCE_BATCH_SIZE):
+        batch_files = files[batch_idx:batch_idx+INFERENCE_BATCH_SIZE]
+        chunks = []
+        for i in batch_files:
+            with open(INPUT_FOLDER+"/"+i, 'rb') as f:
+                chunks.append(f.read())
+        outputs = convert_chunks(model, chunks, generator, regenerated=regenerated)
+        num_patches += sum(math.ceil(len(output) / PATCH_SIZE) for output in outputs)
+
+        for i, output in zip(batch_files, outputs):
+            filename = OUTPUT_FOLDER+"/"+i+'.'+TARGET_EXT
+            with open(filename, 'wb') as file:
+                file.write(output)
+            print("Converted to "+filename)
+        if batch_idx == 0:
+            print("First batch converted %.2fs after start" % (time.time() - startup_time))
+
+    elapsed = time.time() - start_time
+    print("Converted %d files in %.2fs (%.2f chunks/sec)" % (len(files), elapsed, len(files) / max(elapsed, 1e-9)))
+    if LOCALIZED_REPAIR:
+        print("Localized repair regenerated %d of %d patches (%.1f%%), the others were copied" % (sum(regenerated), num_patches, 100 * sum(regenerated) / max(num_patches, 1)))
+    if TRIAGE_MODE is not None and len(files) > 0:
+        # the skipped files would have taken about as long as the converted ones
+        conversion_time = (elapsed - triage_time) / len(files)
+        print("Triage saved about %.2fs (%.2fs per converted file)" % ((num_files - len(files)) * conversion_time - triage_time, conversion_time))
+
 else:
     files = list(range(NUM_SAMPLES))
 
-for i in files:
-    if INFERENCE_MODE == "convert":
-        filename = OUTPUT_FOLDER+"/"+i+'.'+TARGET_EXT
-        byte_list = read_bytes(INPUT_FOLDER+"/"+i)[:-PATCH_SIZE]+bos_patch
-    else:
+    for i in files:
         filename = OUTPUT_FOLDER+"/"+time.strftime("%Y%m%d-%H%M%S")+"-"+str(i+1)+"."+TARGET_EXT
         byte_list = bos_patch.copy()
-    prefix_len = len(byte_list)
-    input_patches = torch.tensor([byte_list], device=device)
-    while input_patches.shape[1]<PATCH_LENGTH*PATCH_SIZE:
-        predicted_patch = model.generate(input_patches.unsqueeze(0),
-                                         top_k=TOP_K,
-                                         top_p=TOP_P,
-                                         temperature=TEMPERATURE)
-        for byte in predicted_patch:
+        prefix_len = len(byte_list)
+        input_patches = torch.tensor([byte_list], device=device)
+        # only the newest patch is fed to the model, the rest is kept in past_key_values
+        new_patches = input_patches
+        past_key_values = None
+        while input_patches.shape[1]<PATCH_LENGTH*PATCH_SIZE:
+            with torch.no_grad(), precision_context(device):
+                predicted_patch, past_key_values = model.generate(new_patches.unsqueeze(0),
+                                                                  top_k=TOP_K,
+                                                                  top_p=TOP_P,
+                                                                  temperature=TEMPERATURE,
+                                                                  past_key_values=past_key_values,
+                                                                  use_cache=True,
+                                                                  generator=generator,
+                                                                  decoding=DECODING_MODE)
+            for byte in predicted_patch:
+                if byte == 256:
+                    break
+                byte_list.append(byte)
             if byte == 256:
                 break
-            byte_list.append(byte)
-        if byte == 256:
-            break
-        predicted_patch = torch.tensor([predicted_patch], device=device)
-        input_patches = torch.cat([input_patches, predicted_patch], dim=1)
-
-    byte_list = byte_list[prefix_len:]
-    # set output file name as the current time
-    with open(filename, 'wb') as file:
-        for byte in byte_list:
-            file.write(bytes([byte]))
-        if INFERENCE_MODE == "convert":
-            print("Converted to "+filename)
-        else:
+            new_patches = torch.tensor([predicted_patch], device=device)
+            input_patches = torch.cat([input_patches, new_patches], dim=1)
+
+        byte_list = byte_list[prefix_len:]
+        # set output file name as the current time
+        with open(filename, 'wb') as file:
+            for byte in byte_list:
+                file.write(bytes([byte]))
             print("Generated "+filename)
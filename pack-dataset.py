@@ -0,0 +1,146 @@
+import os
+import json
+import numpy as np
+from config import *
+from tqdm import tqdm
+from pathlib import Path
+
+### Pack training files into a few large memory-mapped shards for train-gen.py
+# /shards
+# - shard_0000.bin   (uint16 tokens 0-256, laid out like read_bytes in train-gen.py)
+# - shard_0001.bin
+# - index.npy        (one row per sample: shard, input offset, input length, target offset, target length)
+# - meta.json
+
+# Pairs are built with CONVERSION_MODE from config.py, exactly like ByteDataset.
+
+### Use
+# python pack-dataset.py --input ./dataset --output ./shards
+
+SHARD_TOKENS = 1 << 29  # Maximum number of tokens per shard (1 GiB)
+
+
+def list_files_in_directory(directories):
+    file_list = []
+
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            for file in files:
+                file_path = os.path.join(root, file)
+                file_list.append(file_path)
+    return file_list
+
+
+def pair_files(filenames):
+    """Group the files into samples following CONVERSION_MODE, in the same order as ByteDataset."""
+    if CONVERSION_MODE == None:
+        return [(filename,) for filename in filenames]
+    elif "->" in CONVERSION_MODE:
+        input_ext, target_ext = CONVERSION_MODE.split("->")
+    elif "&" in CONVERSION_MODE:
+        input_ext, target_ext = CONVERSION_MODE.split("&")
+    else:
+        raise ValueError("Invalid Conversion Mode, please check the config.py file. You can use None, 'input->output', or 'input&output'.")
+
+    samples = []
+    for filename in filenames:
+        if filename.split('.')[-1]==input_ext:
+            target_filename = filename[:-(len(input_ext))] + target_ext
+            if os.path.exists(target_filename):
+                samples.append((filename, target_filename))
+        elif "&" in CONVERSION_MODE and filename.split('.')[-1]==target_ext:
+            input_filename = filename[:-(len(target_ext))] + input_ext
+            if os.path.exists(input_filename):
+                samples.append((input_filename, filename))
+    return samples
+
+
+def encode_bytes(file_bytes: bytes, ext: str):
+    """Tokenize bytes like read_bytes: bos patch with the extension, bytes padded with 256, eos patch."""
+    ext = bytearray(ext, 'utf-8')[:PATCH_SIZE]
+    file_bytes = np.frombuffer(file_bytes, dtype=np.uint8)
+
+    bos_patch = np.full(PATCH_SIZE, 256, dtype=np.uint16)
+    bos_patch[:len(ext)] = np.frombuffer(bytes(ext), dtype=np.uint8)
+    padding = np.full((-len(file_bytes)) % PATCH_SIZE + PATCH_SIZE, 256, dtype=np.uint16)
+
+    return np.concatenate((bos_patch, file_bytes.astype(np.uint16), padding))
+
+
+def encode_file(filename):
+    """Tokenize a file like read_bytes in train-gen.py."""
+    with open(filename, 'rb') as f:
+        return encode_bytes(f.read(), filename.split('.')[-1])
+
+
+class ShardWriter:
+    """Append tokenized samples to shards, then write the index and meta.json on close."""
+
+    def __init__(self, output_dir: Path, shard_tokens=SHARD_TOKENS, conversion_mode=CONVERSION_MODE):
+        output_dir.mkdir(parents=True, exist_ok=True)
+        self.output_dir = output_dir
+        self.shard_tokens = shard_tokens
+        self.conversion_mode = conversion_mode
+        self.index = []
+        self.shards = []
+        self.shard_file = None
+        self.shard_len = 0
+
+    def add(self, arrays):
+        """Add one sample: a single token array, or the input and target arrays of a pair."""
+        sample_len = sum(len(array) for array in arrays)
+
+        # start a new shard when this one is full
+        if self.shard_file is None or (self.shard_len > 0 and self.shard_len + sample_len > self.shard_tokens):
+            if self.shard_file is not None:
+                self.shard_file.close()
+            self.shards.append(f"shard_{len(self.shards):04d}.bin")
+            self.shard_file = open(self.output_dir / self.shards[-1], "wb")
+            self.shard_len = 0
+
+        row = [len(self.shards) - 1]
+        for array in arrays:
+            self.shard_file.write(array.tobytes())
+            row += [self.shard_len, len(array)]
+            self.shard_len += len(array)
+        if len(arrays) == 1:
+            row += [0, 0]
+        self.index.append(row)
+
+    def close(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+
+        np.save(self.output_dir / "index.npy", np.array(self.index, dtype=np.int64).reshape(-1, 5))
+        meta = {
+            "patch_size": PATCH_SIZE,
+            "conversion_mode": self.conversion_mode,
+            "nr_samples": len(self.index),
+            "shards": self.shards
+        }
+        with open(self.output_dir / "meta.json", "w") as f:
+            json.dump(meta, f, indent=2)
+
+
+def pack_dataset(input_dirs, output_dir: Path, shard_tokens=SHARD_TOKENS):
+    """Write all samples under input_dirs into shards plus an offsets index."""
+    samples = pair_files(list_files_in_directory(input_dirs))
+    print(f"Packing {len(samples)} samples into {output_dir}")
+
+    writer = ShardWriter(output_dir, shard_tokens)
+    for sample in tqdm(samples):
+        writer.add([encode_file(filename) for filename in sample])
+    writer.close()
+    print(f"✅ Packed {len(writer.index)} samples into {len(writer.shards)} shards")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pack training files into memory-mapped shards.")
+    parser.add_argument("--input", type=Path, nargs="+", required=True, help="Folders with training files")
+    parser.add_argument("--output", type=Path, required=True, help="Output shard folder")
+    parser.add_argument("--shard_tokens", type=int, default=SHARD_TOKENS, help="Maximum number of tokens per shard")
+
+    args = parser.parse_args()
+    pack_dataset(args.input, args.output, args.shard_tokens)
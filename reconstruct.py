@@ -3,6 +3,31 @@
 import os
 import json
 from pathlib import Path
+from container import Container
+
+def assemble_jpeg(header: bytes, chunks, meta: dict):
+    """
+    Reassemble JPEG bytes in memory from the header and the (repaired) body chunks.
+
+    Args:
+        header (bytes): Bytes before the SOS marker.
+        chunks (list): Body chunks, the last one zero padded.
+        meta (dict): Content of meta.json (size, chunk_len, nr_chunks).
+    """
+    chunk_size = meta["size"]
+    last_chunk_len = meta["chunk_len"]
+    num_chunks = meta["nr_chunks"]
+    if len(chunks) != num_chunks:
+        raise ValueError(f"Expected {num_chunks} chunks, got {len(chunks)}")
+
+    # --- Concatenate body chunks ---
+    body_bytes = b"".join(chunks)
+
+    # --- Remove zero padding on last chunk ---
+    total_expected_len = (num_chunks - 1) * chunk_size + last_chunk_len
+    body_bytes = body_bytes[:total_expected_len]
+
+    return header + b'\xFF\xDA' + body_bytes + b'\xFF\xD9'
 
 def reconstruct_image(image_dir: Path, output_path: Path, repaired_dir: Path = None):
     """
@@ -11,7 +36,7 @@ def reconstruct_image(image_dir: Path, output_path: Path, repaired_dir: Path = N
     Args:
         image_dir (Path): Folder containing header.bin, trailer.bin, and body/.
         output_path (Path): Path to write the reconstructed JPEG.
-        repaired_dir (Path, optional): 
+        repaired_dir (Path, optional):
             Directory with repaired chunk files. If None, uses the original body.
     """
     header_path = image_dir / "header.bin"
@@ -26,26 +51,32 @@ def reconstruct_image(image_dir: Path, output_path: Path, repaired_dir: Path = N
     meta_path = chunks_dir / "meta.json"
     with open(meta_path, "r") as f:
         meta = json.load(f)
-    chunk_size = meta["size"]
-    last_chunk_len = meta["chunk_len"]
-    num_chunks = meta["nr_chunks"]
 
-    # --- Concatenate body chunks ---
-    body_bytes = bytearray()
-    for i in range(num_chunks):
+    # --- Load body chunks ---
+    chunks = []
+    for i in range(meta["nr_chunks"]):
         chunk_file = chunks_dir / f"chunk_{i:04d}.bin"
         if not chunk_file.exists():
             raise FileNotFoundError(f"Missing chunk: {chunk_file}")
-        chunk = chunk_file.read_bytes()
-        body_bytes.extend(chunk)
-
-    # --- Remove zero padding on last chunk ---
-    total_expected_len = (num_chunks - 1) * chunk_size + last_chunk_len
-    body_bytes = body_bytes[:total_expected_len]
+        chunks.append(chunk_file.read_bytes())
 
     # --- Combine and write final JPEG ---
-    full_jpeg = header + b'\xFF\xDA' + body_bytes + b'\xFF\xD9'
-    output_path.write_bytes(full_jpeg)
+    output_path.write_bytes(assemble_jpeg(header, chunks, meta))
+    print(f"✅ Reconstructed image saved to: {output_path}")
+
+def reconstruct_from_container(container_path: Path, name: str, output_path: Path, stream: str = "bin"):
+    """
+    Reassemble a JPEG file from an image stored in a container (see container.py).
+
+    Args:
+        container_path (Path): The .bgc file.
+        name (str): Image name inside the container, e.g. image_0001.
+        output_path (Path): Path to write the reconstructed JPEG.
+        stream (str): Chunk stream to use, "bin" for the body or "input"/"output" for corruption pairs.
+    """
+    with Container(container_path) as container:
+        jpeg = assemble_jpeg(container.header(name), container.chunks(name, stream), container.meta(name))
+    output_path.write_bytes(jpeg)
     print(f"✅ Reconstructed image saved to: {output_path}")
 
 
@@ -53,9 +84,19 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Reassemble a JPEG from header, chunks, and trailer.")
-    parser.add_argument("--image_dir", type=Path, required=True, help="Path to the image_XXXX directory.")
+    parser.add_argument("--image_dir", type=Path, help="Path to the image_XXXX directory.")
     parser.add_argument("--output", type=Path, required=True, help="Output JPEG path.")
     parser.add_argument("--repaired_dir", type=Path, help="Path to repaired chunks (optional).")
+    parser.add_argument("--container", type=Path, help="Container (.bgc) holding the image, instead of --image_dir.")
+    parser.add_argument("--name", help="Image name inside the container (e.g. image_0001).")
+    parser.add_argument("--stream", default="bin", help="Chunk stream of the container to use (bin, input or output).")
     args = parser.parse_args()
 
-    reconstruct_image(args.image_dir, args.output, args.repaired_dir)
+    if args.container is not None:
+        if args.name is None:
+            parser.error("--container needs --name")
+        reconstruct_from_container(args.container, args.name, args.output, args.stream)
+    elif args.image_dir is not None:
+        reconstruct_image(args.image_dir, args.output, args.repaired_dir)
+    else:
+        parser.error("please give --image_dir or --container")
@@ -0,0 +1,191 @@
+import time
+import torch
+import importlib.util
+from utils import *
+from config import *
+from pathlib import Path
+from collections import deque
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from triage import triage_chunks
+from reconstruct import assemble_jpeg
+
+### Repair corrupted JPEGs end to end, without intermediate folders
+# Each JPEG is split at SOS/EOI like create-dataset.py, its body chunks are streamed through the
+# model in batches (chunks of several JPEGs share a batch) like inference.py convert mode, and the
+# repaired chunks are reassembled in memory like reconstruct.py.
+# Reading and writing run in background threads, overlapping with the model.
+# With TRIAGE_MODE in config.py, only the chunks flagged by triage.py are repaired, the others are kept.
+
+### Use
+# python repair-jpeg.py --input damaged.jpg --output repaired.jpg
+# python repair-jpeg.py --input ./damaged --output ./repaired --workers 2
+
+PREFETCH = 4  # Number of JPEGs read and chunked ahead of the model, per worker
+
+
+def load_script(filename):
+    """Import one of the hyphenated scripts (e.g. create-dataset.py) as a module."""
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace("-", "_"), Path(__file__).parent / filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+create_dataset = load_script("create-dataset.py")
+
+
+def read_jpeg(input_path: Path):
+    """Split a JPEG at SOS/EOI and chunk its body, like create-dataset.py."""
+    header, body, trailer = create_dataset.extract_parts(input_path)
+    chunks, meta = create_dataset.chunk_and_pad(body)
+    return header, chunks, meta
+
+
+def fit_chunk(output: bytes, chunk: bytes):
+    """Trim or pad a repaired chunk to the length of its input chunk, so the following chunks keep their offsets."""
+    # a chunk that stopped early keeps the rest of its input bytes
+    return output[:len(chunk)] + chunk[len(output):]
+
+
+def write_jpeg(output_path: Path, header: bytes, chunks, meta: dict):
+    """Reassemble the repaired chunks like reconstruct.py and write the JPEG."""
+    output_path.write_bytes(assemble_jpeg(header, chunks, meta))
+
+
+def repair_files(model, jobs, batch_size, generator, io_threads=2):
+    """
+    Repair a list of (input path, output path) JPEGs.
+    The chunks of all JPEGs are queued in order and repaired batch_size at a time, while the
+    next JPEGs are read and the finished ones written in background threads.
+    :return: number of JPEGs repaired, number of chunks repaired, number of chunks the triage skipped,
+             seconds spent repairing chunks, seconds spent in the triage
+    """
+    num_images = 0
+    num_chunks = 0
+    num_skipped = 0
+    repair_time = 0.0
+    triage_time = 0.0
+    with ThreadPoolExecutor(io_threads) as io:
+        reads = deque()
+        writes = []
+        images = deque()        # images with chunks still to repair: [input, output, header, meta, repaired, pending]
+        chunk_queue = deque()   # (image, chunk index, chunk bytes)
+        job_iter = iter(jobs)
+
+        def fill_reads():
+            while len(reads) < PREFETCH:
+                job = next(job_iter, None)
+                if job is None:
+                    break
+                reads.append((job, io.submit(read_jpeg, job[0])))
+
+        def write_finished():
+            # write the JPEGs whose chunks are all repaired, in order
+            nonlocal num_images
+            while len(images) > 0 and images[0][5] == 0:
+                input_path, output_path, header, meta, repaired, _ = images.popleft()
+                writes.append(io.submit(write_jpeg, output_path, header, repaired, meta))
+                print(f"Repaired {input_path} -> {output_path}")
+                num_images += 1
+
+        fill_reads()
+        while len(reads) > 0 or len(chunk_queue) > 0:
+            # queue the chunks of the next JPEGs until a batch is full
+            while len(chunk_queue) < batch_size and len(reads) > 0:
+                (input_path, output_path), future = reads.popleft()
+                fill_reads()
+                try:
+                    header, chunks, meta = future.result()
+                except ValueError as error:
+                    print(f"Skipping {input_path}: {error}")
+                    continue
+                # the chunks the triage finds clean are kept as they are
+                triage_start = time.time()
+                suspect = triage_chunks(chunks, TRIAGE_MODE, model, TRIAGE_THRESHOLD)
+                triage_time += time.time() - triage_start
+                repaired = [None if flag else chunk for chunk, flag in zip(chunks, suspect)]
+                image = [input_path, output_path, header, meta, repaired, sum(suspect)]
+                images.append(image)
+                chunk_queue.extend((image, idx, chunk) for idx, chunk in enumerate(chunks) if suspect[idx])
+                num_skipped += len(chunks) - sum(suspect)
+                write_finished()
+
+            batch = [chunk_queue.popleft() for _ in range(min(batch_size, len(chunk_queue)))]
+            if len(batch) > 0:
+                repair_start = time.time()
+                outputs = convert_chunks(model, [chunk for _, _, chunk in batch], generator)
+                repair_time += time.time() - repair_start
+                for (image, idx, chunk), output in zip(batch, outputs):
+                    image[4][idx] = fit_chunk(output, chunk)
+                    image[5] -= 1
+                num_chunks += len(batch)
+            write_finished()
+
+        for future in writes:
+            future.result()
+    return num_images, num_chunks, num_skipped, repair_time, triage_time
+
+
+def repair_worker(args):
+    """Repair a share of the JPEGs in a worker process with its own model."""
+    jobs, batch_size, num_threads = args
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    model = load_inference_model(device)
+    generator = torch.Generator(device=device)
+    if INFERENCE_SEED is not None:
+        generator.manual_seed(INFERENCE_SEED)
+    else:
+        generator.seed()
+    return repair_files(model, jobs, batch_size, generator)
+
+
+def repair_jpegs(input_path: Path, output_path: Path, batch_size=INFERENCE_BATCH_SIZE, workers=1):
+    """Repair one JPEG, or every JPEG of a folder into the output folder using a pool of worker processes."""
+    if input_path.is_dir():
+        output_path.mkdir(parents=True, exist_ok=True)
+        input_files = sorted(list(input_path.glob("*.jpg")) + list(input_path.glob("*.jpeg")))
+        jobs = [(input_file, output_path / input_file.name) for input_file in input_files]
+    else:
+        jobs = [(input_path, output_path)]
+
+    start_time = time.time()
+    workers = max(1, min(workers, len(jobs)))
+    if workers == 1:
+        num_images, num_chunks, num_skipped, repair_time, triage_time = repair_worker((jobs, batch_size, None))
+    else:
+        # every worker gets its share of the JPEGs and of the CPU threads
+        num_threads = max(1, torch.get_num_threads() // workers)
+        with Pool(workers) as pool:
+            results = pool.map(repair_worker, [(jobs[i::workers], batch_size, num_threads) for i in range(workers)])
+        num_images = sum(result[0] for result in results)
+        num_chunks = sum(result[1] for result in results)
+        num_skipped = sum(result[2] for result in results)
+        repair_time = sum(result[3] for result in results)
+        triage_time = sum(result[4] for result in results)
+
+    elapsed = time.time() - start_time
+    print(f"Repaired {num_images} JPEGs ({num_chunks} chunks) in {elapsed:.2f}s "
+          f"({num_images / max(elapsed, 1e-9):.2f} images/sec, {num_chunks / max(elapsed, 1e-9):.2f} chunks/sec)")
+    if TRIAGE_MODE is not None:
+        print(f"Triage ({TRIAGE_MODE}) found {num_skipped} of {num_chunks + num_skipped} chunks clean "
+              f"({num_skipped / max(num_chunks + num_skipped, 1):.1%}), they were kept unchanged")
+        if num_chunks > 0:
+            # the skipped chunks would have taken about as long as the repaired ones, minus the time of the triage,
+            # the seconds of the workers add up so they are shared among them
+            saved = (num_skipped * repair_time / num_chunks - triage_time) / workers
+            print(f"Triage saved about {saved:.2f}s (triage took {triage_time / workers:.2f}s)")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Repair corrupted JPEGs end to end with bGPT.")
+    parser.add_argument("--input", type=Path, required=True, help="Corrupted JPEG, or folder of JPEGs")
+    parser.add_argument("--output", type=Path, required=True, help="Repaired JPEG, or output folder")
+    parser.add_argument("--batch_size", type=int, default=INFERENCE_BATCH_SIZE, help="Number of chunks repaired at once")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for a folder, each loading the model")
+
+    args = parser.parse_args()
+    repair_jpegs(args.input, args.output, args.batch_size, args.workers)
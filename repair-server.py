@@ -0,0 +1,234 @@
+import json
+import time
+import queue
+import torch
+import threading
+from utils import *
+from config import *
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+### Local repair daemon keeping bGPTLMHeadModel resident
+# Chunks posted by several clients are batched into one generate_batch call: the worker waits at most
+# --max_wait_ms after the first queued chunk for more, up to --batch_size chunks per batch.
+# Chunks are encoded like inference.py convert mode (INPUT_EXT -> TARGET_EXT) and decoded with
+# DECODING_MODE, TOP_K, TOP_P, TEMPERATURE and COPY_THRESHOLD from config.py.
+
+### Use
+# python repair-server.py --port 8765
+# curl --data-binary @chunk_0000.input http://127.0.0.1:8765/repair -o chunk_0000.output
+# curl http://127.0.0.1:8765/metrics
+
+LATENCY_WINDOW = 1000  # Number of recent requests the latency percentiles are computed on
+
+
+class RepairMetrics:
+    """Thread-safe counters and recent latencies of the server."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.batches = 0
+        self.batch_sizes = 0
+        self.queue_latencies = deque(maxlen=LATENCY_WINDOW)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def add_batch(self, queue_latencies, latencies):
+        with self.lock:
+            self.requests += len(latencies)
+            self.batches += 1
+            self.batch_sizes += len(latencies)
+            self.queue_latencies.extend(queue_latencies)
+            self.latencies.extend(latencies)
+
+    def add_rejected(self):
+        with self.lock:
+            self.rejected += 1
+
+    def add_timed_out(self):
+        with self.lock:
+            self.timed_out += 1
+
+    def snapshot(self, queue_depth):
+        def percentiles(values):
+            if len(values) == 0:
+                return {"p50": None, "p95": None, "max": None}
+            values = sorted(values)
+            return {"p50": values[len(values)//2],
+                    "p95": values[min(int(len(values)*0.95), len(values)-1)],
+                    "max": values[-1]}
+
+        with self.lock:
+            uptime = time.time() - self.start_time
+            return {"queue_depth": queue_depth,
+                    "requests": self.requests,
+                    "rejected": self.rejected,
+                    "timed_out": self.timed_out,
+                    "batches": self.batches,
+                    "mean_batch_size": self.batch_sizes / max(self.batches, 1),
+                    "chunks_per_sec": self.requests / max(uptime, 1e-9),
+                    "queue_latency_sec": percentiles(self.queue_latencies),
+                    "latency_sec": percentiles(self.latencies),
+                    "uptime_sec": uptime}
+
+
+class RepairWorker(threading.Thread):
+    """Take the queued chunks in batches and repair them with one generate_batch call per batch."""
+
+    def __init__(self, model, batch_size, max_wait, max_queue, metrics, seed=INFERENCE_SEED):
+        super().__init__(daemon=True)
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.metrics = metrics
+        self.generator = torch.Generator(device=model.device)
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+    def submit(self, data: bytes):
+        """Queue a chunk, return a Future of its repaired bytes. Raises queue.Full when the queue is full."""
+        future = Future()
+        self.queue.put_nowait((data, future, time.time()))
+        return future
+
+    def next_batch(self):
+        # block for the first request, then wait at most max_wait for the batch to fill up
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            # the chunks whose request timed out were cancelled and are skipped, the others are marked running
+            batch = [item for item in self.next_batch() if item[1].set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            start_time = time.time()
+            try:
+                outputs = convert_chunks(self.model, [data for data, _, _ in batch], self.generator)
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+
+            end_time = time.time()
+            for (_, future, _), output in zip(batch, outputs):
+                future.set_result(output)
+            self.metrics.add_batch([start_time - queued for _, _, queued in batch],
+                                   [end_time - queued for _, _, queued in batch])
+
+
+class RepairHandler(BaseHTTPRequestHandler):
+    """POST /repair with the raw chunk returns the repaired chunk, GET /metrics returns the metrics as JSON."""
+    worker = None
+    metrics = None
+
+    def send_bytes(self, status, body, content_type="application/octet-stream"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, content):
+        self.send_bytes(status, json.dumps(content).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self.send_json(200, self.metrics.snapshot(self.worker.queue.qsize()))
+        elif path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": f"unknown path {path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/repair":
+            self.send_json(404, {"error": f"unknown path {url.path}"})
+            return
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if len(data) == 0:
+            self.send_json(400, {"error": "empty chunk"})
+            return
+
+        try:
+            future = self.worker.submit(data)
+        except queue.Full:
+            self.metrics.add_rejected()
+            self.send_json(503, {"error": "repair queue is full, try again later"})
+            return
+
+        timeout = float(parse_qs(url.query).get("timeout", [0])[0]) or None
+        try:
+            output = future.result(timeout=timeout)
+        except TimeoutError:
+            # a chunk still queued is cancelled, so the worker skips it
+            future.cancel()
+            self.metrics.add_timed_out()
+            self.send_json(504, {"error": f"chunk not repaired within the timeout of {timeout}s"})
+            return
+        except Exception as error:
+            self.send_json(500, {"error": str(error)})
+            return
+        self.send_bytes(200, output)
+
+    def log_message(self, format, *args):
+        # the metrics replace the per-request access log
+        pass
+
+
+def serve(host, port, batch_size, max_wait_ms, max_queue):
+    if torch.cuda.is_available():
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    start_time = time.time()
+    model = load_inference_model(device)
+    print(f"Model loaded from {INFERENCE_WEIGHTS_PATH} in {time.time()-start_time:.2f}s")
+
+    metrics = RepairMetrics()
+    worker = RepairWorker(model, batch_size, max_wait_ms / 1000, max_queue, metrics)
+    worker.start()
+
+    RepairHandler.worker = worker
+    RepairHandler.metrics = metrics
+    server = ThreadingHTTPServer((host, port), RepairHandler)
+    print(f"Repair server listening on http://{host}:{port} (batch size {batch_size}, max wait {max_wait_ms}ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local bGPT repair server batching concurrent requests.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on, local only by default")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--batch_size", type=int, default=INFERENCE_BATCH_SIZE, help="Maximum number of chunks repaired at once")
+    parser.add_argument("--max_wait_ms", type=float, default=20, help="Maximum wait for a batch to fill up after its first chunk")
+    parser.add_argument("--max_queue", type=int, default=1024, help="Maximum number of queued chunks before requests are rejected")
+
+    args = parser.parse_args()
+    serve(args.host, args.port, args.batch_size, args.max_wait_ms, args.max_queue)
@@ -2,6 +2,7 @@
 # GPT generated as substitute... 
 # samplings.py
 
+import math
 import torch
 import numpy as np
 
@@ -37,3 +38,95 @@ def temperature_sampling(probs: np.ndarray, temperature: float = 1.0):
     exp_logits = np.exp(logits)
     new_probs = exp_logits / exp_logits.sum()
     return np.random.choice(len(new_probs), p=new_probs)
+
+def sample_logits(logits: torch.Tensor, top_k: int = 0, top_p: float = 1.0, temperature: float = 1.0, generator: torch.Generator = None):
+    """
+    Batched on-device version of top_k_sampling -> top_p_sampling -> temperature_sampling.
+    :param logits: the logits of shape (vocab,) or (batch, vocab)
+    :param top_k: keep only the k most likely tokens, 0 to disable
+    :param top_p: keep the smallest set of most likely tokens whose probability exceeds top_p
+    :param temperature: the temperature for sampling, <= 0 for argmax
+    :param generator: the torch.Generator used to sample, on the same device as the logits
+    :return: the sampled tokens of shape () or (batch,)
+    """
+    if temperature <= 0:
+        return logits.argmax(-1)
+
+    # work on the candidate tokens only, sorted by descending logit when filtering is needed
+    logits = logits.float()
+    indices = None
+    if 0 < top_k < logits.shape[-1]:
+        logits, indices = torch.topk(logits, top_k, dim=-1)
+    elif top_p < 1.0:
+        logits, indices = torch.sort(logits, descending=True, dim=-1)
+
+    if top_p < 1.0:
+        probs = torch.softmax(logits, dim=-1)
+        # drop every token after the cumulative probability has exceeded top_p
+        remove = (probs.cumsum(-1) - probs) > top_p
+        logits = logits.masked_fill(remove, float('-inf'))
+
+    # exponential race, equivalent to torch.multinomial but a single pass without a sync
+    probs = torch.softmax(logits / temperature, dim=-1)
+    noise = torch.empty_like(probs).exponential_(generator=generator)
+    tokens = (probs / noise).argmax(-1, keepdim=True)
+    if indices is not None:
+        tokens = indices.gather(-1, tokens)
+    return tokens.squeeze(-1)
+
+def copy_unless_confident(logits: torch.Tensor, references: torch.Tensor, threshold: float = 0.9):
+    """
+    Teacher-forced decoding for lightly corrupted inputs: keep the reference token unless the model
+    puts at least threshold probability on a different one.
+    :param logits: the logits of shape (vocab,) or (batch, vocab)
+    :param references: the reference tokens of shape () or (batch,)
+    :param threshold: the probability the argmax needs to override the reference
+    :return: the chosen tokens of shape () or (batch,)
+    """
+    max_logits, tokens = logits.max(-1)
+    confident = (max_logits - torch.logsumexp(logits, dim=-1)) >= math.log(threshold)
+    return torch.where(confident, tokens, references)
+
+def sampling_probs(logits: torch.Tensor, top_k: int = 0, top_p: float = 1.0, temperature: float = 1.0):
+    """
+    The distribution sample_logits draws from, over the whole vocabulary.
+    :param logits: the logits of shape (..., vocab)
+    :return: the probabilities of shape (..., vocab), 0 for the tokens top_k and top_p drop
+    """
+    logits = logits.float()
+    if temperature <= 0:
+        return torch.nn.functional.one_hot(logits.argmax(-1), logits.shape[-1]).float()
+
+    shape = logits.shape
+    indices = None
+    if 0 < top_k < logits.shape[-1]:
+        logits, indices = torch.topk(logits, top_k, dim=-1)
+    elif top_p < 1.0:
+        logits, indices = torch.sort(logits, descending=True, dim=-1)
+
+    if top_p < 1.0:
+        probs = torch.softmax(logits, dim=-1)
+        remove = (probs.cumsum(-1) - probs) > top_p
+        logits = logits.masked_fill(remove, float('-inf'))
+
+    probs = torch.softmax(logits / temperature, dim=-1)
+    if indices is not None:
+        probs = probs.new_zeros(shape).scatter(-1, indices, probs)
+    return probs
+
+def accept_draft(probs: torch.Tensor, drafts: torch.Tensor, generator: torch.Generator = None):
+    """
+    Speculative sampling against a draft that is sure of its tokens (such as the corrupted input):
+    a draft token is kept with the probability the model gives it, and otherwise replaced by a token
+    drawn from the model with the draft token removed, so the tokens follow probs whatever the draft.
+    :param probs: the probabilities of shape (..., vocab)
+    :param drafts: the draft tokens of shape (...)
+    :param generator: the torch.Generator used to sample, on the same device as the probabilities
+    :return: whether every draft token is accepted, and the tokens replacing it otherwise, both of shape (...)
+    """
+    draft_probs = probs.gather(-1, drafts.unsqueeze(-1)).squeeze(-1)
+    accepted = torch.rand(draft_probs.shape, generator=generator, device=probs.device) < draft_probs
+    # exponential race over the probabilities without the draft token, like sample_logits
+    residual = probs.scatter(-1, drafts.unsqueeze(-1), 0)
+    noise = torch.empty_like(residual).exponential_(generator=generator)
+    return accepted, (residual / noise).argmax(-1)
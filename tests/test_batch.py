@@ -0,0 +1,49 @@
+import torch
+import utils
+from config import PATCH_SIZE
+from transformers import GPT2Config
+from utils import bGPTLMHeadModel, pad_byte_lists
+
+PATCH_LENGTH = 8
+
+
+def build_model():
+    patch_config = GPT2Config(num_hidden_layers=1, max_length=PATCH_LENGTH, max_position_embeddings=PATCH_LENGTH,
+                              hidden_size=64, n_head=1, vocab_size=1)
+    byte_config = GPT2Config(num_hidden_layers=1, max_length=PATCH_SIZE+1, max_position_embeddings=PATCH_SIZE+1,
+                             hidden_size=64, n_head=1, vocab_size=256+1)
+    return bGPTLMHeadModel(patch_config, byte_config).eval()
+
+
+def generate_greedy(model, prompt):
+    # one sequence at a time, like the generate mode loop of inference.py
+    patches = torch.tensor([prompt])
+    new_patches = patches
+    past_key_values = None
+    generated = []
+    while patches.shape[1] < PATCH_LENGTH*PATCH_SIZE:
+        patch, past_key_values = model.generate(new_patches.unsqueeze(0), past_key_values=past_key_values,
+                                                use_cache=True, decoding="greedy")
+        generated.extend(token for token in patch if token != 256)
+        if patch[-1] == 256:
+            break
+        new_patches = torch.tensor([patch])
+        patches = torch.cat([patches, new_patches], dim=1)
+    return generated
+
+
+def test_batch_matches_one_sequence_at_a_time(monkeypatch):
+    monkeypatch.setattr(utils, "PATCH_LENGTH", PATCH_LENGTH)
+    torch.manual_seed(0)
+    model = build_model()
+    # left padding: the prompts are 2, 3 and 5 patches long
+    bos_patch = list(b"bin") + [256] * (PATCH_SIZE - 3)
+    prompts = [bos_patch + torch.randint(0, 256, (num_patches*PATCH_SIZE,)).tolist() for num_patches in (1, 2, 4)]
+    patches, masks = pad_byte_lists(prompts)
+
+    with torch.no_grad():
+        batch = model.generate_batch(patches, masks, decoding="greedy")
+        sequences = [generate_greedy(model, prompt) for prompt in prompts]
+
+    assert any(len(output) > PATCH_SIZE for output in sequences)
+    assert batch == sequences
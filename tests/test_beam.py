@@ -0,0 +1,41 @@
+import math
+import torch
+from config import PATCH_SIZE
+from transformers import GPT2Config
+from utils import bGPTLMHeadModel
+
+
+def build_model():
+    patch_config = GPT2Config(num_hidden_layers=1, max_length=8, max_position_embeddings=8,
+                              hidden_size=64, n_head=1, vocab_size=1)
+    byte_config = GPT2Config(num_hidden_layers=1, max_length=PATCH_SIZE+1, max_position_embeddings=PATCH_SIZE+1,
+                             hidden_size=64, n_head=1, vocab_size=256+1)
+    return bGPTLMHeadModel(patch_config, byte_config).eval()
+
+
+def scripted_generate(encoded_patch, tokens, past_key_values=None, use_cache=False, return_logits=False):
+    # the first byte of a patch is the special token with probability 0.4 and "A" with 0.35,
+    # after an "A" the next one is "A" with probability 0.99
+    positions = torch.zeros(len(encoded_patch)) if past_key_values is None else past_key_values[0][0] + 1
+    probs = torch.full((len(encoded_patch), 257), 1e-6)
+    first = positions == 0
+    probs[first, 256] = 0.4
+    probs[first, ord("A")] = 0.35
+    probs[~first, ord("A")] = 0.99
+    return probs.log(), ((positions,),)
+
+
+def test_premature_end_token_loses():
+    model = build_model()
+    model.byte_level_decoder.generate = scripted_generate
+    patches = torch.tensor([list(b"bin") + [256] * (PATCH_SIZE - 3) + [0] * PATCH_SIZE])
+    masks = torch.ones((1, 2), dtype=torch.long)
+
+    # by the sum of log-probabilities the empty output wins: log(0.4) > log(0.35) + 15 log(0.99)
+    assert math.log(0.4) > math.log(0.35) + (PATCH_SIZE - 1) * math.log(0.99)
+    with torch.no_grad():
+        unnormalized = model.generate_beam(patches, masks, beam_width=2, jpeg_stuffing=False, max_patches=1, length_penalty=0)
+        normalized = model.generate_beam(patches, masks, beam_width=2, jpeg_stuffing=False, max_patches=1)
+
+    assert unnormalized == [[]]
+    assert normalized == [[ord("A")] * PATCH_SIZE]
@@ -0,0 +1,47 @@
+import torch
+from config import PATCH_SIZE
+from transformers import GPT2Config
+from utils import bGPTLMHeadModel
+
+PATCH_LENGTH = 8
+
+
+def build_model():
+    patch_config = GPT2Config(num_hidden_layers=1, max_length=PATCH_LENGTH, max_position_embeddings=PATCH_LENGTH,
+                              hidden_size=64, n_head=1, vocab_size=1)
+    byte_config = GPT2Config(num_hidden_layers=1, max_length=PATCH_SIZE+1, max_position_embeddings=PATCH_SIZE+1,
+                             hidden_size=64, n_head=1, vocab_size=256+1)
+    return bGPTLMHeadModel(patch_config, byte_config).eval()
+
+
+def generate_greedy(model, prompt, use_cache):
+    # the generate mode loop of inference.py, feeding only the newest patch with the cache
+    patches = torch.tensor([prompt])
+    new_patches = patches
+    past_key_values = None
+    generated = []
+    while patches.shape[1] < PATCH_LENGTH*PATCH_SIZE:
+        if use_cache:
+            patch, past_key_values = model.generate(new_patches.unsqueeze(0), past_key_values=past_key_values,
+                                                    use_cache=True, decoding="greedy")
+        else:
+            patch = model.generate(patches.unsqueeze(0), decoding="greedy")
+        generated.append(patch)
+        if patch[-1] == 256:
+            break
+        new_patches = torch.tensor([patch])
+        patches = torch.cat([patches, new_patches], dim=1)
+    return generated
+
+
+def test_cached_generate_matches_uncached():
+    torch.manual_seed(0)
+    model = build_model()
+    prompt = list(b"bin") + [256] * (PATCH_SIZE - 3) + torch.randint(0, 256, (2*PATCH_SIZE,)).tolist()
+
+    with torch.no_grad():
+        cached = generate_greedy(model, prompt, use_cache=True)
+        uncached = generate_greedy(model, prompt, use_cache=False)
+
+    assert len(uncached) > 1
+    assert cached == uncached
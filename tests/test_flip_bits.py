@@ -0,0 +1,55 @@
+import sys
+import shutil
+import importlib.util
+import numpy as np
+import pytest
+from pathlib import Path
+
+spec = importlib.util.spec_from_file_location("flip_bits_final", Path(__file__).resolve().parent.parent / "flip-bits-final.py")
+flip_bits_final = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(flip_bits_final)
+
+# stand-in for `bitflip spray percent:X file`, which flips X% of the bits of the file in place
+SPRAY = """#!{python}
+import sys, random
+percent, path = float(sys.argv[2].split(":")[1]), sys.argv[3]
+data = bytearray(open(path, "rb").read())
+for position in random.sample(range(len(data) * 8), round(len(data) * 8 * percent / 100)):
+    data[position >> 3] ^= 1 << (position & 7)
+open(path, "wb").write(bytes(data))
+"""
+
+
+def flipped_bits(clean: bytes, corrupted: bytes):
+    return int(np.unpackbits(np.frombuffer(clean, np.uint8) ^ np.frombuffer(corrupted, np.uint8)).sum())
+
+
+def compare_paths(tmp_path, level):
+    clean = np.random.default_rng(0).integers(0, 256, 4096, dtype=np.uint8).tobytes()
+    src = tmp_path / "chunk.bin"
+    dst = tmp_path / "chunk.input"
+    src.write_bytes(clean)
+    flip_bits_final.corrupt_file(src, dst, percent=level)
+    in_process = flip_bits_final.flip_bits(clean, level, np.random.default_rng(0))
+    return flipped_bits(clean, dst.read_bytes()), flipped_bits(clean, in_process)
+
+
+def test_in_process_matches_bitflip_spray(tmp_path, monkeypatch):
+    spray = tmp_path / "bitflip"
+    spray.write_text(SPRAY.format(python=sys.executable))
+    spray.chmod(0o755)
+    monkeypatch.setattr(flip_bits_final, "BITFLIP_CMD", str(spray))
+
+    counts = []
+    for level in flip_bits_final.CORRUPTION_LEVELS:
+        tool, in_process = compare_paths(tmp_path, level)
+        assert tool == in_process
+        counts.append(in_process)
+    # every corruption level flips a different number of bits
+    assert len(set(counts)) == len(counts)
+
+
+@pytest.mark.skipif(shutil.which(flip_bits_final.BITFLIP_CMD) is None, reason="the bitflip tool is not installed")
+def test_in_process_matches_installed_bitflip(tmp_path):
+    tool, in_process = compare_paths(tmp_path, 0.5)
+    assert tool == in_process
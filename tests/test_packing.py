@@ -0,0 +1,35 @@
+import torch
+from config import PATCH_SIZE
+from transformers import GPT2Config
+from utils import bGPTLMHeadModel
+
+
+def build_model():
+    patch_config = GPT2Config(num_hidden_layers=2, max_length=8, max_position_embeddings=8,
+                              hidden_size=64, n_head=2, vocab_size=1)
+    byte_config = GPT2Config(num_hidden_layers=1, max_length=PATCH_SIZE+1, max_position_embeddings=PATCH_SIZE+1,
+                             hidden_size=64, n_head=1, vocab_size=256+1)
+    return bGPTLMHeadModel(patch_config, byte_config).eval()
+
+
+def test_packed_loss_matches_unpacked():
+    torch.manual_seed(0)
+    model = build_model()
+    samples = [torch.randint(0, 257, (num_patches*PATCH_SIZE,)) for num_patches in (3, 4)]
+
+    # one sample per row, right-padded
+    patches = torch.full((2, 4*PATCH_SIZE), 256)
+    masks = torch.zeros((2, 4), dtype=torch.long)
+    for row, sample in enumerate(samples):
+        patches[row, :len(sample)] = sample
+        masks[row, :len(sample)//PATCH_SIZE] = 1
+
+    # both samples in one row, with their segment ids and one padding patch, like PackedDataset in train-gen.py
+    packed_patches = torch.cat(samples + [torch.full((PATCH_SIZE,), 256)]).unsqueeze(0)
+    segment_ids = torch.tensor([[1, 1, 1, 2, 2, 2, 2, 0]])
+
+    with torch.no_grad():
+        unpacked = model(patches, masks).loss
+        packed = model(packed_patches, segment_ids).loss
+
+    assert torch.allclose(packed, unpacked, atol=1e-5)
@@ -0,0 +1,55 @@
+import torch
+import utils
+from config import PATCH_SIZE
+from transformers import GPT2Config
+from utils import bGPTLMHeadModel, encode_chunk, pad_byte_lists
+
+PATCH_LENGTH = 16
+
+
+def build_model():
+    patch_config = GPT2Config(num_hidden_layers=1, max_length=PATCH_LENGTH, max_position_embeddings=PATCH_LENGTH,
+                              hidden_size=64, n_head=1, vocab_size=1)
+    byte_config = GPT2Config(num_hidden_layers=1, max_length=PATCH_SIZE+1, max_position_embeddings=PATCH_SIZE+1,
+                             hidden_size=64, n_head=1, vocab_size=256+1)
+    return bGPTLMHeadModel(patch_config, byte_config).eval()
+
+
+def first_prompt(model, decode):
+    # the patches of the first patch-level pass, without padding
+    calls = []
+    forward = model.patch_level_decoder.forward
+
+    def recording(patches, masks=None, **kwargs):
+        patches = patches.reshape(len(patches), -1, PATCH_SIZE)
+        calls.append(patches[0] if masks is None else patches[0][masks[0] == 1])
+        return forward(patches, masks, **kwargs)
+
+    model.patch_level_decoder.forward = recording
+    with torch.no_grad():
+        decode()
+    model.patch_level_decoder.forward = forward
+    return calls[0]
+
+
+def test_batch_and_localized_slide_alike(monkeypatch):
+    monkeypatch.setattr(utils, "PATCH_LENGTH", PATCH_LENGTH)
+    torch.manual_seed(0)
+    model = build_model()
+    # 8 input patches and 8 output patches overflow PATCH_LENGTH with the bos and eos patches by 3
+    chunk = bytes(torch.randint(0, 256, (8*PATCH_SIZE,)).tolist())
+    patches, masks = pad_byte_lists([encode_chunk(chunk)])
+    references = torch.tensor([list(chunk)])
+    layout = patches.reshape(-1, PATCH_SIZE)
+    expected = torch.cat((layout[:1], layout[4:]))
+
+    batch = first_prompt(model, lambda: model.generate_batch(patches, masks, decoding="greedy", references=references,
+                                                             max_patches=1, sliding_window=PATCH_SIZE))
+    beam = first_prompt(model, lambda: model.generate_beam(patches, masks, beam_width=1, max_patches=1,
+                                                           sliding_window=PATCH_SIZE))
+    localized = first_prompt(model, lambda: model.generate_localized(patches, masks, references, decoding="greedy",
+                                                                     sliding_window=True))
+
+    assert torch.equal(batch, expected)
+    assert torch.equal(beam, expected)
+    assert torch.equal(localized[:len(expected)], expected)
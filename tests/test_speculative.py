@@ -0,0 +1,43 @@
+import torch
+import utils
+from config import PATCH_SIZE
+from transformers import GPT2Config
+from utils import bGPTLMHeadModel, pad_byte_lists
+
+PATCH_LENGTH = 8
+
+
+def build_model():
+    patch_config = GPT2Config(num_hidden_layers=1, max_length=PATCH_LENGTH, max_position_embeddings=PATCH_LENGTH,
+                              hidden_size=64, n_head=1, vocab_size=1)
+    byte_config = GPT2Config(num_hidden_layers=1, max_length=PATCH_SIZE+1, max_position_embeddings=PATCH_SIZE+1,
+                             hidden_size=64, n_head=1, vocab_size=256+1)
+    return bGPTLMHeadModel(patch_config, byte_config).eval()
+
+
+def pad_references(byte_lists):
+    return torch.nn.utils.rnn.pad_sequence([torch.tensor(byte_list, dtype=torch.long) for byte_list in byte_lists],
+                                           batch_first=True,
+                                           padding_value=256)
+
+
+def test_speculative_matches_byte_by_byte(monkeypatch):
+    monkeypatch.setattr(utils, "PATCH_LENGTH", PATCH_LENGTH)
+    torch.manual_seed(0)
+    model = build_model()
+    bos_patch = list(b"bin") + [256] * (PATCH_SIZE - 3)
+    inputs = [torch.randint(0, 256, (num_patches*PATCH_SIZE,)).tolist() for num_patches in (1, 3)]
+    patches, masks = pad_byte_lists([bos_patch + input_bytes + bos_patch for input_bytes in inputs])
+
+    def decode(decoding, references, speculative):
+        with torch.no_grad():
+            return model.generate_batch(patches, masks, decoding=decoding, references=references,
+                                        copy_threshold=0.5, speculative=speculative)
+
+    for decoding in ("greedy", "copy"):
+        # the random input bytes are mostly rejected as drafts, the output of byte by byte decoding is accepted
+        references = pad_references(inputs)
+        expected = decode(decoding, references, speculative=False)
+        assert decode(decoding, references, speculative=True) == expected
+        references = pad_references(expected)
+        assert decode(decoding, references, speculative=True) == decode(decoding, references, speculative=False)
@@ -0,0 +1,24 @@
+import random
+import torch
+from config import PATCH_LENGTH, PATCH_SIZE
+from utils import truncate_aligned, truncation_window
+
+
+def test_truncation_window_keeps_short_samples():
+    assert truncation_window(4 * PATCH_SIZE) == slice(0, 4 * PATCH_SIZE)
+
+
+def test_truncate_aligned_keeps_input_and_target_aligned():
+    # target[i] is input[i] + offset, so any misalignment shows as another difference
+    offset = 10**6
+    random.seed(0)
+    for extra_patches in [1, 2, 5, 37]:
+        length = (PATCH_LENGTH + extra_patches) * PATCH_SIZE
+        input_tokens = torch.arange(length)
+        for target_length in [length, length - 3 * PATCH_SIZE]:
+            target_tokens = torch.arange(target_length) + offset
+            for _ in range(20):
+                input_bytes, target_bytes = truncate_aligned(input_tokens, target_tokens)
+                assert len(input_bytes) == len(target_bytes) == min(target_length, PATCH_LENGTH * PATCH_SIZE)
+                assert len(input_bytes) % PATCH_SIZE == 0
+                assert torch.equal(target_bytes - input_bytes, torch.full_like(input_bytes, offset))
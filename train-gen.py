@@ -1,4 +1,7 @@
 import os
+import json
+import math
+import bisect
 import time
 import wandb
 import torch
@@ -8,9 +11,10 @@ import numpy as np
 from utils import *
 from config import *
 from tqdm import tqdm
+from container import Container, list_containers
 from copy import deepcopy
-from torch.cuda.amp import autocast, GradScaler
-from torch.utils.data import Dataset, DataLoader
+from torch.cuda.amp import GradScaler
+from torch.utils.data import Dataset, DataLoader, Sampler
 from transformers import GPT2Config, get_scheduler
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
@@ -52,7 +56,11 @@ byte_config = GPT2Config(vocab_size=256+1,
                         n_layer=BYTE_NUM_LAYERS,
                         n_head=HIDDEN_SIZE//64,
                         n_inner=HIDDEN_SIZE*4)
-model = bGPTLMHeadModel(patch_config, byte_config)
+if CORRECTION_HEAD:
+    model = bGPTForCorrection(patch_config)
+else:
+    model = bGPTLMHeadModel(patch_config, byte_config)
+model = configure_memory(model, GRADIENT_CHECKPOINTING, SDPA_ATTENTION)
 model = model.to(device)
 
 # print parameter number
@@ -61,25 +69,34 @@ print("Parameter Number: "+str(sum(p.numel() for p in model.parameters() if p.re
 if world_size > 1:
     model = DDP(model, device_ids=[local_rank], output_device=local_rank,  find_unused_parameters=True)
 
-scaler = GradScaler()
-is_autocast = True
+# float16 autocast with loss scaling on CUDA, bfloat16 autocast (no scaling needed) on CPU with CPU_PRECISION "bf16"
+scaler = GradScaler(enabled=device.type == "cuda")
+is_autocast = device.type == "cuda" or CPU_PRECISION == "bf16"
+autocast_dtype = torch.float16 if device.type == "cuda" else torch.bfloat16
 optimizer = torch.optim.AdamW(model.parameters(), lr=LEARNING_RATE)
     
 def collate_batch(input_batches):
     
-    input_patches, input_masks = zip(*input_batches)
-    input_patches = torch.nn.utils.rnn.pad_sequence(input_patches, batch_first=True, padding_value=256)
+    input_patches, input_masks, *target_patches = zip(*input_batches)
+    input_patches = torch.nn.utils.rnn.pad_sequence(input_patches, batch_first=True, padding_value=256).long()
     input_masks = torch.nn.utils.rnn.pad_sequence(input_masks, batch_first=True, padding_value=0)
 
+    if CORRECTION_HEAD:
+        target_patches = torch.nn.utils.rnn.pad_sequence(target_patches[0], batch_first=True, padding_value=256).long()
+        return input_patches.to(device), input_masks.to(device), target_patches.to(device)
+
+    if len(target_patches) > 0:
+        # the output masks of the conversion pairs, for the target-aware patch sampling
+        output_masks = torch.nn.utils.rnn.pad_sequence(target_patches[0], batch_first=True, padding_value=0)
+        return input_patches.to(device), input_masks.to(device), output_masks.to(device)
+
     return input_patches.to(device), input_masks.to(device)
 
-def split_into_minibatches(input_patches, input_masks, minibatch_size):
+def split_into_minibatches(batch, minibatch_size):
     minibatches = []
-    for start_idx in range(0, len(input_patches), minibatch_size):
+    for start_idx in range(0, len(batch[0]), minibatch_size):
         end_idx = start_idx + minibatch_size
-        minibatch_patches = input_patches[start_idx:end_idx]
-        minibatch_masks = input_masks[start_idx:end_idx]
-        minibatches.append((minibatch_patches, minibatch_masks))
+        minibatches.append(tuple(tensor[start_idx:end_idx] for tensor in batch))
     return minibatches
 
 def list_files_in_directory(directories):
@@ -92,7 +109,27 @@ def list_files_in_directory(directories):
                 file_list.append(file_path)
     return file_list
 
-def read_bytes(filename):
+def list_samples_in_shards(directories):
+    sample_list = []
+
+    for directory in directories:
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        for idx in range(meta["nr_samples"]):
+            sample_list.append((directory, idx))
+    return sample_list
+
+def list_samples_in_containers(paths):
+    sample_list = []
+
+    for path in list_containers(paths):
+        with Container(path) as container:
+            for name in container.names():
+                for idx in range(container.meta(name)["nr_chunks"]):
+                    sample_list.append((str(path), name, idx))
+    return sample_list
+
+def read_bytes(filename, truncate=True):
     
     ext = filename.split('.')[-1]
     ext = bytearray(ext, 'utf-8')
@@ -111,25 +148,45 @@ def read_bytes(filename):
     bos_patch = ext + [256] * (PATCH_SIZE - len(ext))
     bytes = bos_patch + bytes + [256] * PATCH_SIZE
 
-    if len(bytes) > PATCH_LENGTH*PATCH_SIZE:
+    if truncate and len(bytes) > PATCH_LENGTH*PATCH_SIZE:
         if SHOW_WARNS:
             warnings.warn(f"Warning: {filename} is too long, truncating to {PATCH_LENGTH*PATCH_SIZE} bytes.")
-        choices = ["head", "body", "tail"]
-        choice = random.choice(choices)
-        if choice == "head":
-            bytes = bytes[:PATCH_LENGTH*PATCH_SIZE]
-        elif choice == "body" and len(bytes) > (PATCH_LENGTH+1)*PATCH_SIZE:
-            start = random.randint(1, len(bytes)//PATCH_SIZE-PATCH_LENGTH)
-            bytes = bytes[start*PATCH_SIZE:(start+PATCH_LENGTH)*PATCH_SIZE]
-        else:
-            bytes = bytes[-PATCH_LENGTH*PATCH_SIZE:]
+        bytes = bytes[truncation_window(len(bytes))]
 
     masks = [1] * (len(bytes)//PATCH_SIZE)
 
     return bytes, masks
 
+def truncate_tokens(tokens):
+    # same random head/body/tail choice as read_bytes, for token tensors
+    return tokens[truncation_window(len(tokens))]
+
+def join_pair(input_bytes, target_bytes):
+    # the input without its eos patch, then the target; a pair longer than PATCH_LENGTH drops the
+    # oldest input patches after the bos patch with SLIDING_WINDOW, like convert mode, or the end of the target
+    input_bytes = input_bytes[:-PATCH_SIZE]
+    overflow = len(input_bytes) + len(target_bytes) - PATCH_LENGTH*PATCH_SIZE
+    if SLIDING_WINDOW and overflow > 0:
+        input_bytes = torch.cat((input_bytes[:PATCH_SIZE], input_bytes[PATCH_SIZE+overflow:]))
+    file_bytes = torch.cat((input_bytes, target_bytes))[:PATCH_LENGTH*PATCH_SIZE]
+    # the output patches come after the bos patch of the target
+    output_masks = (torch.arange(len(file_bytes)//PATCH_SIZE) > len(input_bytes)//PATCH_SIZE).long()
+    return file_bytes, output_masks
+
+def count_patches(input_patches, target_patches=None):
+    # patches of a sample from the patches of its files (bos and eos included), truncated like read_bytes and join_pair
+    input_patches = min(input_patches, PATCH_LENGTH)
+    if target_patches is None:
+        return input_patches
+    return min(input_patches - 1 + min(target_patches, PATCH_LENGTH), PATCH_LENGTH)
+
+def file_patches(filename):
+    return math.ceil(os.path.getsize(filename) / PATCH_SIZE) + 2
+
 class ByteDataset(Dataset):
     def __init__(self, filenames, split='train'):
+        if CORRECTION_HEAD and (CONVERSION_MODE == None or "->" not in CONVERSION_MODE):
+            raise ValueError("The correction head needs a unidirectional CONVERSION_MODE, such as 'input->output'.")
         if CONVERSION_MODE == None:
             print(f"Autoregressive Training Mode: loading {len(filenames)} files for {split}")
             self.filenames = filenames
@@ -165,6 +222,12 @@ class ByteDataset(Dataset):
     def __len__(self):
         return len(self.filenames)
 
+    def lengths(self):
+        # patches of every sample, from the file sizes
+        if CONVERSION_MODE == None:
+            return [count_patches(file_patches(filename)) for filename in self.filenames]
+        return [count_patches(file_patches(input_filename), file_patches(target_filename)) for input_filename, target_filename in self.filenames]
+
     def __getitem__(self, idx):
         
         if CONVERSION_MODE == None:
@@ -172,29 +235,267 @@ class ByteDataset(Dataset):
             file_bytes, file_masks = read_bytes(filename)
         else:
             input_filename, target_filename = self.filenames[idx]
-            input_bytes, input_masks = read_bytes(input_filename)
-            target_bytes, target_masks = read_bytes(target_filename)
+            # the correction head truncates input and target together, see truncate_aligned
+            input_bytes, input_masks = read_bytes(input_filename, truncate=not CORRECTION_HEAD)
+            target_bytes, target_masks = read_bytes(target_filename, truncate=not CORRECTION_HEAD)
 
-            file_bytes = input_bytes[:-PATCH_SIZE] + target_bytes
-            file_masks = input_masks[:-1] + target_masks
+            if CORRECTION_HEAD:
+                # the clean bytes are predicted in place, so input and target stay aligned
+                input_bytes, target_bytes = truncate_aligned(torch.tensor(input_bytes, dtype=torch.long),
+                                                             torch.tensor(target_bytes, dtype=torch.long))
+                input_masks = torch.ones(len(input_bytes)//PATCH_SIZE, dtype=torch.long)
+                return input_bytes, input_masks, target_bytes
 
-            if len(file_bytes) > PATCH_LENGTH*PATCH_SIZE:
-                # all 48 bytes truncation, let it be for now! train loss is decreasing so let it run.
-                # print(f"Warning: {input_filename} and {target_filename} are too long after concatenation, truncating to {PATCH_LENGTH*PATCH_SIZE} bytes.")
-                truncated = len(file_bytes) - (PATCH_LENGTH * PATCH_SIZE)
-                # print(f"Warning: {input_filename} and {target_filename} are too long by {truncated} bytes, truncating.")
-                file_bytes = file_bytes[:PATCH_LENGTH*PATCH_SIZE]
-                file_masks = file_masks[:PATCH_LENGTH]
+            file_bytes, output_masks = join_pair(torch.tensor(input_bytes, dtype=torch.long), torch.tensor(target_bytes, dtype=torch.long))
+            file_masks = torch.ones(len(file_bytes)//PATCH_SIZE, dtype=torch.long)
+            return file_bytes, file_masks, output_masks
 
         file_bytes = torch.tensor(file_bytes, dtype=torch.long)
         file_masks = torch.tensor(file_masks, dtype=torch.long)
         
         return file_bytes, file_masks
 
+class ShardDataset(Dataset):
+    def __init__(self, samples, split='train'):
+        print(f"Shard Mode: loading {len(samples)} samples for {split}")
+        self.samples = samples
+        self.indices = {}
+        self.shard_names = {}
+        self.shards = {}
+
+        for directory in sorted(set(directory for directory, _ in samples)):
+            with open(os.path.join(directory, "meta.json"), "r") as f:
+                meta = json.load(f)
+            if meta["patch_size"] != PATCH_SIZE or meta["conversion_mode"] != CONVERSION_MODE:
+                raise ValueError(f"The shards in {directory} were packed with PATCH_SIZE={meta['patch_size']} and CONVERSION_MODE={meta['conversion_mode']}, please repack them with pack-dataset.py.")
+            self.indices[directory] = np.load(os.path.join(directory, "index.npy"))
+            self.shard_names[directory] = meta["shards"]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def lengths(self):
+        # patches of every sample, from the token lengths in the index
+        lengths = []
+        for directory, sample_idx in self.samples:
+            _, _, input_length, _, target_length = self.indices[directory][sample_idx].tolist()
+            lengths.append(count_patches(input_length // PATCH_SIZE, target_length // PATCH_SIZE if target_length > 0 else None))
+        return lengths
+
+    def get_tokens(self, directory, shard, offset, length):
+        # map the shards lazily, so that every DataLoader worker has its own maps
+        if (directory, shard) not in self.shards:
+            shard_path = os.path.join(directory, self.shard_names[directory][shard])
+            # tokens are 0-256, so the uint16 shards can be viewed as int16; copy-on-write keeps from_numpy happy
+            self.shards[(directory, shard)] = np.memmap(shard_path, dtype=np.int16, mode='c')
+        return torch.from_numpy(self.shards[(directory, shard)][offset:offset+length])
+
+    def __getitem__(self, idx):
+
+        directory, sample_idx = self.samples[idx]
+        shard, input_offset, input_length, target_offset, target_length = self.indices[directory][sample_idx].tolist()
+        input_tokens = self.get_tokens(directory, shard, input_offset, input_length)
+
+        if target_length == 0:
+            file_bytes = truncate_tokens(input_tokens)
+        else:
+            target_tokens = self.get_tokens(directory, shard, target_offset, target_length)
+
+            if CORRECTION_HEAD:
+                # the clean bytes are predicted in place, so input and target are truncated together
+                input_bytes, target_bytes = truncate_aligned(input_tokens, target_tokens)
+                input_masks = torch.ones(len(input_bytes)//PATCH_SIZE, dtype=torch.long)
+                return input_bytes, input_masks, target_bytes
+
+            file_bytes, output_masks = join_pair(truncate_tokens(input_tokens), truncate_tokens(target_tokens))
+            file_masks = torch.ones(len(file_bytes)//PATCH_SIZE, dtype=torch.long)
+            return file_bytes, file_masks, output_masks
+
+        file_masks = torch.ones(len(file_bytes)//PATCH_SIZE, dtype=torch.long)
+
+        return file_bytes, file_masks
+
+class ContainerDataset(Dataset):
+    def __init__(self, samples, split='train'):
+        # chunks are stored in streams named like the file extensions, e.g. "input" and "output"
+        if CONVERSION_MODE == None:
+            self.streams = ["bin"]
+        elif "->" in CONVERSION_MODE:
+            self.streams = CONVERSION_MODE.split("->")
+        elif "&" in CONVERSION_MODE:
+            self.streams = CONVERSION_MODE.split("&")
+        else:
+            raise ValueError("Invalid Conversion Mode, please check the config.py file. You can use None, 'input->output', or 'input&output'.")
+        if CORRECTION_HEAD and (CONVERSION_MODE == None or "->" not in CONVERSION_MODE):
+            raise ValueError("The correction head needs a unidirectional CONVERSION_MODE, such as 'input->output'.")
+        print(f"Container Mode: loading {len(samples)} chunks for {split}")
+        self.samples = samples
+        self.containers = {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def lengths(self):
+        # patches of every sample, from the chunk size of its image
+        lengths = []
+        for path, name, _ in self.samples:
+            if path not in self.containers:
+                self.containers[path] = Container(path)
+            chunk_patches = math.ceil(self.containers[path].meta(name)["size"] / PATCH_SIZE) + 2
+            lengths.append(count_patches(chunk_patches, chunk_patches if len(self.streams) > 1 else None))
+        return lengths
+
+    def read_chunk(self, path, name, idx, stream, truncate=True):
+        # open the containers lazily, so that every DataLoader worker has its own maps
+        if path not in self.containers:
+            self.containers[path] = Container(path)
+
+        ext = bytearray(stream, 'utf-8')[:PATCH_SIZE]
+        bos_patch = torch.full((PATCH_SIZE,), 256, dtype=torch.long)
+        bos_patch[:len(ext)] = torch.tensor(list(ext), dtype=torch.long)
+        chunk = torch.frombuffer(bytearray(self.containers[path].chunk(name, idx, stream)), dtype=torch.uint8).long()
+        padding = torch.full(((-len(chunk)) % PATCH_SIZE + PATCH_SIZE,), 256, dtype=torch.long)
+        tokens = torch.cat((bos_patch, chunk, padding))
+        return truncate_tokens(tokens) if truncate else tokens
+
+    def __getitem__(self, idx):
+
+        path, name, chunk_idx = self.samples[idx]
+        # the correction head truncates input and target together, see truncate_aligned
+        input_bytes = self.read_chunk(path, name, chunk_idx, self.streams[0], truncate=not CORRECTION_HEAD)
+
+        if len(self.streams) == 1:
+            file_bytes = input_bytes
+        else:
+            target_bytes = self.read_chunk(path, name, chunk_idx, self.streams[1], truncate=not CORRECTION_HEAD)
+
+            if CORRECTION_HEAD:
+                # the clean bytes are predicted in place, so input and target stay aligned
+                input_bytes, target_bytes = truncate_aligned(input_bytes, target_bytes)
+                input_masks = torch.ones(len(input_bytes)//PATCH_SIZE, dtype=torch.long)
+                return input_bytes, input_masks, target_bytes
+
+            file_bytes, output_masks = join_pair(input_bytes, target_bytes)
+            file_masks = torch.ones(len(file_bytes)//PATCH_SIZE, dtype=torch.long)
+            return file_bytes, file_masks, output_masks
+
+        file_masks = torch.ones(len(file_bytes)//PATCH_SIZE, dtype=torch.long)
+
+        return file_bytes, file_masks
+
+def pack_samples(lengths, capacity=PATCH_LENGTH):
+    # best fit decreasing: every sample, longest first, goes to the fullest pack it still fits in
+    packs = []
+    rooms = []  # sorted (room left, pack index)
+    for idx in sorted(range(len(lengths)), key=lambda idx: -lengths[idx]):
+        position = bisect.bisect_left(rooms, (lengths[idx], -1))
+        if position < len(rooms):
+            room, pack_idx = rooms.pop(position)
+        else:
+            room, pack_idx = capacity, len(packs)
+            packs.append([])
+        packs[pack_idx].append(idx)
+        if room - lengths[idx] > 0:
+            bisect.insort(rooms, (room - lengths[idx], pack_idx))
+    return packs
+
+class PackedDataset(Dataset):
+    def __init__(self, dataset, split='train'):
+        # several short samples share one PATCH_LENGTH sequence, their masks become segment ids (see bGPTLMHeadModel.forward)
+        if CORRECTION_HEAD:
+            raise ValueError("Sequence packing is not supported with the correction head.")
+        self.dataset = dataset
+        self.sample_lengths = dataset.lengths()
+        self.packs = pack_samples(self.sample_lengths)
+        print(f"Packing Mode: {len(dataset)} samples packed into {len(self.packs)} sequences for {split} "
+              f"({sum(self.sample_lengths) / max(len(self.packs)*PATCH_LENGTH, 1):.1%} of the patches used)")
+
+    def __len__(self):
+        return len(self.packs)
+
+    def lengths(self):
+        return [sum(self.sample_lengths[idx] for idx in pack) for pack in self.packs]
+
+    def __getitem__(self, idx):
+
+        file_bytes = []
+        file_masks = []
+        output_masks = []
+        for segment, sample_idx in enumerate(self.packs[idx], 1):
+            sample_bytes, sample_masks, *sample_output_masks = self.dataset[sample_idx]
+            file_bytes.append(sample_bytes)
+            file_masks.append(sample_masks * segment)
+            output_masks += sample_output_masks
+        file_bytes = torch.cat(file_bytes)[:PATCH_LENGTH*PATCH_SIZE]
+        file_masks = torch.cat(file_masks)[:PATCH_LENGTH]
+
+        if len(output_masks) > 0:
+            return file_bytes, file_masks, torch.cat(output_masks)[:PATCH_LENGTH]
+        return file_bytes, file_masks
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch samples of similar patch counts together, so that little of every batch is padding.
+    The samples are shuffled, sorted by length within buckets of bucket_size batches and batched,
+    then the batches are shuffled. Like DistributedSampler, every replica gets the same number of
+    batches (repeating the first ones if needed), and set_epoch reshuffles them.
+    With max_patches, a batch takes as many samples as fit in max_patches patches once padded, instead of batch_size.
+    """
+    def __init__(self, lengths, batch_size, max_patches=0, bucket_size=64, num_replicas=1, rank=0, shuffle=True, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_patches = max_patches
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+
+        batches = []
+        bucket_len = self.batch_size * self.bucket_size
+        for start in range(0, len(indices), bucket_len):
+            batch = []
+            for idx in sorted(indices[start:start+bucket_len], key=lambda idx: self.lengths[idx]):
+                # sorted by length, so the new sample is the longest of the batch
+                if self.max_patches > 0:
+                    full = len(batch) > 0 and (len(batch) + 1) * self.lengths[idx] > self.max_patches
+                else:
+                    full = len(batch) == self.batch_size
+                if full:
+                    batches.append(batch)
+                    batch = []
+                batch.append(idx)
+            if len(batch) > 0:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        total = math.ceil(len(batches) / self.num_replicas) * self.num_replicas
+        while 0 < len(batches) < total:
+            batches += batches[:total-len(batches)]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
 # call model with a batch of input
 def process_one_batch(batch):
-    input_patches, input_masks = batch
-    loss = model(input_patches, input_masks).loss
+    loss = model(*batch).loss
 
     # Reduce the loss on GPU 0
     if world_size > 1:
@@ -212,12 +513,17 @@ def train_epoch():
     iter_idx = 1
     model.train()
     train_steps = (epoch-1)*len(train_set)
+    # tokens are the patches of the samples, padding excluded
+    num_tokens = 0
+    num_slots = 0
+    start_time = time.time()
 
     for batch in tqdm_train_set:
-        minibatches = split_into_minibatches(batch[0], batch[1], BATCH_SIZE//ACCUMULATION_STEPS)
+        # batches of the token budget vary in size, so they are split in ACCUMULATION_STEPS parts
+        minibatches = split_into_minibatches(batch, math.ceil(len(batch[0])/ACCUMULATION_STEPS))
         for minibatch in minibatches:
-            with autocast():
-                loss = process_one_batch(minibatch) / ACCUMULATION_STEPS
+            with torch.autocast(device.type, dtype=autocast_dtype, enabled=is_autocast):
+                loss = process_one_batch(minibatch) / len(minibatches)
             scaler.scale(loss).backward()
             total_train_loss += loss.item()
         scaler.step(optimizer)
@@ -225,16 +531,24 @@ def train_epoch():
         
         lr_scheduler.step()
         model.zero_grad(set_to_none=True)
-        tqdm_train_set.set_postfix({str(global_rank)+'_train_loss': total_train_loss / iter_idx})
+        num_tokens += int((batch[1] > 0).sum())
+        num_slots += batch[1].numel()
+        tokens_per_sec = num_tokens / max(time.time() - start_time, 1e-9)
+        tqdm_train_set.set_postfix({str(global_rank)+'_train_loss': total_train_loss / iter_idx,
+                                    str(global_rank)+'_tokens_per_sec': round(tokens_per_sec)})
         train_steps += 1
         
         # Log the training loss to wandb
         if global_rank==0 and WANDB_LOG:
-            wandb.log({"train_loss": total_train_loss / iter_idx}, step=train_steps)
+            wandb.log({"train_loss": total_train_loss / iter_idx,
+                       "train_tokens_per_sec": tokens_per_sec,
+                       "train_padding": 1 - num_tokens / num_slots}, step=train_steps)
 
         iter_idx += 1
         
-    return total_train_loss / (iter_idx-1)
+    tokens_per_sec = num_tokens / max(time.time() - start_time, 1e-9)
+    print(f"Trained on {num_tokens} tokens at {tokens_per_sec:.1f} tokens/sec ({1 - num_tokens / max(num_slots, 1):.1%} padding)")
+    return total_train_loss / (iter_idx-1), tokens_per_sec
 
 # do one epoch for eval
 def eval_epoch():
@@ -245,10 +559,10 @@ def eval_epoch():
   
     # Evaluate data for one epoch
     for batch in tqdm_eval_set: 
-        minibatches = split_into_minibatches(batch[0], batch[1], BATCH_SIZE//ACCUMULATION_STEPS)
+        minibatches = split_into_minibatches(batch, math.ceil(len(batch[0])/ACCUMULATION_STEPS))
         for minibatch in minibatches:
             with torch.no_grad():
-                loss = process_one_batch(minibatch) / ACCUMULATION_STEPS
+                loss = process_one_batch(minibatch) / len(minibatches)
             total_eval_loss += loss.item()
         tqdm_eval_set.set_postfix({str(global_rank)+'_eval_loss': total_eval_loss / iter_idx})
         iter_idx += 1
@@ -267,9 +581,16 @@ if __name__ == "__main__":
                     "_lr_"+str(LEARNING_RATE)+
                     "_batch_"+str(BATCH_SIZE))
                    
-    # load filenames under train and eval folder
-    train_files = list_files_in_directory(TRAIN_FOLDERS)
-    eval_files = list_files_in_directory(EVAL_FOLDERS)
+    # load filenames under train and eval folder, or samples in the packed shards or containers
+    if len(TRAIN_SHARDS)>0:
+        train_files = list_samples_in_shards(TRAIN_SHARDS)
+        eval_files = list_samples_in_shards(EVAL_SHARDS)
+    elif len(TRAIN_CONTAINERS)>0:
+        train_files = list_samples_in_containers(TRAIN_CONTAINERS)
+        eval_files = list_samples_in_containers(EVAL_CONTAINERS)
+    else:
+        train_files = list_files_in_directory(TRAIN_FOLDERS)
+        eval_files = list_files_in_directory(EVAL_FOLDERS)
 
     if len(eval_files)==0:
         random.shuffle(train_files)
@@ -285,14 +606,37 @@ if __name__ == "__main__":
     train_files = train_files[:train_batch_nums*batch_size]
     eval_files = eval_files[:eval_batch_nums*batch_size]
 
-    train_set = ByteDataset(train_files, split='train')
-    eval_set = ByteDataset(eval_files, split='eval')
+    if CONVERSION_MODE != None:
+        check_chunk_geometry()
+
+    if len(TRAIN_SHARDS)>0:
+        train_set = ShardDataset(train_files, split='train')
+        eval_set = ShardDataset(eval_files, split='eval')
+    elif len(TRAIN_CONTAINERS)>0:
+        train_set = ContainerDataset(train_files, split='train')
+        eval_set = ContainerDataset(eval_files, split='eval')
+    else:
+        train_set = ByteDataset(train_files, split='train')
+        eval_set = ByteDataset(eval_files, split='eval')
 
-    train_sampler = DistributedSampler(train_set, num_replicas=world_size, rank=local_rank)
-    eval_sampler = DistributedSampler(eval_set, num_replicas=world_size, rank=local_rank)
+    if PACK_SEQUENCES:
+        train_set = PackedDataset(train_set, split='train')
+        eval_set = PackedDataset(eval_set, split='eval')
+
+    if BUCKET_BATCHING:
+        # samples of similar patch counts are batched together, optionally up to a patch budget
+        train_sampler = BucketBatchSampler(train_set.lengths(), batch_size, MAX_BATCH_PATCHES, num_replicas=world_size, rank=global_rank)
+        eval_sampler = BucketBatchSampler(eval_set.lengths(), batch_size, MAX_BATCH_PATCHES, num_replicas=world_size, rank=global_rank)
+        print(f"Bucket batching: {len(train_sampler)} train batches and {len(eval_sampler)} eval batches per replica")
+
+        train_set = DataLoader(train_set, batch_sampler=train_sampler, collate_fn=collate_batch)
+        eval_set = DataLoader(eval_set, batch_sampler=eval_sampler, collate_fn=collate_batch)
+    else:
+        train_sampler = DistributedSampler(train_set, num_replicas=world_size, rank=local_rank)
+        eval_sampler = DistributedSampler(eval_set, num_replicas=world_size, rank=local_rank)
 
-    train_set = DataLoader(train_set, batch_size=batch_size, collate_fn=collate_batch, sampler=train_sampler, shuffle = (train_sampler is None))
-    eval_set = DataLoader(eval_set, batch_size=batch_size, collate_fn=collate_batch, sampler=eval_sampler, shuffle = (train_sampler is None))
+        train_set = DataLoader(train_set, batch_size=batch_size, collate_fn=collate_batch, sampler=train_sampler, shuffle = (train_sampler is None))
+        eval_set = DataLoader(eval_set, batch_size=batch_size, collate_fn=collate_batch, sampler=eval_sampler, shuffle = (train_sampler is None))
 
     lr_scheduler = get_scheduler(
         name="cosine",
@@ -360,11 +704,11 @@ if __name__ == "__main__":
         train_sampler.set_epoch(epoch)
         eval_sampler.set_epoch(epoch)
         print('-' * 21 + "Epoch " + str(epoch) + '-' * 21)
-        train_loss = train_epoch()
+        train_loss, train_tokens_per_sec = train_epoch()
         eval_loss = eval_epoch()
         if global_rank==0:
             with open(LOGS_PATH,'a') as f:
-                f.write("Epoch " + str(epoch) + "\ntrain_loss: " + str(train_loss) + "\neval_loss: " +str(eval_loss) + "\ntime: " + time.asctime(time.localtime(time.time())) + "\n\n")
+                f.write("Epoch " + str(epoch) + "\ntrain_loss: " + str(train_loss) + "\neval_loss: " +str(eval_loss) + "\ntrain_tokens_per_sec: " + str(train_tokens_per_sec) + "\ntime: " + time.asctime(time.localtime(time.time())) + "\n\n")
             if eval_loss < min_eval_loss:
                 best_epoch = epoch
                 min_eval_loss = eval_loss
@@ -0,0 +1,121 @@
+import math
+import json
+import time
+import torch
+import numpy as np
+from config import *
+from pathlib import Path
+from utils import load_inference_model, precision_context
+
+### Triage of chunks before repair, so that only suspect chunks go through generation
+# - "stuffing":   in JPEG entropy-coded data every 0xFF byte is followed by 0x00 (byte stuffing) or a
+#                 restart marker 0xD0-0xD7, anything else is an unexpected marker left by a bit flip
+# - "perplexity": the worst patch of the chunk under the model, in bits per byte, from one teacher-forced
+#                 pass (bGPTLMHeadModel.score) is above TRIAGE_THRESHOLD
+# - "both":       suspect if either says so
+# Clean chunks are copied unchanged.
+
+### Use
+# Set TRIAGE_MODE in config.py for inference.py (convert mode) and repair-jpeg.py, or evaluate it
+# against the corruption log of flip-bits-final.py:
+# python triage.py --input ./bgpt-dataset --log corruption_log.json --mode stuffing
+
+RESTART_MARKERS = np.arange(0xD0, 0xD8)
+
+
+def has_invalid_stuffing(chunk: bytes):
+    """Whether a chunk of entropy-coded JPEG data has a 0xFF byte not followed by 0x00 or a restart marker."""
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    # a 0xFF as last byte continues in the next chunk, so it is not checked
+    following = data[1:][data[:-1] == 0xFF]
+    return bool(np.any((following != 0x00) & ~np.isin(following, RESTART_MARKERS)))
+
+
+def patch_perplexities(model, chunks, batch_size=INFERENCE_BATCH_SIZE):
+    """Bits per byte of the worst patch of every chunk, laid out like the input of inference.py convert mode."""
+    input_bos = list(bytearray(INPUT_EXT, 'utf-8'))[:PATCH_SIZE]
+    input_bos = input_bos + [256] * (PATCH_SIZE - len(input_bos))
+
+    perplexities = []
+    for start in range(0, len(chunks), batch_size):
+        byte_lists = []
+        for chunk in chunks[start:start+batch_size]:
+            byte_list = list(chunk)[:(PATCH_LENGTH-1)*PATCH_SIZE]
+            if len(byte_list) % PATCH_SIZE != 0:
+                byte_list = byte_list + [256] * (PATCH_SIZE - len(byte_list) % PATCH_SIZE)
+            byte_lists.append(input_bos + byte_list)
+
+        patches = torch.nn.utils.rnn.pad_sequence([torch.tensor(byte_list, dtype=torch.long) for byte_list in byte_lists],
+                                                  batch_first=True,
+                                                  padding_value=256)
+        masks = torch.nn.utils.rnn.pad_sequence([torch.ones(len(byte_list)//PATCH_SIZE, dtype=torch.long) for byte_list in byte_lists],
+                                                batch_first=True,
+                                                padding_value=0)
+        with torch.no_grad(), precision_context(model.device):
+            bits = -model.score(patches, masks).mean(-1).cpu() / math.log(2)
+        # patches of the padding do not count
+        bits = bits.masked_fill(masks[:, 1:] == 0, 0)
+        perplexities += bits.max(1).values.tolist()
+    return perplexities
+
+
+def triage_chunks(chunks, mode=TRIAGE_MODE, model=None, threshold=TRIAGE_THRESHOLD):
+    """
+    Flag the chunks that need repair.
+    :param chunks: the chunks as bytes
+    :param mode: None (every chunk is suspect), "stuffing", "perplexity" or "both"
+    :param model: the bGPTLMHeadModel, needed for "perplexity" and "both"
+    :param threshold: bits per byte of the worst patch above which a chunk is suspect
+    :return: a list with True for every suspect chunk
+    """
+    if mode == None:
+        return [True] * len(chunks)
+    if mode not in ["stuffing", "perplexity", "both"]:
+        raise ValueError(f"Invalid triage mode {mode}, please use None, 'stuffing', 'perplexity' or 'both'.")
+
+    suspect = [False] * len(chunks)
+    if mode in ["stuffing", "both"]:
+        suspect = [has_invalid_stuffing(chunk) for chunk in chunks]
+    if mode in ["perplexity", "both"]:
+        if model is None:
+            raise ValueError(f"Triage mode {mode} needs the model.")
+        perplexities = patch_perplexities(model, chunks)
+        suspect = [flag or perplexity > threshold for flag, perplexity in zip(suspect, perplexities)]
+    return suspect
+
+
+def evaluate_triage(input_dir, log_path, mode, threshold, weights_path=INFERENCE_WEIGHTS_PATH):
+    """Compare the triage of the .input chunks of flip-bits-final.py with the corruption log."""
+    with open(log_path, "r") as f:
+        log = json.load(f)
+    bases = sorted(base for base in log if (Path(input_dir) / f"{base}.input").exists())
+    chunks = [(Path(input_dir) / f"{base}.input").read_bytes() for base in bases]
+    corrupted = [log[base] > 0 for base in bases]
+
+    model = None
+    if mode in ["perplexity", "both"]:
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+        model = load_inference_model(device, weights_path)
+
+    start_time = time.time()
+    suspect = triage_chunks(chunks, mode, model, threshold)
+    elapsed = time.time() - start_time
+
+    true_positives = sum(s and c for s, c in zip(suspect, corrupted))
+    print(f"Triage '{mode}' on {len(chunks)} chunks in {elapsed:.2f}s ({len(chunks)/max(elapsed, 1e-9):.1f} chunks/sec)")
+    print(f"Skipped (clean):   {len(chunks)-sum(suspect)} ({(len(chunks)-sum(suspect))/max(len(chunks), 1):.1%})")
+    print(f"Corrupted flagged: {true_positives}/{sum(corrupted)} (recall {true_positives/max(sum(corrupted), 1):.1%})")
+    print(f"Clean flagged:     {sum(suspect)-true_positives}/{len(chunks)-sum(corrupted)}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Evaluate the chunk triage against a corruption log.")
+    parser.add_argument("--input", required=True, help="Folder with the .input/.output pairs of flip-bits-final.py")
+    parser.add_argument("--log", required=True, help="Corruption log of flip-bits-final.py")
+    parser.add_argument("--mode", default="stuffing", choices=["stuffing", "perplexity", "both"], help="Triage signal")
+    parser.add_argument("--threshold", type=float, default=TRIAGE_THRESHOLD, help="Bits per byte of the worst patch for perplexity")
+
+    args = parser.parse_args()
+    evaluate_triage(args.input, args.log, args.mode, args.threshold)
@@ -1,8 +1,21 @@
+import math
+import types
 import torch
 import random
+import torch.utils.checkpoint
+import inspect
 from config import *
-from transformers import GPT2Model, GPT2LMHeadModel, PreTrainedModel
-from samplings import top_p_sampling, top_k_sampling, temperature_sampling
+from contextlib import contextmanager, nullcontext
+from transformers import GPT2Config, GPT2Model, GPT2LMHeadModel, PreTrainedModel
+from transformers.modeling_utils import Conv1D
+from transformers.models.gpt2.modeling_gpt2 import GPT2PreTrainedModel, GPT2Attention
+from transformers.modeling_outputs import TokenClassifierOutput, CausalLMOutput
+from samplings import sample_logits, copy_unless_confident, sampling_probs, accept_draft
+
+try:
+    from safetensors.torch import save_file, load_file
+except ImportError:
+    save_file = load_file = None
 
 class PatchLevelDecoder(PreTrainedModel):
     """
@@ -15,24 +28,94 @@ class PatchLevelDecoder(PreTrainedModel):
         torch.nn.init.normal_(self.patch_embedding.weight, std=0.02)
         self.base = GPT2Model(config)
 
+    def embed(self,
+              patches: torch.Tensor,
+              embedding_bag=EMBEDDING_BAG) -> torch.Tensor:
+        """
+        Embed the patches. The patch embedding is a Linear over the one-hot bytes of a patch, so it is
+        also the bias plus one weight column per byte, which embedding_bag gathers and sums without
+        building the one-hot tensor (PATCH_SIZE*257 floats per patch).
+        :param patches: the patches to be embedded
+        :param embedding_bag: whether to gather the weight columns instead of multiplying the one-hot bytes
+        :return: the embedded patches
+        """
+        patches = patches.reshape(len(patches), -1, PATCH_SIZE).to(self.device)
+        if not embedding_bag:
+            patches = torch.nn.functional.one_hot(patches, num_classes=256+1).to(self.dtype)
+            patches = patches.reshape(len(patches), -1, PATCH_SIZE * (256+1))
+            return self.patch_embedding(patches)
+
+        # byte b at position i of a patch is column i*257+b of the weight
+        indices = patches + torch.arange(PATCH_SIZE, device=self.device) * (256+1)
+        embeds = torch.nn.functional.embedding_bag(indices.reshape(-1, PATCH_SIZE),
+                                                   self.patch_embedding.weight.t(),
+                                                   mode="sum")
+        embeds = embeds + self.patch_embedding.bias
+        return embeds.reshape(len(patches), -1, embeds.shape[-1])
+
     def forward(self,
                 patches: torch.Tensor,
-                masks=None) -> torch.Tensor:
+                masks=None,
+                past_key_values=None,
+                use_cache=False,
+                position_ids=None) -> torch.Tensor:
         """
         The forward pass of the patch-level decoder model.
         :param patches: the patches to be encoded
-        :param masks: the masks for the patches
+        :param masks: the masks for the patches (including the cached ones when past_key_values is given)
+        :param past_key_values: the cached keys and values of the patches already encoded
+        :param use_cache: whether to return the updated past_key_values
+        :param position_ids: the positions of the patches, needed for left-padded batches
         :return: the encoded patches
         """
-        patches = torch.nn.functional.one_hot(patches, num_classes=256+1).to(self.dtype)
-        patches = patches.reshape(len(patches), -1, PATCH_SIZE * (256+1))
-        patches = self.patch_embedding(patches.to(self.device))
+        patches = self.embed(patches)
 
         if masks==None:
-            return self.base(inputs_embeds=patches)
+            return self.base(inputs_embeds=patches,
+                             past_key_values=past_key_values,
+                             use_cache=use_cache,
+                             position_ids=position_ids)
         else:
             return self.base(inputs_embeds=patches,
-                             attention_mask=masks)
+                             attention_mask=masks,
+                             past_key_values=past_key_values,
+                             use_cache=use_cache,
+                             position_ids=position_ids)
+
+    def forward_packed(self,
+                       patches: torch.Tensor,
+                       segment_ids: torch.Tensor) -> torch.Tensor:
+        """
+        The forward pass of the patch-level decoder over sequences packing several samples.
+        GPT2Model only takes 2D attention masks, so its blocks are run here with a block-diagonal
+        causal mask: the patches of a sample only attend to the patches before them in the same sample,
+        and the positions start again from 0 at every sample.
+        :param patches: the packed patches
+        :param segment_ids: the sample of every patch (1, 2, ... within a sequence, 0 for the padding)
+        :return: the encoded patches
+        """
+        hidden_states = self.embed(patches)
+
+        # position of every patch within its sample
+        segment_ids = segment_ids.to(self.device)
+        indices = torch.arange(segment_ids.shape[1], device=self.device).expand_as(segment_ids)
+        starts = torch.cat((torch.ones_like(segment_ids[:, :1], dtype=torch.bool), segment_ids[:, 1:] != segment_ids[:, :-1]), dim=1)
+        position_ids = indices - torch.where(starts, indices, torch.zeros_like(indices)).cummax(1).values
+        hidden_states = self.base.drop(hidden_states + self.base.wpe(position_ids))
+
+        causal = torch.ones((segment_ids.shape[1], segment_ids.shape[1]), dtype=torch.bool, device=self.device).tril()
+        allowed = (segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)) & causal
+        attention_mask = torch.zeros(allowed.shape, dtype=hidden_states.dtype, device=self.device)
+        attention_mask = attention_mask.masked_fill(~allowed, torch.finfo(hidden_states.dtype).min).unsqueeze(1)
+
+        for block in self.base.h:
+            if self.base.gradient_checkpointing and self.training:
+                hidden_states = torch.utils.checkpoint.checkpoint(lambda hidden_states, block=block: block(hidden_states, attention_mask=attention_mask)[0],
+                                                                  hidden_states,
+                                                                  use_reentrant=False)
+            else:
+                hidden_states = block(hidden_states, attention_mask=attention_mask)[0]
+        return self.base.ln_f(hidden_states)
 
 class ByteLevelDecoder(PreTrainedModel):
     """
@@ -43,61 +126,172 @@ class ByteLevelDecoder(PreTrainedModel):
         super().__init__(config)
         self.special_token_id = 256
         self.base = GPT2LMHeadModel(config)
+        # whether generate runs forward_static instead of GPT2LMHeadModel with a growing cache, see compile_steps
+        self.static_steps = False
 
     def forward(self,
                 encoded_patches: torch.Tensor,
-                target_patches: torch.Tensor):
+                target_patches: torch.Tensor,
+                return_loss=True):
         """
         The forward pass of the byte-level decoder model.
+        The logits of the last position predict nothing, so unlike GPT2LMHeadModel with labels,
+        the lm_head and the loss only run on the PATCH_SIZE positions predicting a target byte.
         :param encoded_patches: the encoded patches
         :param target_patches: the target patches
+        :param return_loss: whether to compute the loss, inference only needs the logits
         :return: the output of the model
         """
-        # preparing the labels for model training
-        target_patches = torch.cat((torch.ones_like(target_patches[:,0:1])*self.special_token_id, target_patches), dim=1)
+        # get input embeddings, the encoded patch takes the place of the special token
+        inputs_embeds = torch.nn.functional.embedding(target_patches[:, :-1], self.base.transformer.wte.weight)
+        inputs_embeds = torch.cat((encoded_patches.unsqueeze(1), inputs_embeds), dim=1)
 
-        # select patches
-        if PATCH_SAMPLING_BATCH_SIZE!=0 and PATCH_SAMPLING_BATCH_SIZE<target_patches.shape[0]:
-            indices = list(range(len(target_patches)))
-            random.shuffle(indices)
-            selected_indices = sorted(indices[:PATCH_SAMPLING_BATCH_SIZE])
+        hidden_states = self.base.transformer(inputs_embeds=inputs_embeds)["last_hidden_state"]
+        logits = self.base.lm_head(hidden_states)
+        if not return_loss:
+            return CausalLMOutput(logits=logits)
+        loss = torch.nn.functional.cross_entropy(logits.reshape(-1, logits.shape[-1]), target_patches.reshape(-1))
 
-            target_patches = target_patches[selected_indices,:]
-            encoded_patches = encoded_patches[selected_indices,:]
+        return CausalLMOutput(loss=loss, logits=logits)
 
-        # get input embeddings
-        inputs_embeds = torch.nn.functional.embedding(target_patches, self.base.transformer.wte.weight)
+    def forward_static(self,
+                       inputs_embeds: torch.Tensor,
+                       keys: torch.Tensor,
+                       values: torch.Tensor,
+                       position: torch.Tensor) -> torch.Tensor:
+        """
+        One step of the byte-level decoder over a static cache: the input at position is written into the
+        cache of the PATCH_SIZE+1 positions of a patch and attends to it, the positions after it masked.
+        The shapes do not change within a patch and position is a tensor, so the step compiles once.
+        :param inputs_embeds: the embedded input of shape (batch, hidden), the encoded patch or the previous token
+        :param keys: the cached keys of shape (layers, batch, heads, PATCH_SIZE+1, head size), updated in place
+        :param values: the cached values, of the same shape, updated in place
+        :param position: the position of the input, a tensor of shape ()
+        :return: the logits of the next token of shape (batch, 257)
+        """
+        transformer = self.base.transformer
+        hidden_states = transformer.drop(inputs_embeds + transformer.wpe(position))
+        mask = (torch.arange(PATCH_SIZE+1, device=position.device) <= position).reshape(1, 1, 1, -1)
+        for layer, block in enumerate(transformer.h):
+            attn = block.attn
+            query, key, value = attn.c_attn(block.ln_1(hidden_states)).split(attn.split_size, dim=-1)
+            shape = (len(hidden_states), attn.num_heads, 1, attn.head_dim)
+            keys[layer].index_copy_(2, position.reshape(1), key.reshape(shape).to(keys.dtype))
+            values[layer].index_copy_(2, position.reshape(1), value.reshape(shape).to(values.dtype))
+            output = torch.nn.functional.scaled_dot_product_attention(query.reshape(shape).to(keys.dtype),
+                                                                      keys[layer],
+                                                                      values[layer],
+                                                                      attn_mask=mask)
+            hidden_states = hidden_states + attn.resid_dropout(attn.c_proj(output.reshape(len(hidden_states), -1)))
+            hidden_states = hidden_states + block.mlp(block.ln_2(hidden_states))
+        return self.base.lm_head(transformer.ln_f(hidden_states))
 
-        # concatenate the encoded patches with the input embeddings
-        inputs_embeds = torch.cat((encoded_patches.unsqueeze(1), inputs_embeds[:,1:,:]), dim=1)
+    def score_patches(self,
+                      encoded_patches: torch.Tensor,
+                      candidates: torch.Tensor) -> torch.Tensor:
+        """
+        The log-probability of every byte of candidate patches, in one pass: causal attention computes
+        every position at once, so a candidate costs one call instead of PATCH_SIZE, and the K candidates
+        of every encoded patch share it. The log-probabilities after a special token in a candidate
+        condition on bytes past its end, they are the caller's to ignore.
+        :param encoded_patches: the features of the previous patches of shape (batch, hidden)
+        :param candidates: the candidate patches of shape (batch, K, PATCH_SIZE), or (K, PATCH_SIZE) for the same
+                           candidates after every encoded patch
+        :return: the log-probabilities of the candidate bytes of shape (batch, K, PATCH_SIZE)
+        """
+        candidates = candidates.to(encoded_patches.device)
+        if candidates.dim() == 2:
+            candidates = candidates.expand(len(encoded_patches), -1, -1)
+        batch_size, num_candidates = candidates.shape[:2]
+        encoded_patches = encoded_patches.unsqueeze(1).expand(-1, num_candidates, -1).reshape(batch_size*num_candidates, -1)
+        candidates = candidates.reshape(batch_size*num_candidates, PATCH_SIZE)
+
+        # the encoded patch takes the place of the special token, like in forward
+        inputs_embeds = torch.nn.functional.embedding(candidates[:, :-1], self.base.transformer.wte.weight)
+        inputs_embeds = torch.cat((encoded_patches.unsqueeze(1), inputs_embeds), dim=1)
+        logits = self.base(inputs_embeds=inputs_embeds).logits
 
-        return self.base(inputs_embeds=inputs_embeds,
-                         labels=target_patches)
+        log_probs = torch.nn.functional.log_softmax(logits.float(), dim=-1)
+        log_probs = log_probs.gather(-1, candidates.unsqueeze(-1)).squeeze(-1)
+        return log_probs.reshape(batch_size, num_candidates, PATCH_SIZE)
+
+    def reorder_cache(self, past_key_values, rows):
+        """
+        Select rows of the cache returned by generate, e.g. the beams kept by beam search.
+        :param past_key_values: the cache of generate, the static one of forward_static included
+        :param rows: the rows to keep, in order
+        :return: the cache of the given rows
+        """
+        if self.static_steps:
+            keys, values, position = past_key_values
+            return keys[:, rows], values[:, rows], position
+        return tuple(tuple(past[rows] for past in layer) for layer in past_key_values)
 
     def generate(self,
                  encoded_patch: torch.Tensor,
-                 tokens: torch.Tensor):
+                 tokens: torch.Tensor,
+                 past_key_values=None,
+                 use_cache=False,
+                 return_logits=False):
         """
         The generate function for generating a patch based on the encoded patch and already generated tokens.
-        :param encoded_patch: the encoded patch
-        :param tokens: already generated tokens in the patch
-        :return: the probability distribution of next token
+        :param encoded_patch: the encoded patch, or a batch of encoded patches
+        :param tokens: already generated tokens in the patch (only the new ones when past_key_values is given)
+        :param past_key_values: the cached keys and values of the encoded patch and the tokens already fed
+        :param use_cache: whether to also return the updated past_key_values
+        :param return_logits: whether to return the logits instead of the probabilities
+        :return: the probability distribution of next token (and the past_key_values if use_cache)
         """
-        encoded_patch = encoded_patch.reshape(1, 1, -1)
-        tokens = tokens.reshape(1, -1)
+        batched = encoded_patch.dim() > 1
+        encoded_patch = encoded_patch.reshape(-1, 1, encoded_patch.shape[-1])
+        tokens = tokens.reshape(len(encoded_patch), -1)
+
+        if self.static_steps:
+            # the cache has the PATCH_SIZE+1 positions of the patch from the start, and the position of the next input
+            if past_key_values==None:
+                transformer = self.base.transformer
+                shape = (len(transformer.h), len(tokens), self.config.n_head, PATCH_SIZE+1, self.config.n_embd//self.config.n_head)
+                past_key_values = (torch.zeros(shape, dtype=encoded_patch.dtype, device=encoded_patch.device),
+                                   torch.zeros(shape, dtype=encoded_patch.dtype, device=encoded_patch.device),
+                                   torch.tensor(0, device=encoded_patch.device))
+                tokens = torch.nn.functional.embedding(tokens[:, 1:], self.base.transformer.wte.weight)
+                inputs_embeds = torch.cat((encoded_patch, tokens), dim=1)
+            else:
+                inputs_embeds = torch.nn.functional.embedding(tokens, self.base.transformer.wte.weight)
+            keys, values, position = past_key_values
+            for idx in range(inputs_embeds.shape[1]):
+                probs = self.forward_static(inputs_embeds[:, idx], keys, values, position).float()
+                position = position + 1
+            if not return_logits:
+                probs = torch.nn.functional.softmax(probs, dim=-1)
+            if not batched:
+                probs = probs.squeeze(0)
+            if use_cache:
+                return probs, (keys, values, position)
+            return probs
 
         # Get input embeddings
         tokens = torch.nn.functional.embedding(tokens, self.base.transformer.wte.weight)
 
-        # Concatenate the encoded patch with the input embeddings
-        tokens = torch.cat((encoded_patch, tokens[:,1:,:]), dim=1)
+        # Concatenate the encoded patch with the input embeddings, it is already in the cache otherwise
+        if past_key_values==None:
+            tokens = torch.cat((encoded_patch, tokens[:,1:,:]), dim=1)
         
         # Get output from model
-        outputs = self.base(inputs_embeds=tokens)
+        outputs = self.base(inputs_embeds=tokens,
+                            past_key_values=past_key_values,
+                            use_cache=use_cache)
         
         # Get probabilities of next token
-        probs = torch.nn.functional.softmax(outputs.logits.squeeze(0)[-1], dim=-1)
+        # in float32, also under bfloat16 autocast
+        probs = outputs.logits[:, -1].float()
+        if not return_logits:
+            probs = torch.nn.functional.softmax(probs, dim=-1)
+        if not batched:
+            probs = probs.squeeze(0)
 
+        if use_cache:
+            return probs, outputs.past_key_values
         return probs
 
 class bGPTLMHeadModel(PreTrainedModel):
@@ -116,36 +310,110 @@ class bGPTLMHeadModel(PreTrainedModel):
 
     def forward(self,
                 patches: torch.Tensor,
-                masks: torch.Tensor):
+                masks: torch.Tensor,
+                output_masks=None):
         """
         The forward pass of the bGPT model.
         :param patches: the patches to be encoded
-        :param masks: the masks for the patches
+        :param masks: the masks for the patches, or the segment ids of packed samples (1, 2, ... within a sequence, 0 for the padding)
+        :param output_masks: the output patches of conversion pairs, the only ones sampled with PATCH_SAMPLING_TARGETS
         :return: the decoded patches
         """
         patches = patches.reshape(len(patches), -1, PATCH_SIZE)
-        encoded_patches = self.patch_level_decoder(patches, masks)["last_hidden_state"]
-        
-        left_shift_masks = masks * (masks.flip(1).cumsum(1).flip(1) > 1)
-        masks[:, 0] = 0
-        
-        encoded_patches = encoded_patches[left_shift_masks == 1]
-        patches = patches[masks == 1]
+        if masks.max() > 1:
+            encoded_patches = self.patch_level_decoder.forward_packed(patches, masks)
+        else:
+            encoded_patches = self.patch_level_decoder(patches, masks)["last_hidden_state"]
+
+        # every patch predicts the next one of the same sample
+        targets = (masks[:, 1:] == masks[:, :-1]) & (masks[:, 1:] != 0)
+        if PATCH_SAMPLING_BATCH_SIZE != 0 and self.training:
+            if PATCH_SAMPLING_TARGETS and output_masks is not None:
+                targets &= output_masks[:, 1:] == 1
+            targets = sample_targets(targets, masks[:, 1:], PATCH_SAMPLING_BATCH_SIZE)
+        encoded_patches = encoded_patches[:, :-1][targets]
+        patches = patches[:, 1:][targets]
         
         return self.byte_level_decoder(encoded_patches, patches)
-        
+
+    def score(self,
+              patches: torch.Tensor,
+              masks=None):
+        """
+        The teacher-forced log-probability of every byte, from one pass of both decoders.
+        :param patches: the right-padded patches of shape (batch, length*PATCH_SIZE), starting with a bos patch
+        :param masks: the masks for the patches of shape (batch, length)
+        :return: the log-probabilities of the bytes of every patch but the first, of shape (batch, length-1, PATCH_SIZE)
+        """
+        patches = patches.reshape(len(patches), -1, PATCH_SIZE).to(self.device)
+        if masks is not None:
+            masks = masks.to(self.device)
+        encoded_patches = self.patch_level_decoder(patches, masks)["last_hidden_state"]
+        return self.score_encoded(encoded_patches, patches)
+
+    def score_encoded(self,
+                      encoded_patches: torch.Tensor,
+                      patches: torch.Tensor):
+        """
+        The teacher-forced log-probability of every byte, given the patch-level features.
+        :param encoded_patches: the encoded patches of shape (batch, length, hidden)
+        :param patches: the patches of shape (batch, length, PATCH_SIZE)
+        :return: the log-probabilities of the bytes of every patch but the first, of shape (batch, length-1, PATCH_SIZE)
+        """
+        # every patch is predicted from the features of the previous one, like in forward
+        batch_size = len(patches)
+        encoded_patches = encoded_patches[:, :-1].reshape(-1, encoded_patches.shape[-1])
+        target_patches = patches[:, 1:].reshape(-1, 1, PATCH_SIZE)
+        log_probs = self.byte_level_decoder.score_patches(encoded_patches, target_patches)
+        return log_probs.reshape(batch_size, -1, PATCH_SIZE)
+
+    def score_candidates(self,
+                         patches: torch.Tensor,
+                         masks: torch.Tensor,
+                         candidates: torch.Tensor):
+        """
+        Score K candidates for the patch following every sequence, e.g. to rank repairs of a corrupted patch.
+        The sequences are encoded once and all candidates go through the byte-level decoder in one pass.
+        :param patches: the right-padded patches of shape (batch, length*PATCH_SIZE), starting with a bos patch
+        :param masks: the masks for the patches of shape (batch, length)
+        :param candidates: the candidate patches of shape (batch, K, PATCH_SIZE), or (K, PATCH_SIZE) for every sequence
+        :return: the log-probabilities of the candidate bytes of shape (batch, K, PATCH_SIZE)
+        """
+        patches = patches.reshape(len(patches), -1, PATCH_SIZE).to(self.device)
+        masks = masks.to(self.device)
+        encoded_patches = self.patch_level_decoder(patches, masks)["last_hidden_state"]
+        # the features of the last patch of every sequence predict the next one
+        encoded_patches = encoded_patches[torch.arange(len(patches), device=self.device), masks.sum(1) - 1]
+        return self.byte_level_decoder.score_patches(encoded_patches, candidates)
+
     def generate(self,
                  patches: torch.Tensor,
                  top_k=0,
                  top_p=1,
-                 temperature=1.0):
+                 temperature=1.0,
+                 past_key_values=None,
+                 use_cache=False,
+                 generator=None,
+                 decoding="sample",
+                 reference=None,
+                 copy_threshold=0.9,
+                 speculative=False):
         """
         The generate function for generating patches based on patches.
-        :param patches: the patches to be encoded
+        Both decoders feed only their newest inputs to GPT2: the byte-level decoder always reuses its
+        cache within the patch, and the patch-level decoder reuses past_key_values across calls.
+        :param patches: the patches to be encoded (only the new ones when past_key_values is given)
         :param top_k: the top k for sampling
         :param top_p: the top p for sampling
         :param temperature: the temperature for sampling
-        :return: the generated patches
+        :param past_key_values: the patch-level cache returned by the previous call with use_cache
+        :param use_cache: whether to also return the updated patch-level past_key_values
+        :param generator: the torch.Generator used for sampling
+        :param decoding: "sample", "greedy" (argmax of the logits) or "copy" (reference unless confident)
+        :param reference: the reference bytes of the patch for "copy" decoding, 256 past their end
+        :param copy_threshold: the probability needed to override the reference in "copy" decoding
+        :param speculative: whether to verify the reference as a draft, see generate_speculative
+        :return: the generated patches (and the past_key_values if use_cache)
         """
         if patches.shape[-1]%PATCH_SIZE!=0:
             tokens = patches[:,:,-(patches.shape[-1]%PATCH_SIZE):].squeeze(0).squeeze(0)
@@ -155,22 +423,841 @@ class bGPTLMHeadModel(PreTrainedModel):
             tokens = torch.tensor([self.special_token_id], device=self.device)
             
         patches = patches.reshape(len(patches), -1, PATCH_SIZE)
-        encoded_patches = self.patch_level_decoder(patches)["last_hidden_state"]
-        generated_patch = []            
+        outputs = self.patch_level_decoder(patches,
+                                           past_key_values=past_key_values,
+                                           use_cache=use_cache)
+        encoded_patches = outputs["last_hidden_state"]
+        generated_patch = []
+        byte_past_key_values = None
+        new_tokens = tokens
+
+        if speculative and reference is not None:
+            # the bytes of the patch given in patches, then the reference bytes after them, are the draft
+            draft = torch.cat((tokens[1:], reference.to(self.device)[len(tokens)-1:PATCH_SIZE]))
+            draft = torch.nn.functional.pad(draft, (0, PATCH_SIZE - len(draft)), value=self.special_token_id)
+            patch, _ = self.generate_speculative(encoded_patches[0][-1].unsqueeze(0),
+                                                 draft.unsqueeze(0),
+                                                 prefix_length=len(tokens)-1,
+                                                 top_k=top_k,
+                                                 top_p=top_p,
+                                                 temperature=temperature,
+                                                 generator=generator,
+                                                 decoding=decoding,
+                                                 copy_threshold=copy_threshold)
+            for token in patch[0, len(tokens)-1:].tolist():
+                generated_patch.append(token)
+                if token == self.special_token_id:
+                    break
+            if use_cache:
+                return generated_patch, outputs["past_key_values"]
+            return generated_patch
 
         while True:
-            prob = self.byte_level_decoder.generate(encoded_patches[0][-1], tokens).cpu().detach().numpy()
-            prob = top_k_sampling(prob, top_k=top_k, return_probs=True)
-            prob = top_p_sampling(prob, top_p=top_p, return_probs=True)
-            token = temperature_sampling(prob, temperature=temperature)
+            logits, byte_past_key_values = self.byte_level_decoder.generate(encoded_patches[0][-1],
+                                                                            new_tokens,
+                                                                            past_key_values=byte_past_key_values,
+                                                                            use_cache=True,
+                                                                            return_logits=True)
+            if reference is not None:
+                byte_idx = len(tokens) - 1
+                references = reference[byte_idx] if byte_idx < len(reference) else torch.tensor(self.special_token_id, device=self.device)
+            else:
+                references = None
+            token = int(select_tokens(logits,
+                                      decoding=decoding,
+                                      references=references,
+                                      copy_threshold=copy_threshold,
+                                      top_k=top_k,
+                                      top_p=top_p,
+                                      temperature=temperature,
+                                      generator=generator))
             generated_patch.append(token)
             if token == self.special_token_id or len(tokens) >= PATCH_SIZE:
                 break
             else:
-                tokens = torch.cat((tokens, torch.tensor([token], device=self.device)), dim=0)
+                new_tokens = torch.tensor([token], device=self.device)
+                tokens = torch.cat((tokens, new_tokens), dim=0)
         
+        if use_cache:
+            return generated_patch, outputs["past_key_values"]
         return generated_patch
 
+    def generate_batch(self,
+                       patches: torch.Tensor,
+                       masks: torch.Tensor,
+                       top_k=0,
+                       top_p=1,
+                       temperature=1.0,
+                       generator=None,
+                       decoding="sample",
+                       references=None,
+                       copy_threshold=0.9,
+                       max_patches=None,
+                       sliding_window=0,
+                       speculative=False):
+        """
+        The generate function for continuing a batch of left-padded sequences at once.
+        Each sequence stops on its own when it emits the special token or reaches PATCH_LENGTH,
+        and is then dropped from the batch (and the caches) while the rest continues.
+        With sliding_window, the oldest input patches are dropped up front (slide_prompt) so that an output
+        as long as the input fits, like the pairs of training. A sequence still reaching PATCH_LENGTH keeps
+        going: the oldest patches after its first (bos) patch are dropped, sliding_window patches at once,
+        and the remaining sequences are encoded again, since their positions change.
+        :param patches: the left-padded patches of shape (batch, length*PATCH_SIZE)
+        :param masks: the masks for the patches of shape (batch, length)
+        :param top_k: the top k for sampling
+        :param top_p: the top p for sampling
+        :param temperature: the temperature for sampling
+        :param generator: the torch.Generator used for sampling
+        :param decoding: "sample", "greedy" (argmax of the logits) or "copy" (reference unless confident)
+        :param references: the reference bytes of each sequence for "copy" decoding, padded with 256
+        :param copy_threshold: the probability needed to override the reference in "copy" decoding
+        :param max_patches: the maximum number of patches generated per sequence, None for no limit
+        :param sliding_window: the number of patches dropped at once when a sequence reaches PATCH_LENGTH, 0 to stop it
+        :param speculative: whether to verify the references as drafts, see generate_speculative
+        :return: the generated bytes of each sequence, without the special token
+        """
+        patches = patches.reshape(len(patches), -1, PATCH_SIZE).to(self.device)
+        masks = masks.to(self.device)
+        prompts = [patches[row][masks[row] == 1] for row in range(len(patches))]
+        if sliding_window:
+            # the output of a repair is as long as its input, the prompt without its two bos patches
+            prompts = [slide_prompt(prompt, len(prompt) - 2) for prompt in prompts]
+            patches, masks = pad_byte_lists([prompt.reshape(-1).tolist() for prompt in prompts])
+            patches = patches.reshape(len(patches), -1, PATCH_SIZE).to(self.device)
+            masks = masks.to(self.device)
+        dropped = [0] * len(patches)
+        position_ids = (masks.cumsum(1) - 1).clamp(min=0)
+        outputs = self.patch_level_decoder(patches,
+                                           masks,
+                                           use_cache=True,
+                                           position_ids=position_ids)
+        encoded_patches = outputs["last_hidden_state"][:, -1]
+        past_key_values = outputs["past_key_values"]
+        positions = position_ids[:, -1] + 1
+
+        def select_rows(rows, masks, past_key_values):
+            # keep the given rows, and drop the leading padding no remaining row needs anymore
+            masks = masks[rows]
+            offset = int((masks.max(0).values.cumsum(0) == 0).sum())
+            masks = masks[:, offset:]
+            past_key_values = tuple(tuple(past[rows, :, offset:] for past in layer) for layer in past_key_values)
+            return masks, past_key_values
+
+        def encode_windows(rows, sliding):
+            # encode the prompt and generated patches of the given rows, the sliding ones drop more of their oldest patches after the first
+            windows = []
+            for row, slide in zip(rows.tolist(), sliding.tolist()):
+                sequence = torch.cat((prompts[row], torch.tensor(generated[row], dtype=torch.long, device=self.device).reshape(-1, PATCH_SIZE)))
+                if slide:
+                    dropped[row] = len(sequence) - PATCH_LENGTH + sliding_window
+                windows.append(torch.cat((sequence[:1], sequence[1+dropped[row]:])))
+            length = max(len(window) for window in windows)
+            window_patches = torch.full((len(windows), length, PATCH_SIZE), self.special_token_id, device=self.device)
+            window_masks = torch.zeros((len(windows), length), dtype=torch.long, device=self.device)
+            for i, window in enumerate(windows):
+                window_patches[i, length-len(window):] = window
+                window_masks[i, length-len(window):] = 1
+            position_ids = (window_masks.cumsum(1) - 1).clamp(min=0)
+            outputs = self.patch_level_decoder(window_patches,
+                                               window_masks,
+                                               use_cache=True,
+                                               position_ids=position_ids)
+            return outputs["last_hidden_state"][:, -1], window_masks, outputs["past_key_values"], position_ids[:, -1] + 1
+
+        generated = [[] for _ in range(len(patches))]
+        active = (positions < PATCH_LENGTH).nonzero().squeeze(1)
+        encoded_patches = encoded_patches[active]
+        positions = positions[active]
+        masks, past_key_values = select_rows(active, masks, past_key_values)
+        if references is not None:
+            # one extra column so that copying past the end emits the special token
+            references = references.to(self.device)
+            references = torch.cat((references, torch.full_like(references[:, :1], self.special_token_id)), dim=1)
+        patch_idx = 0
+
+        while len(active) > 0:
+            # generate one patch for every active sequence
+            finished = torch.zeros(len(active), dtype=torch.bool)
+            if speculative and references is not None:
+                # the reference bytes of the patch are the draft
+                drafts = references[active, patch_idx*PATCH_SIZE:(patch_idx+1)*PATCH_SIZE]
+                drafts = torch.nn.functional.pad(drafts, (0, PATCH_SIZE - drafts.shape[1]), value=self.special_token_id)
+                patch_tokens, _ = self.generate_speculative(encoded_patches,
+                                                            drafts,
+                                                            top_k=top_k,
+                                                            top_p=top_p,
+                                                            temperature=temperature,
+                                                            generator=generator,
+                                                            decoding=decoding,
+                                                            copy_threshold=copy_threshold)
+                for row, patch in enumerate(patch_tokens.tolist()):
+                    for token in patch:
+                        if token == self.special_token_id:
+                            finished[row] = True
+                            break
+                        generated[active[row]].append(token)
+                new_patches = list(patch_tokens.unbind(1))
+            else:
+                new_patches = []
+                tokens = torch.full((len(active), 1), self.special_token_id, device=self.device)
+                byte_past_key_values = None
+                for byte_idx in range(PATCH_SIZE):
+                    logits, byte_past_key_values = self.byte_level_decoder.generate(encoded_patches,
+                                                                                    tokens,
+                                                                                    past_key_values=byte_past_key_values,
+                                                                                    use_cache=True,
+                                                                                    return_logits=True)
+                    if references is not None:
+                        ref_idx = min(patch_idx*PATCH_SIZE + byte_idx, references.shape[1] - 1)
+                        ref_tokens = references[active, ref_idx]
+                    else:
+                        ref_tokens = None
+                    new_tokens = select_tokens(logits,
+                                               decoding=decoding,
+                                               references=ref_tokens,
+                                               copy_threshold=copy_threshold,
+                                               top_k=top_k,
+                                               top_p=top_p,
+                                               temperature=temperature,
+                                               generator=generator)
+                    for row, token in enumerate(new_tokens.tolist()):
+                        if not finished[row]:
+                            if token == self.special_token_id:
+                                finished[row] = True
+                            else:
+                                generated[active[row]].append(token)
+                    new_patches.append(new_tokens)
+                    if finished.all():
+                        break
+                    tokens = new_tokens.unsqueeze(1)
+
+            patch_idx += 1
+
+            # drop the finished sequences, and those running out of positions unless the window slides
+            out_of_positions = (positions + 1 >= PATCH_LENGTH).cpu()
+            if not sliding_window:
+                finished |= out_of_positions
+            if max_patches is not None and patch_idx >= max_patches:
+                break
+            keep = (~finished).nonzero().squeeze(1).to(self.device)
+            if len(keep) == 0:
+                break
+            new_patches = torch.stack(new_patches, dim=1)[keep]
+            active = active[keep]
+            positions = positions[keep]
+            if out_of_positions[keep.cpu()].any():
+                encoded_patches, masks, past_key_values, positions = encode_windows(active, out_of_positions[keep.cpu()])
+                continue
+            masks, past_key_values = select_rows(keep, masks, past_key_values)
+            masks = torch.cat((masks, torch.ones_like(masks[:, :1])), dim=1)
+
+            # encode only the newest patch of every remaining sequence
+            outputs = self.patch_level_decoder(new_patches.unsqueeze(1),
+                                               masks,
+                                               past_key_values=past_key_values,
+                                               use_cache=True,
+                                               position_ids=positions.unsqueeze(1))
+            encoded_patches = outputs["last_hidden_state"][:, -1]
+            past_key_values = outputs["past_key_values"]
+            positions = positions + 1
+
+        return generated
+
+    def generate_patch(self,
+                       encoded_patch: torch.Tensor,
+                       reference: torch.Tensor,
+                       top_k=0,
+                       top_p=1,
+                       temperature=1.0,
+                       generator=None,
+                       decoding="sample",
+                       copy_threshold=0.9,
+                       speculative=False):
+        """
+        Generate the bytes of one patch in place of a reference patch.
+        If the special token comes early, the rest of the patch is taken from the reference, so it keeps its length.
+        :param encoded_patch: the features of the previous patch
+        :param reference: the reference patch of PATCH_SIZE bytes, also used by "copy" decoding
+        :param speculative: whether to verify the reference as a draft, see generate_speculative
+        :return: the generated patch of PATCH_SIZE bytes
+        """
+        if speculative:
+            patch, _ = self.generate_speculative(encoded_patch.unsqueeze(0),
+                                                 reference.unsqueeze(0),
+                                                 top_k=top_k,
+                                                 top_p=top_p,
+                                                 temperature=temperature,
+                                                 generator=generator,
+                                                 decoding=decoding,
+                                                 copy_threshold=copy_threshold)
+            ended = (patch[0] == self.special_token_id).int().cumsum(0) > 0
+            return torch.where(ended, reference, patch[0])
+
+        patch = reference.clone()
+        tokens = torch.full((1, 1), self.special_token_id, device=self.device)
+        byte_past_key_values = None
+        for byte_idx in range(PATCH_SIZE):
+            logits, byte_past_key_values = self.byte_level_decoder.generate(encoded_patch.unsqueeze(0),
+                                                                            tokens,
+                                                                            past_key_values=byte_past_key_values,
+                                                                            use_cache=True,
+                                                                            return_logits=True)
+            new_tokens = select_tokens(logits,
+                                       decoding=decoding,
+                                       references=reference[byte_idx:byte_idx+1],
+                                       copy_threshold=copy_threshold,
+                                       top_k=top_k,
+                                       top_p=top_p,
+                                       temperature=temperature,
+                                       generator=generator)
+            if int(new_tokens) == self.special_token_id:
+                break
+            patch[byte_idx] = new_tokens[0]
+            tokens = new_tokens.unsqueeze(1)
+        return patch
+
+    def generate_speculative(self,
+                             encoded_patches: torch.Tensor,
+                             drafts: torch.Tensor,
+                             prefix_length=0,
+                             top_k=0,
+                             top_p=1,
+                             temperature=1.0,
+                             generator=None,
+                             decoding="sample",
+                             copy_threshold=0.9):
+        """
+        Generate one patch per row with the draft bytes (the corrupted input) verified in parallel.
+        Every pass of the byte-level decoder scores the whole draft at once: the draft bytes up to the first
+        the decoding rejects are kept, that byte is replaced, and the next pass verifies the rest of the draft
+        after it. "sample" keeps a draft byte with the probability the model gives it and otherwise draws
+        from the model without it (accept_draft), so the patches follow the same distribution as decoding
+        byte by byte; "greedy" and "copy" give the same bytes. A lightly corrupted patch takes one pass per
+        corrupted byte plus one instead of PATCH_SIZE.
+        :param encoded_patches: the features of the previous patches of shape (batch, hidden)
+        :param drafts: the draft patches of shape (batch, PATCH_SIZE), 256 past the end of the input
+        :param prefix_length: the number of leading draft bytes that are given, not verified
+        :return: the patches of shape (batch, PATCH_SIZE), the draft bytes after a special token are left
+                 as they are, and the number of byte-level decoder passes
+        """
+        tokens = drafts.to(self.device).clone()
+        positions = torch.arange(PATCH_SIZE, device=self.device)
+        starts = torch.full((len(tokens),), prefix_length, device=self.device)
+        rows = torch.arange(len(tokens), device=self.device)
+        num_passes = 0
+
+        while len(rows) > 0:
+            logits = self.byte_level_decoder(encoded_patches[rows], tokens[rows], return_loss=False).logits
+            num_passes += 1
+            if decoding == "sample":
+                probs = sampling_probs(logits, top_k=top_k, top_p=top_p, temperature=temperature)
+                accepted, choices = accept_draft(probs, tokens[rows], generator=generator)
+            else:
+                choices = select_tokens(logits.reshape(-1, logits.shape[-1]),
+                                        decoding=decoding,
+                                        references=tokens[rows].reshape(-1),
+                                        copy_threshold=copy_threshold).reshape(tokens[rows].shape)
+                accepted = choices == tokens[rows]
+
+            # the bytes before the start are decided, the first rejected one after it is replaced
+            rejected = ~accepted & (positions >= starts[rows].unsqueeze(1))
+            firsts = torch.where(rejected.any(1), rejected.int().argmax(1), PATCH_SIZE)
+            # a special token before the first rejection ends the patch there
+            ended = ((tokens[rows] == self.special_token_id) & (positions < firsts.unsqueeze(1))).any(1)
+            replace = ~ended & (firsts < PATCH_SIZE)
+            tokens[rows[replace], firsts[replace]] = choices[replace, firsts[replace]]
+            ended |= replace & (tokens[rows, firsts.clamp(max=PATCH_SIZE-1)] == self.special_token_id)
+            starts[rows] = firsts + 1
+            rows = rows[~ended & (firsts + 1 < PATCH_SIZE)]
+
+        return tokens, num_passes
+
+    def generate_localized(self,
+                           patches: torch.Tensor,
+                           masks: torch.Tensor,
+                           references: torch.Tensor,
+                           threshold=2.0,
+                           top_k=0,
+                           top_p=1,
+                           temperature=1.0,
+                           generator=None,
+                           decoding="sample",
+                           copy_threshold=0.9,
+                           sliding_window=0,
+                           speculative=False):
+        """
+        Repair sequences by regenerating only the output patches the model finds unlikely, copying the rest.
+        The references are teacher-forced as the output in one pass of both decoders. The patches scoring
+        above threshold bits per byte are regenerated in order, each conditioned on the repaired patches
+        before it, reusing the patch-level cache of the scoring pass up to the first of them.
+        Patches past PATCH_LENGTH cannot be scored and are copied, unless sliding_window drops the
+        oldest input patches after the first (bos) patch to make room for them.
+        Unlike generate_batch, the sequences are repaired one at a time, each with its own cache.
+        :param patches: the left-padded patches of shape (batch, length*PATCH_SIZE), ending with the target bos patch
+        :param masks: the masks for the patches of shape (batch, length)
+        :param references: the reference bytes of each sequence, padded with 256
+        :param threshold: the bits per byte above which an output patch is regenerated
+        :param top_k: the top k for sampling
+        :param top_p: the top p for sampling
+        :param temperature: the temperature for sampling
+        :param generator: the torch.Generator used for sampling
+        :param decoding: "sample", "greedy" (argmax of the logits) or "copy" (reference unless confident)
+        :param copy_threshold: the probability needed to override the reference in "copy" decoding
+        :param sliding_window: whether to drop the oldest input patches when the sequence is longer than PATCH_LENGTH
+        :param speculative: whether to verify the reference patches as drafts, see generate_speculative
+        :return: the repaired bytes of each sequence (as long as its reference), and the number of regenerated patches of each
+        """
+        patches = patches.reshape(len(patches), -1, PATCH_SIZE).to(self.device)
+        masks = masks.to(self.device)
+        references = references.to(self.device)
+        repaired_bytes = []
+        regenerated = []
+
+        for row in range(len(patches)):
+            prefix = patches[row][masks[row] == 1]
+            reference_len = int((references[row] != self.special_token_id).sum())
+            num_patches = -(-reference_len // PATCH_SIZE)
+            reference = references[row, :num_patches*PATCH_SIZE]
+            reference = torch.cat((reference, torch.full((num_patches*PATCH_SIZE - len(reference),), self.special_token_id, device=self.device)))
+            reference_patches = reference.reshape(-1, PATCH_SIZE)
+
+            if sliding_window:
+                prefix = slide_prompt(prefix, num_patches)
+
+            # score the references as the output, up to the eos patch
+            eos_patch = torch.full((1, PATCH_SIZE), self.special_token_id, device=self.device)
+            sequence = torch.cat((prefix, reference_patches, eos_patch))[:PATCH_LENGTH].unsqueeze(0)
+            outputs = self.patch_level_decoder(sequence, use_cache=True)
+            encoded_patches = outputs["last_hidden_state"]
+            bits = -self.score_encoded(encoded_patches, sequence)[0].mean(-1) / math.log(2)
+            start = len(prefix)
+            flagged = (bits[start-1:start-1+num_patches] > threshold).tolist()
+            flagged = flagged + [False] * (num_patches - len(flagged))
+            flagged_idx = [idx for idx, flag in enumerate(flagged) if flag]
+
+            repaired = reference_patches.clone()
+            if len(flagged_idx) > 0:
+                # the cache of the scoring pass holds until the first regenerated patch
+                past_key_values = tuple(tuple(past[:, :, :start+flagged_idx[0]] for past in layer) for layer in outputs["past_key_values"])
+                encoded_patch = encoded_patches[0, start+flagged_idx[0]-1]
+                idx = flagged_idx[0]
+                while True:
+                    if flagged[idx]:
+                        repaired[idx] = self.generate_patch(encoded_patch,
+                                                            reference_patches[idx],
+                                                            top_k=top_k,
+                                                            top_p=top_p,
+                                                            temperature=temperature,
+                                                            generator=generator,
+                                                            decoding=decoding,
+                                                            copy_threshold=copy_threshold,
+                                                            speculative=speculative)
+                        end = idx + 1
+                    else:
+                        # a run of copied patches is encoded at once
+                        end = next(flagged_idx_ for flagged_idx_ in flagged_idx if flagged_idx_ > idx)
+                    if end > flagged_idx[-1]:
+                        break
+                    outputs = self.patch_level_decoder(repaired[idx:end].unsqueeze(0),
+                                                       past_key_values=past_key_values,
+                                                       use_cache=True)
+                    encoded_patch = outputs["last_hidden_state"][0, -1]
+                    past_key_values = outputs["past_key_values"]
+                    idx = end
+
+            repaired_bytes.append(repaired.reshape(-1)[:reference_len].tolist())
+            regenerated.append(len(flagged_idx))
+
+        return repaired_bytes, regenerated
+
+    def generate_beam(self,
+                      patches: torch.Tensor,
+                      masks: torch.Tensor,
+                      beam_width=4,
+                      jpeg_stuffing=True,
+                      max_patches=None,
+                      sliding_window=0,
+                      length_penalty=1.0):
+        """
+        Beam search for a batch of left-padded sequences, keeping the beam_width most likely continuations
+        of every sequence, byte by byte. Beams are ranked by the sum of their log-probabilities divided by
+        their number of generated tokens (the special token included) to the power length_penalty: a beam
+        that ended keeps its score while the others add negative log-probabilities, so without the division
+        the shortest beams, i.e. truncated chunks, would always win.
+        The beams of all sequences are the rows of one batch: every byte costs one pass of the byte-level
+        decoder and every patch one pass of the patch-level decoder, whatever the beam width.
+        With jpeg_stuffing, the continuations breaking the byte stuffing of entropy-coded JPEG data (0xFF
+        followed by anything but 0x00 or a restart marker) are pruned as they are generated.
+        A sequence stops when all its beams have emitted the special token, or like in generate_batch.
+        :param patches: the left-padded patches of shape (batch, length*PATCH_SIZE)
+        :param masks: the masks for the patches of shape (batch, length)
+        :param beam_width: the number of beams of every sequence
+        :param jpeg_stuffing: whether to prune the beams breaking the JPEG byte stuffing
+        :param max_patches: the maximum number of patches generated per sequence, None for no limit
+        :param sliding_window: the number of patches dropped at once when a sequence reaches PATCH_LENGTH, 0 to stop it
+        :param length_penalty: the exponent of the length normalization, 0 to rank by the sum of log-probabilities
+        :return: the generated bytes of the best beam of each sequence, without the special token
+        """
+        patches = patches.reshape(len(patches), -1, PATCH_SIZE).to(self.device)
+        masks = masks.to(self.device)
+        prompts = [patches[row][masks[row] == 1] for row in range(len(patches))]
+        if sliding_window:
+            # the output of a repair is as long as its input, the prompt without its two bos patches
+            prompts = [slide_prompt(prompt, len(prompt) - 2) for prompt in prompts]
+            patches, masks = pad_byte_lists([prompt.reshape(-1).tolist() for prompt in prompts])
+            patches = patches.reshape(len(patches), -1, PATCH_SIZE).to(self.device)
+            masks = masks.to(self.device)
+        dropped = [0] * len(patches)
+        results = [[] for _ in range(len(patches))]
+        position_ids = (masks.cumsum(1) - 1).clamp(min=0)
+        outputs = self.patch_level_decoder(patches,
+                                           masks,
+                                           use_cache=True,
+                                           position_ids=position_ids)
+
+        # row s*beam_width+k is beam k of the s-th remaining sequence
+        sequences = torch.arange(len(patches), device=self.device)
+        encoded_patches = outputs["last_hidden_state"][:, -1].repeat_interleave(beam_width, 0)
+        past_key_values = tuple(tuple(past.repeat_interleave(beam_width, 0) for past in layer) for layer in outputs["past_key_values"])
+        masks = masks.repeat_interleave(beam_width, 0)
+        positions = (position_ids[:, -1] + 1).repeat_interleave(beam_width, 0)
+        # only the first beam of every sequence is alive at the start, so that the beams differ
+        scores = torch.full((len(patches), beam_width), float('-inf'), device=self.device)
+        scores[:, 0] = 0
+        scores = scores.reshape(-1)
+        generated = torch.zeros((len(scores), 0), dtype=torch.long, device=self.device)
+        # the number of tokens generated by every beam, which stops growing once it ended
+        lengths = torch.zeros(len(scores), device=self.device)
+        finished = torch.zeros(len(scores), dtype=torch.bool, device=self.device)
+        last_bytes = torch.full((len(scores),), -1, device=self.device)
+        patch_idx = 0
+
+        def finish(done):
+            # keep the best beam of the sequences done, and the rows of the others
+            for sequence_idx in done.nonzero().squeeze(1).tolist():
+                rows = slice(sequence_idx*beam_width, (sequence_idx+1)*beam_width)
+                row = sequence_idx * beam_width + int((scores[rows] / lengths[rows].clamp(min=1)**length_penalty).argmax())
+                tokens = generated[row].tolist()
+                sequence = int(sequences[sequence_idx])
+                results[sequence] = tokens[:tokens.index(self.special_token_id)] if self.special_token_id in tokens else tokens
+            return (~done).repeat_interleave(beam_width).nonzero().squeeze(1)
+
+        while len(sequences) > 0:
+            # extend every beam by one byte at a time, keeping the beam_width best of every sequence
+            origins = torch.arange(len(scores), device=self.device)
+            patch_tokens = torch.zeros((len(scores), 0), dtype=torch.long, device=self.device)
+            tokens = torch.full((len(scores), 1), self.special_token_id, device=self.device)
+            byte_past_key_values = None
+            for byte_idx in range(PATCH_SIZE):
+                logits, byte_past_key_values = self.byte_level_decoder.generate(encoded_patches,
+                                                                                tokens,
+                                                                                past_key_values=byte_past_key_values,
+                                                                                use_cache=True,
+                                                                                return_logits=True)
+                log_probs = torch.nn.functional.log_softmax(logits, dim=-1)
+                if jpeg_stuffing:
+                    log_probs = log_probs.masked_fill(~stuffing_mask(last_bytes), float('-inf'))
+                # a finished beam only continues with the special token, at no cost
+                log_probs[finished] = float('-inf')
+                log_probs[finished, self.special_token_id] = 0
+
+                candidates = (scores.unsqueeze(1) + log_probs).reshape(len(sequences), -1)
+                candidate_lengths = (lengths + (~finished).float()).unsqueeze(1).expand_as(log_probs).reshape(len(sequences), -1)
+                _, indices = (candidates / candidate_lengths**length_penalty).topk(beam_width, dim=1)
+                scores = candidates.gather(1, indices).reshape(-1)
+                lengths = candidate_lengths.gather(1, indices).reshape(-1)
+                beams = (indices // log_probs.shape[-1] + torch.arange(len(sequences), device=self.device).unsqueeze(1) * beam_width).reshape(-1)
+                new_tokens = (indices % log_probs.shape[-1]).reshape(-1)
+
+                origins = origins[beams]
+                patch_tokens = torch.cat((patch_tokens[beams], new_tokens.unsqueeze(1)), dim=1)
+                last_bytes = torch.where(new_tokens == self.special_token_id, last_bytes[beams], new_tokens)
+                finished = finished[beams] | (new_tokens == self.special_token_id)
+                byte_past_key_values = self.byte_level_decoder.reorder_cache(byte_past_key_values, beams)
+                tokens = new_tokens.unsqueeze(1)
+                if finished.all():
+                    break
+            patch_tokens = torch.nn.functional.pad(patch_tokens, (0, PATCH_SIZE - patch_tokens.shape[1]), value=self.special_token_id)
+            generated = torch.cat((generated[origins], patch_tokens), dim=1)
+            past_key_values = tuple(tuple(past[origins] for past in layer) for layer in past_key_values)
+            masks = masks[origins]
+            patch_idx += 1
+
+            # the beams of a sequence share its positions
+            done = finished.reshape(-1, beam_width).all(1)
+            out_of_positions = (positions + 1 >= PATCH_LENGTH).reshape(-1, beam_width)[:, 0]
+            if not sliding_window:
+                done |= out_of_positions
+            if max_patches is not None and patch_idx >= max_patches:
+                done[:] = True
+            keep = finish(done)
+            sequences = sequences[~done]
+            out_of_positions = out_of_positions[~done]
+            generated, finished, last_bytes, scores, lengths = generated[keep], finished[keep], last_bytes[keep], scores[keep], lengths[keep]
+            masks, positions = masks[keep], positions[keep]
+            past_key_values = tuple(tuple(past[keep] for past in layer) for layer in past_key_values)
+            if len(sequences) == 0:
+                break
+
+            if out_of_positions.any():
+                # encode the beams again, those of the sequences out of positions without more of their oldest patches
+                for sequence_idx, sequence in enumerate(sequences.tolist()):
+                    if out_of_positions[sequence_idx]:
+                        dropped[sequence] = len(prompts[sequence]) + generated.shape[1] // PATCH_SIZE - PATCH_LENGTH + sliding_window
+                windows = []
+                for row in range(len(generated)):
+                    sequence = int(sequences[row // beam_width])
+                    window = torch.cat((prompts[sequence], generated[row].reshape(-1, PATCH_SIZE)))
+                    windows.append(torch.cat((window[:1], window[1+dropped[sequence]:])))
+                window_patches, masks = pad_byte_lists([window.reshape(-1).tolist() for window in windows])
+                masks = masks.to(self.device)
+                position_ids = (masks.cumsum(1) - 1).clamp(min=0)
+                outputs = self.patch_level_decoder(window_patches.to(self.device),
+                                                   masks,
+                                                   use_cache=True,
+                                                   position_ids=position_ids)
+                positions = position_ids[:, -1] + 1
+            else:
+                # the beams may have changed their last patch, so only the newest patch of every beam is encoded
+                masks = torch.cat((masks, torch.ones_like(masks[:, :1])), dim=1)
+                outputs = self.patch_level_decoder(generated[:, -PATCH_SIZE:].unsqueeze(1),
+                                                   masks,
+                                                   past_key_values=past_key_values,
+                                                   use_cache=True,
+                                                   position_ids=positions.unsqueeze(1))
+                positions = positions + 1
+            encoded_patches = outputs["last_hidden_state"][:, -1]
+            past_key_values = outputs["past_key_values"]
+
+        return results
+
+def sample_targets(targets, segment_ids, num_patches):
+    """
+    Sample about num_patches of the target patches on device, stratified per sample: every sample
+    (every row, or every segment of packed rows) keeps the same share of random target patches.
+    :param targets: the target patches, a boolean tensor of shape (batch, length)
+    :param segment_ids: the masks or segment ids of the target patches
+    :param num_patches: the number of patches to sample in the batch
+    :return: the sampled target patches, a boolean tensor of shape (batch, length)
+    """
+    rows, indices = targets.nonzero(as_tuple=True)
+    if len(rows) <= num_patches:
+        return targets
+    _, groups = torch.unique(rows * (int(segment_ids.max()) + 1) + segment_ids[rows, indices], return_inverse=True)
+    quota = math.ceil(num_patches / (int(groups.max()) + 1))
+
+    # shuffle, group the samples together (stable, so still shuffled within them), keep the first quota of each
+    order = torch.randperm(len(groups), device=groups.device)
+    sorted_groups, sorting = torch.sort(groups[order], stable=True)
+    order = order[sorting]
+    counts = torch.bincount(sorted_groups)
+    ranks = torch.arange(len(order), device=order.device) - (counts.cumsum(0) - counts)[sorted_groups]
+    order = order[ranks < quota]
+
+    sampled = torch.zeros_like(targets)
+    sampled[rows[order], indices[order]] = True
+    return sampled
+
+def select_tokens(logits,
+                  decoding="sample",
+                  references=None,
+                  copy_threshold=0.9,
+                  top_k=0,
+                  top_p=1,
+                  temperature=1.0,
+                  generator=None):
+    """
+    Choose the next tokens from the logits of the byte-level decoder.
+    :param logits: the logits of shape (vocab,) or (batch, vocab)
+    :param decoding: "sample", "greedy" or "copy", "copy" falls back to "greedy" without references
+    :param references: the reference tokens for "copy" decoding
+    :param copy_threshold: the probability needed to override the reference in "copy" decoding
+    :return: the chosen tokens
+    """
+    if decoding == "sample":
+        return sample_logits(logits,
+                             top_k=top_k,
+                             top_p=top_p,
+                             temperature=temperature,
+                             generator=generator)
+    elif decoding == "greedy" or (decoding == "copy" and references is None):
+        return logits.argmax(-1)
+    elif decoding == "copy":
+        return copy_unless_confident(logits, references, threshold=copy_threshold)
+    else:
+        raise ValueError("Invalid decoding mode, please use 'sample', 'greedy' or 'copy'.")
+
+def stuffing_mask(last_bytes):
+    """
+    The tokens allowed after the previous byte of entropy-coded JPEG data: after 0xFF, only 0x00 (byte
+    stuffing), a restart marker 0xD0-0xD7 or the special token (the chunk may end on 0xFF), anything after
+    any other byte.
+    :param last_bytes: the previous bytes of shape (batch,), -1 for none
+    :return: the allowed tokens of shape (batch, 257)
+    """
+    after_marker = torch.zeros(256+1, dtype=torch.bool, device=last_bytes.device)
+    after_marker[[0x00, 256]] = True
+    after_marker[0xD0:0xD8] = True
+    allowed = torch.ones((len(last_bytes), 256+1), dtype=torch.bool, device=last_bytes.device)
+    return torch.where((last_bytes == 0xFF).unsqueeze(1), after_marker, allowed)
+
+def slide_prompt(prompt, num_output_patches):
+    """
+    Drop the oldest input patches of a prompt after its first (bos) patch, like join_pair in train-gen.py with
+    SLIDING_WINDOW, so that the prompt, the output patches and the eos patch fit in PATCH_LENGTH.
+    :param prompt: the patches of shape (length, PATCH_SIZE): input bos patch, input patches and target bos patch
+    :param num_output_patches: the expected number of output patches
+    :return: the prompt without its overflow, both bos patches are kept
+    """
+    overflow = min(len(prompt) + num_output_patches + 1 - PATCH_LENGTH, len(prompt) - 2)
+    if overflow <= 0:
+        return prompt
+    return torch.cat((prompt[:1], prompt[1+overflow:]))
+
+def pad_byte_lists(byte_lists):
+    """
+    Pack byte lists of whole patches into one left-padded tensor for bGPTLMHeadModel.generate_batch.
+    :param byte_lists: the byte lists, each a multiple of PATCH_SIZE long
+    :return: the padded patches and their masks
+    """
+    length = max(len(byte_list) for byte_list in byte_lists) // PATCH_SIZE
+    patches = torch.full((len(byte_lists), length*PATCH_SIZE), 256, dtype=torch.long)
+    masks = torch.zeros((len(byte_lists), length), dtype=torch.long)
+    for i, byte_list in enumerate(byte_lists):
+        if len(byte_list) > 0:
+            patches[i, -len(byte_list):] = torch.tensor(byte_list, dtype=torch.long)
+            masks[i, -(len(byte_list)//PATCH_SIZE):] = 1
+
+    return patches, masks
+
+def encode_chunk(data: bytes):
+    """
+    Lay out a chunk like inference.py convert mode: INPUT_EXT bos patch, bytes, TARGET_EXT bos patch.
+    :param data: the bytes of the chunk
+    :return: the byte list, a multiple of PATCH_SIZE long
+    """
+    input_bos = list(bytearray(INPUT_EXT, 'utf-8'))[:PATCH_SIZE]
+    input_bos = input_bos + [256] * (PATCH_SIZE - len(input_bos))
+    target_bos = list(bytearray(TARGET_EXT, 'utf-8'))[:PATCH_SIZE]
+    target_bos = target_bos + [256] * (PATCH_SIZE - len(target_bos))
+
+    byte_list = list(data)
+    if len(byte_list) % PATCH_SIZE != 0:
+        byte_list = byte_list + [256] * (PATCH_SIZE - len(byte_list) % PATCH_SIZE)
+    byte_list = (input_bos + byte_list + [256] * PATCH_SIZE)[:PATCH_LENGTH*PATCH_SIZE]
+
+    return byte_list[:-PATCH_SIZE] + target_bos
+
+def truncation_window(length):
+    """
+    The random head/body/tail choice of training samples longer than PATCH_LENGTH patches.
+    :param length: the number of tokens, a multiple of PATCH_SIZE
+    :return: the slice of the PATCH_LENGTH*PATCH_SIZE tokens kept, all of them for shorter samples
+    """
+    if length <= PATCH_LENGTH*PATCH_SIZE:
+        return slice(0, length)
+    choice = random.choice(["head", "body", "tail"])
+    if choice == "head":
+        return slice(0, PATCH_LENGTH*PATCH_SIZE)
+    elif choice == "body" and length > (PATCH_LENGTH+1)*PATCH_SIZE:
+        start = random.randint(1, length//PATCH_SIZE-PATCH_LENGTH)
+        return slice(start*PATCH_SIZE, (start+PATCH_LENGTH)*PATCH_SIZE)
+    return slice(length-PATCH_LENGTH*PATCH_SIZE, length)
+
+def truncate_aligned(input_tokens, target_tokens):
+    """
+    Cut an input and its target to the same length and truncate both at the same offset, for the
+    correction head which predicts the clean bytes in place.
+    :param input_tokens: the input tokens, bos and eos patches included
+    :param target_tokens: the target tokens, aligned with the input
+    :return: the truncated input and target tokens, of the same length
+    """
+    length = min(len(input_tokens), len(target_tokens))
+    window = truncation_window(length)
+    return input_tokens[:length][window], target_tokens[:length][window]
+
+def pair_length(chunk_size=CHUNK_SIZE):
+    """
+    The number of patches of an input/output pair of chunks: input bos, input, output bos, output and eos patches.
+    :param chunk_size: the size of the chunks in bytes
+    :return: the number of patches
+    """
+    return 2 * math.ceil(chunk_size / PATCH_SIZE) + 3
+
+def check_chunk_geometry(chunk_size=CHUNK_SIZE):
+    """
+    Warn when an input/output pair of chunks does not fit in PATCH_LENGTH.
+    :param chunk_size: the size of the chunks in bytes
+    :return: the number of patches the pair is too long by
+    """
+    overflow = pair_length(chunk_size) - PATCH_LENGTH
+    if overflow > 0:
+        largest = (PATCH_LENGTH - 3) // 2 * PATCH_SIZE
+        if SLIDING_WINDOW:
+            print(f"Chunks of {chunk_size} bytes take {pair_length(chunk_size)} patches as input/output pairs, the oldest input patches are dropped to fit PATCH_LENGTH={PATCH_LENGTH} (chunks up to {largest} bytes fit whole)")
+        else:
+            print(f"Warning: chunks of {chunk_size} bytes take {pair_length(chunk_size)} patches as input/output pairs, the last {overflow*PATCH_SIZE} bytes of the output are truncated to fit PATCH_LENGTH={PATCH_LENGTH} (set SLIDING_WINDOW, or chunks up to {largest} bytes fit whole)")
+    return overflow
+
+def convert_chunks(model, chunks, generator=None, precision=CPU_PRECISION, regenerated=None):
+    """
+    Convert a batch of chunks at once with the decoding settings of config.py, for inference.py convert mode,
+    repair-jpeg.py and repair-server.py.
+    :param model: the bGPTLMHeadModel
+    :param chunks: the input chunks as bytes
+    :param generator: the torch.Generator used for sampling
+    :param precision: the CPU precision the model was prepared for, see apply_precision
+    :param regenerated: a list extended with the number of regenerated patches of each chunk (localized repair)
+    :return: the converted chunks as bytes
+    """
+    byte_lists = [encode_chunk(chunk) for chunk in chunks]
+    input_patches, input_masks = pad_byte_lists(byte_lists)
+    # the input bytes, without the two bos patches, are the references for copy decoding
+    references = torch.nn.utils.rnn.pad_sequence([torch.tensor(byte_list[PATCH_SIZE:-PATCH_SIZE], dtype=torch.long) for byte_list in byte_lists],
+                                                 batch_first=True,
+                                                 padding_value=256)
+    # the sliding window does not stop at PATCH_LENGTH, so the output is bounded by the longest input
+    max_patches = references.shape[1] // PATCH_SIZE + 1 if SLIDING_WINDOW else None
+    with torch.no_grad(), precision_context(model.device, precision):
+        if LOCALIZED_REPAIR:
+            outputs, num_regenerated = model.generate_localized(input_patches,
+                                                  input_masks,
+                                                  references,
+                                                  threshold=REPAIR_THRESHOLD,
+                                                  top_k=TOP_K,
+                                                  top_p=TOP_P,
+                                                  temperature=TEMPERATURE,
+                                                  generator=generator,
+                                                  decoding=DECODING_MODE,
+                                                  copy_threshold=COPY_THRESHOLD,
+                                                  sliding_window=SLIDING_WINDOW,
+                                                  speculative=SPECULATIVE_DECODING)
+            if regenerated is not None:
+                regenerated.extend(num_regenerated)
+        elif BEAM_WIDTH:
+            outputs = model.generate_beam(input_patches,
+                                          input_masks,
+                                          beam_width=BEAM_WIDTH,
+                                          jpeg_stuffing=BEAM_JPEG_PRUNING,
+                                          max_patches=max_patches,
+                                          sliding_window=SLIDING_WINDOW,
+                                          length_penalty=BEAM_LENGTH_PENALTY)
+        else:
+            outputs = model.generate_batch(input_patches,
+                                           input_masks,
+                                           top_k=TOP_K,
+                                           top_p=TOP_P,
+                                           temperature=TEMPERATURE,
+                                           generator=generator,
+                                           decoding=DECODING_MODE,
+                                           references=references,
+                                           copy_threshold=COPY_THRESHOLD,
+                                           max_patches=max_patches,
+                                           sliding_window=SLIDING_WINDOW,
+                                           speculative=SPECULATIVE_DECODING)
+    return [bytes(output) for output in outputs]
+
 class bGPTForClassification(PreTrainedModel):
     """
     This class is used to classify the patches generated by the bGPT model.
@@ -197,3 +1284,342 @@ class bGPTForClassification(PreTrainedModel):
         encoded_patches = self.patch_level_decoder(patches)["last_hidden_state"]
         encoded_patches = torch.mean(encoded_patches, dim=1)
         return self.classifier(encoded_patches)
+
+class bGPTForCorrection(PreTrainedModel):
+    """
+    This class is used to repair corruption that keeps the byte positions, such as bit flips.
+    It contains the patch level decoder and a correction head.
+    The correction head predicts the clean bytes of each patch from its encoded feature,
+    so a whole chunk is repaired in one forward pass instead of byte by byte.
+    It inherits PreTrainedModel from transformers.
+    """
+    def __init__(self, encoder_config):
+        super().__init__(encoder_config)
+        self.patch_level_decoder = PatchLevelDecoder(encoder_config)
+        self.correction_head = torch.nn.Linear(encoder_config.n_embd, PATCH_SIZE * 256)
+        torch.nn.init.normal_(self.correction_head.weight, std=0.02)
+
+    def forward(self,
+                patches: torch.Tensor,
+                masks=None,
+                target_patches=None):
+        """
+        The forward pass of the bGPT model for correction.
+        :param patches: the corrupted patches, including the bos and eos patches
+        :param masks: the masks for the patches
+        :param target_patches: the clean patches aligned with the corrupted ones, for the loss
+        :return: the logits of the clean bytes (and the loss if target_patches is given)
+        """
+        patches = patches.reshape(len(patches), -1, PATCH_SIZE)
+        encoded_patches = self.patch_level_decoder(patches, masks)["last_hidden_state"]
+        logits = self.correction_head(encoded_patches).reshape(len(patches), -1, PATCH_SIZE, 256)
+
+        loss = None
+        if target_patches is not None:
+            # the bos patch and the padding bytes (256) are not predicted
+            labels = target_patches.reshape(len(patches), -1, PATCH_SIZE).clone()
+            labels[labels == 256] = -100
+            labels[:, 0] = -100
+            if masks is not None:
+                labels[masks == 0] = -100
+            loss = torch.nn.functional.cross_entropy(logits.reshape(-1, 256).float(),
+                                                     labels.reshape(-1),
+                                                     ignore_index=-100)
+
+        return TokenClassifierOutput(loss=loss, logits=logits)
+
+    def correct(self,
+                patches: torch.Tensor,
+                masks=None):
+        """
+        The correct function for repairing a batch of patches in a single forward pass.
+        :param patches: the corrupted patches, including the bos and eos patches
+        :param masks: the masks for the patches
+        :return: the most likely clean bytes, aligned with the input bytes
+        """
+        if masks is not None:
+            masks = masks.to(self.device)
+        logits = self.forward(patches.to(self.device), masks)["logits"]
+        return logits.argmax(-1).reshape(len(patches), -1)
+
+def sdpa_attention(self, query, key, value, attention_mask=None, head_mask=None):
+    """
+    GPT2Attention._attn with torch.nn.functional.scaled_dot_product_attention, which does not keep the
+    [heads, length, length] attention weights on the backends supporting it, so the weights are not returned.
+    """
+    query_length, key_length = query.size(-2), key.size(-2)
+    if attention_mask is None and query_length == key_length:
+        return torch.nn.functional.scaled_dot_product_attention(query, key, value,
+                                                                dropout_p=self.attn_dropout.p if self.training else 0.0,
+                                                                is_causal=True), None
+
+    # the causal mask of GPT2Attention, for queries continuing past_key_values, plus the padding mask
+    mask_value = torch.finfo(query.dtype).min
+    causal = self.bias[:, :, key_length-query_length:key_length, :key_length].bool()
+    mask = torch.zeros(causal.shape, dtype=torch.float, device=query.device).masked_fill(~causal, mask_value)
+    if attention_mask is not None:
+        mask = mask + attention_mask
+    mask = mask.clamp(min=mask_value).to(query.dtype)
+    return torch.nn.functional.scaled_dot_product_attention(query, key, value,
+                                                            attn_mask=mask,
+                                                            dropout_p=self.attn_dropout.p if self.training else 0.0), None
+
+def enable_sdpa(model):
+    """
+    Run the self-attention of every GPT2 block of the model with sdpa_attention.
+    Attention with a head mask or a non-default scaling keeps the eager GPT2Attention._attn.
+    :param model: the model, changed in place
+    :return: the number of attention modules changed
+    """
+    if not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        raise ValueError("SDPA_ATTENTION needs PyTorch 2.0 or newer.")
+
+    num_modules = 0
+    for module in model.modules():
+        if not isinstance(module, GPT2Attention) or module.is_cross_attention or not hasattr(module, "_attn"):
+            continue
+        if not module.scale_attn_weights or module.scale_attn_by_inverse_layer_idx or module.reorder_and_upcast_attn:
+            continue
+        eager_attn = module._attn
+
+        def _attn(self, query, key, value, attention_mask=None, head_mask=None, eager_attn=eager_attn):
+            if head_mask is not None:
+                return eager_attn(query, key, value, attention_mask, head_mask)
+            return sdpa_attention(self, query, key, value, attention_mask)
+
+        module._attn = types.MethodType(_attn, module)
+        num_modules += 1
+    return num_modules
+
+def configure_memory(model, gradient_checkpointing=GRADIENT_CHECKPOINTING, sdpa=SDPA_ATTENTION):
+    """
+    Set the activation memory options of both GPT2 stacks of a bGPT model.
+    :param model: the model, changed in place
+    :param gradient_checkpointing: whether to recompute the activations of the blocks in the backward pass
+    :param sdpa: whether to run attention with scaled_dot_product_attention
+    :return: the model
+    """
+    for decoder in [getattr(model, "patch_level_decoder", None), getattr(model, "byte_level_decoder", None)]:
+        if decoder is None:
+            continue
+        if gradient_checkpointing:
+            decoder.base.gradient_checkpointing_enable()
+        else:
+            decoder.base.gradient_checkpointing_disable()
+    if sdpa:
+        enable_sdpa(model)
+    return model
+
+def conv1d_to_linear(module):
+    """
+    Replace the transformers Conv1D layers of GPT2 (a Linear with a transposed weight) by torch Linear
+    layers with the same weights, so that torch quantization recognises them.
+    :param module: the module, changed in place
+    :return: the module
+    """
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            linear = torch.nn.Linear(child.weight.shape[0], child.nf, device=child.weight.device)
+            linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous())
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+    return module
+
+def quantize_int8(model):
+    """
+    Quantize the linear layers of both GPT2 stacks to int8 with dynamic quantization: the weights are
+    stored in int8 and the activations quantized on the fly, on CPU only. The patch embedding stays in
+    float32, as embedding_bag reads its weights directly.
+    :param model: the model on CPU, changed in place
+    :return: the model
+    """
+    for decoder in [getattr(model, "patch_level_decoder", None), getattr(model, "byte_level_decoder", None)]:
+        if decoder is None:
+            continue
+        decoder.base = torch.ao.quantization.quantize_dynamic(conv1d_to_linear(decoder.base),
+                                                              {torch.nn.Linear},
+                                                              dtype=torch.qint8)
+    return model
+
+def apply_precision(model, device, precision=CPU_PRECISION):
+    """
+    Prepare a model in eval mode for inference with the given precision on CPU.
+    "fp32" and "bf16" (autocast, see precision_context) leave the weights as they are, "int8" quantizes them.
+    On CUDA the model always runs in float32.
+    :param model: the model
+    :param device: the device the model runs on
+    :param precision: "fp32", "bf16" or "int8"
+    :return: the model
+    """
+    if precision not in ["fp32", "bf16", "int8"]:
+        raise ValueError(f"Invalid precision {precision}, please use 'fp32', 'bf16' or 'int8'.")
+    if device.type == "cpu" and precision == "int8":
+        model = quantize_int8(model)
+    return model
+
+def precision_context(device, precision=CPU_PRECISION):
+    """
+    The context to run the model in: bfloat16 autocast for "bf16" on CPU, nothing otherwise.
+    :param device: the device the model runs on
+    :param precision: "fp32", "bf16" or "int8"
+    :return: the context manager
+    """
+    if device.type == "cpu" and precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return nullcontext()
+
+def compile_with_fallback(fn, name, **kwargs):
+    """
+    Compile a function with torch.compile, running it eagerly instead if it does not compile.
+    :param fn: the function
+    :param name: the name of the function in the fallback message
+    :param kwargs: the arguments of torch.compile
+    :return: the compiled function, which falls back to fn
+    """
+    compiled = torch.compile(fn, **kwargs)
+
+    def step(*args, **step_kwargs):
+        nonlocal compiled
+        if compiled is not fn:
+            try:
+                return compiled(*args, **step_kwargs)
+            except Exception as error:
+                print(f"Could not compile the {name} ({type(error).__name__}: {str(error).splitlines()[0] if str(error) else ''}), running it in eager mode")
+                compiled = fn
+        return fn(*args, **step_kwargs)
+
+    return step
+
+def compile_steps(model, enabled=COMPILE_STEPS):
+    """
+    Compile the two steps of generation with torch.compile: the byte-level decoder runs forward_static,
+    whose shapes are fixed by PATCH_SIZE, and the patch-level decoder its forward, whose length grows with
+    the cache. A step that does not compile runs in eager mode.
+    :param model: the bGPTLMHeadModel, changed in place
+    :param enabled: whether to compile, the model is returned unchanged otherwise
+    :return: the model
+    """
+    if not enabled:
+        return model
+    if not hasattr(torch, "compile"):
+        print("COMPILE_STEPS needs PyTorch 2.0 or newer, running in eager mode")
+        return model
+    decoder = model.byte_level_decoder
+    decoder.forward_static = compile_with_fallback(decoder.forward_static, "byte-level decoder step")
+    decoder.static_steps = True
+    model.patch_level_decoder.forward = compile_with_fallback(model.patch_level_decoder.forward,
+                                                              "patch-level decoder step",
+                                                              dynamic=True)
+    return model
+
+@contextmanager
+def skip_init():
+    """
+    Build models without random initialisation, for weights that are loaded right after.
+    The torch.nn.init functions and the _init_weights of GPT2 do nothing inside this context.
+    """
+    noop = lambda tensor, *args, **kwargs: tensor
+    init_names = ["normal_", "uniform_", "trunc_normal_", "constant_", "zeros_", "ones_",
+                  "kaiming_uniform_", "kaiming_normal_", "xavier_uniform_", "xavier_normal_"]
+    init_fns = {name: getattr(torch.nn.init, name) for name in init_names if hasattr(torch.nn.init, name)}
+    init_weights = GPT2PreTrainedModel._init_weights
+    try:
+        for name in init_fns:
+            setattr(torch.nn.init, name, noop)
+        GPT2PreTrainedModel._init_weights = lambda self, module: None
+        yield
+    finally:
+        for name, fn in init_fns.items():
+            setattr(torch.nn.init, name, fn)
+        GPT2PreTrainedModel._init_weights = init_weights
+
+def tied_keys(state_dict):
+    """Keys of the lm_head weights that are tied to their input embeddings."""
+    keys = []
+    for key in state_dict:
+        if key.endswith("lm_head.weight"):
+            wte_key = key[:-len("lm_head.weight")] + "transformer.wte.weight"
+            if wte_key in state_dict and torch.equal(state_dict[key], state_dict[wte_key]):
+                keys.append(key)
+    return keys
+
+def export_inference_weights(state_dict, path):
+    """
+    Save the model weights only, without the tied lm_head, for inference.
+    Uses safetensors for .safetensors paths, a plain torch state_dict (mmap-loadable) otherwise.
+    """
+    dropped = tied_keys(state_dict)
+    state_dict = {key: value.contiguous() for key, value in state_dict.items() if key not in dropped}
+    if path.endswith(".safetensors"):
+        if save_file is None:
+            raise ImportError("Exporting to .safetensors needs the safetensors package, use a .pt path instead.")
+        save_file(state_dict, path)
+    else:
+        torch.save({'model': state_dict}, path)
+
+def load_inference_weights(model, path, device):
+    """
+    Load the weights of a training checkpoint or of export-weights.py into model.
+    Exported torch files are memory-mapped when torch supports it, and the tied lm_head is tied again.
+    :param model: the model, ideally built inside skip_init()
+    :param path: .safetensors file, or torch file with a 'model' state_dict
+    :param device: the device to load the weights on
+    :return: the model with its weights
+    """
+    if path.endswith(".safetensors"):
+        if load_file is None:
+            raise ImportError(f"Loading {path} needs the safetensors package.")
+        state_dict = load_file(path, device=str(device))
+    else:
+        kwargs = {"mmap": True} if "mmap" in inspect.signature(torch.load).parameters else {}
+        state_dict = torch.load(path, map_location=device, **kwargs)['model']
+
+    # assign the loaded tensors instead of copying them, when torch supports it
+    kwargs = {"assign": True} if "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters else {}
+    missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False, **kwargs)
+    missing_keys = [key for key in missing_keys if not key.endswith("lm_head.weight")]
+    if len(missing_keys) > 0 or len(unexpected_keys) > 0:
+        raise RuntimeError(f"Error loading {path}: missing keys {missing_keys}, unexpected keys {unexpected_keys}")
+
+    for module in model.modules():
+        if isinstance(module, GPT2LMHeadModel):
+            module.tie_weights()
+    return model.to(device)
+
+def load_inference_model(device, weights_path=INFERENCE_WEIGHTS_PATH, precision=CPU_PRECISION, compiled=COMPILE_STEPS, correction=False):
+    """
+    Build bGPTLMHeadModel with the sizes in config.py without random init, and load its weights.
+    :param device: the device to run on
+    :param weights_path: training checkpoint or weights exported by export-weights.py
+    :param precision: the CPU precision, see apply_precision
+    :param compiled: whether to compile the generation steps, see compile_steps
+    :param correction: build bGPTForCorrection instead, which has no generation steps to compile
+    :return: the model in eval mode
+    """
+    patch_config = GPT2Config(num_hidden_layers=PATCH_NUM_LAYERS,
+                        max_length=PATCH_LENGTH,
+                        max_position_embeddings=PATCH_LENGTH,
+                        hidden_size=HIDDEN_SIZE,
+                        n_head=HIDDEN_SIZE//64,
+                        vocab_size=1)
+    byte_config = GPT2Config(num_hidden_layers=BYTE_NUM_LAYERS,
+                        max_length=PATCH_SIZE+1,
+                        max_position_embeddings=PATCH_SIZE+1,
+                        hidden_size=HIDDEN_SIZE,
+                        n_head=HIDDEN_SIZE//64,
+                        vocab_size=256+1)
+    # the weights are loaded right away, so the random initialisation is skipped
+    with skip_init():
+        if correction:
+            model = bGPTForCorrection(patch_config)
+        else:
+            model = bGPTLMHeadModel(patch_config, byte_config)
+    # training checkpoints work, weights exported by export-weights.py load faster
+    model = load_inference_weights(model, weights_path, device)
+    # on CPU, bf16 runs under autocast (precision_context) and int8 quantizes the weights here
+    model = apply_precision(model.eval(), device, precision)
+    if correction:
+        return model
+    return compile_steps(model, compiled)